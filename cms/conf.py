@@ -55,12 +55,17 @@ class Config(object):
         # System-wide
         self.temp_dir = "/tmp"
         self.backdoor = False
+        self.metrics_port_offset = None
         self.file_log_debug = False
 
         # Database.
         self.database = "postgresql+psycopg2://cmsuser@localhost/cms"
         self.database_debug = False
         self.twophase_commit = False
+        self.database_pool = {}
+        self.database_pgbouncer = False
+        self.database_replica = None
+        self.database_replica_max_lag = 5.0
 
         # Worker.
         self.keep_sandbox = True
@@ -30,11 +30,16 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import logging
+import os
+import sys
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import DisconnectionError
 from sqlalchemy.orm import joinedload, configure_mappers
+from sqlalchemy.pool import NullPool
 
 from cms import config
+from cmscommon.metrics import registry
 
 
 logger = logging.getLogger(__name__)
@@ -43,9 +48,12 @@ logger = logging.getLogger(__name__)
 # Define what this package will provide.
 
 __all__ = [
-    "version", "engine",
+    "version", "engine", "replica_engine", "get_pool_config",
+    "get_pool_status",
     # session
     "Session", "ScopedSession", "SessionGen", "custom_psycopg2_connection",
+    "ReplicaSession", "get_replica_lag", "get_read_only_session",
+    "ReadOnlySessionGen",
     # base
     "metadata", "Base",
     # types
@@ -59,7 +67,7 @@ __all__ = [
     "Manager", "Testcase",
     # submission
     "Submission", "File", "Token", "SubmissionResult", "Executable",
-    "Evaluation",
+    "Evaluation", "UserTaskScore",
     # usertest
     "UserTest", "UserTestFile", "UserTestManager", "UserTestResult",
     "UserTestExecutable",
@@ -79,12 +87,183 @@ __all__ = [
 version = 12
 
 
-engine = create_engine(config.database, echo=config.database_debug,
-                       pool_size=20, pool_recycle=120)
+# The parameters of the connection pool of the services that don't
+# have specific ones in the configuration.
+DEFAULT_POOL_CONFIG = {
+    "size": 20,
+    "max_overflow": 10,
+    "recycle": 120,
+    "pre_ping": False,
+    "statement_timeout": None,
+    }
+
+
+def get_pool_config(service_name):
+    """Return the parameters of the connection pool of a service.
+
+    They are the ones given in the database_pool configuration for
+    the service, falling back on the ones given for "default" and then
+    on DEFAULT_POOL_CONFIG.
+
+    service_name (unicode): the name of the service (e.g.
+        "ContestWebServer").
+
+    return (dict): the values of size (the connections kept open),
+        max_overflow (the further ones opened under load), recycle
+        (seconds after which a connection is replaced), pre_ping
+        (whether to test connections before using them) and
+        statement_timeout (milliseconds, or None for no timeout).
+
+    """
+    result = dict(DEFAULT_POOL_CONFIG)
+    result.update(config.database_pool.get("default", {}))
+    result.update(config.database_pool.get(service_name, {}))
+    return result
+
+
+def _get_service_name():
+    """Guess the name of the running service from the command line.
+
+    Both the installed scripts (e.g. cmsContestWebServer) and the
+    modules (e.g. ContestWebServer.py) give "ContestWebServer".
+
+    return (unicode): the name of the service.
+
+    """
+    name = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    if name.startswith("cms") and name[3:4].isupper():
+        name = name[3:]
+    return name.decode(sys.getfilesystemencoding() or "utf-8")
+
+
+# Counters about the use of the pool, to plan the capacity of the
+# database (see get_pool_status).
+_pool_stats = {
+    "checkouts": 0,
+    "overflow_checkouts": 0,
+    "exhausted_checkouts": 0,
+    "max_checked_out": 0,
+    }
+
+
+def _create_engine(url, pool_config):
+    """Create an engine, with the given pool parameters.
+
+    url (unicode): the connection string of the database.
+    pool_config (dict): as returned by get_pool_config.
+
+    return (Engine): the engine.
+
+    """
+    kwargs = dict()
+    if config.database_pgbouncer:
+        # PgBouncer does the pooling: a connection we keep open would
+        # just hold one of its slots.
+        kwargs["poolclass"] = NullPool
+    else:
+        kwargs["pool_size"] = pool_config["size"]
+        kwargs["max_overflow"] = pool_config["max_overflow"]
+        kwargs["pool_recycle"] = pool_config["recycle"]
+    new_engine = create_engine(url, echo=config.database_debug,
+                               **kwargs)
+
+    timeout = pool_config["statement_timeout"]
+    if timeout is not None and config.database_pgbouncer:
+        # In transaction pooling mode consecutive transactions may run
+        # on different server connections, hence no setting can be
+        # made for the whole session: do it for each transaction.
+        @event.listens_for(new_engine, "begin")
+        def set_local_timeout(conn):
+            conn.execute("SET LOCAL statement_timeout = %d" % timeout)
+    elif timeout is not None:
+        @event.listens_for(new_engine, "connect")
+        def set_timeout(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute("SET statement_timeout = %d" % timeout)
+            cursor.close()
+            dbapi_connection.commit()
+
+    if pool_config["pre_ping"] and not config.database_pgbouncer:
+        @event.listens_for(new_engine, "checkout")
+        def ping(dbapi_connection, connection_record, connection_proxy):
+            try:
+                cursor = dbapi_connection.cursor()
+                cursor.execute("SELECT 1")
+                cursor.close()
+                dbapi_connection.rollback()
+            except new_engine.dialect.dbapi.Error:
+                # The pool will try again with a new connection.
+                raise DisconnectionError()
+
+    @event.listens_for(new_engine, "checkout")
+    def count_checkout(dbapi_connection, connection_record,
+                       connection_proxy):
+        _pool_stats["checkouts"] += 1
+        pool = new_engine.pool
+        if isinstance(pool, NullPool):
+            return
+        checked_out = pool.checkedout()
+        _pool_stats["max_checked_out"] = \
+            max(_pool_stats["max_checked_out"], checked_out)
+        if checked_out > pool.size():
+            _pool_stats["overflow_checkouts"] += 1
+        if checked_out >= pool.size() + pool._max_overflow:
+            # The next request for a connection will have to wait.
+            if _pool_stats["exhausted_checkouts"] == 0:
+                logger.warning("Database connection pool exhausted, "
+                               "consider enlarging it.")
+            _pool_stats["exhausted_checkouts"] += 1
+
+    return new_engine
+
+
+def get_pool_status():
+    """Return the current state of the connection pool.
+
+    return (dict): the number of connections checked out, in total
+        (checkouts), when the pool had to open connections beyond its
+        size (overflow_checkouts) and when the connection was the last
+        available one (exhausted_checkouts); the largest number of
+        connections in use at the same time (max_checked_out); the
+        parameters of the pool and the number of connections in use
+        (checked_out) and idle (checked_in) right now.
+
+    """
+    result = dict(_pool_stats)
+    result.update(pool_config)
+    pool = engine.pool
+    if not isinstance(pool, NullPool):
+        result["checked_out"] = pool.checkedout()
+        result["checked_in"] = pool.checkedin()
+    return result
+
+
+pool_config = get_pool_config(_get_service_name())
+engine = _create_engine(config.database, pool_config)
+# The engine of the read-only replica, if any (its connections are
+# counted in the same statistics of the main ones).
+replica_engine = None
+if config.database_replica is not None:
+    replica_engine = _create_engine(config.database_replica, pool_config)
+
+
+# Export the state of the pool with the other metrics of the service
+# (they are read only when the metrics are requested).
+pool_status = registry.gauge(
+    "cms_db_pool_status",
+    "State of the database connection pool (see get_pool_status).",
+    ["quantity"])
+for _quantity in ["checkouts", "overflow_checkouts", "exhausted_checkouts",
+                  "max_checked_out", "size", "max_overflow",
+                  "checked_out", "checked_in"]:
+    pool_status.set_function(
+        lambda quantity=_quantity: get_pool_status().get(quantity, 0),
+        quantity=_quantity)
 
 
 from .session import Session, ScopedSession, SessionGen, \
-    custom_psycopg2_connection
+    custom_psycopg2_connection, ReplicaSession, get_replica_lag, \
+    get_read_only_session, ReadOnlySessionGen
 
 from .types import RepeatedUnicode
 from .base import metadata, Base
@@ -93,7 +272,7 @@ from .user import User, Message, Question
 from .task import Task, Statement, Attachment, SubmissionFormatElement, \
     Dataset, Manager, Testcase
 from .submission import Submission, File, Token, SubmissionResult, \
-    Executable, Evaluation
+    Executable, Evaluation, UserTaskScore
 from .usertest import UserTest, UserTestFile, UserTestManager, \
     UserTestResult, UserTestExecutable
 from .fsobject import FSObject
@@ -41,11 +41,19 @@ from sqlalchemy.exc import IntegrityError
 from cms import config, mkdir
 from cms.db import SessionGen, FSObject
 from cms.io.GeventUtils import copyfileobj, move, rmtree
+from cmscommon.metrics import registry
 
 
 logger = logging.getLogger(__name__)
 
 
+cache_lookups = registry.counter(
+    "cms_filecacher_lookups_total",
+    "Files requested to the FileCachers, by whether they were found in "
+    "the local cache (hit) or fetched from the backend (miss).",
+    ["result"])
+
+
 class FileCacherBackend(object):
     """Abstract base class for all FileCacher backends.
 
@@ -384,7 +392,8 @@ class FileCacher(object):
     # CHUNK_SIZE should be a multiple of these values.
     CHUNK_SIZE = 2 ** 14  # 16348
 
-    def __init__(self, service=None, path=None, null=False):
+    def __init__(self, service=None, path=None, null=False,
+                 cache_path=None):
         """Initialize.
 
         By default the database-powered backend will be used, but this
@@ -402,6 +411,13 @@ class FileCacher(object):
         null (bool): if True, back the FileCacher with a NullBackend,
             that just discards every file it receives. This setting
             takes priority over path.
+        cache_path (string|None): if specified, use this directory as
+            a persistent file-system cache, that is kept across runs
+            and that remembers the digests of the files stored from a
+            path (by path, modification time and size), so that they
+            are not read again while they don't change. Meant for
+            local tools that repeatedly load the same (possibly big)
+            files. Takes priority over the location given by service.
 
         """
         self.service = service
@@ -413,7 +429,9 @@ class FileCacher(object):
         else:
             self.backend = FSBackend(path)
 
-        if service is None:
+        if cache_path is not None:
+            self.file_dir = cache_path
+        elif service is None:
             self.file_dir = tempfile.mkdtemp(dir=config.temp_dir)
         else:
             self.file_dir = os.path.join(
@@ -422,8 +440,17 @@ class FileCacher(object):
 
         self.temp_dir = os.path.join(self.file_dir, "_temp")
 
+        # The digests of the files stored from a path, each in a file
+        # named after the digest of the path.
+        if cache_path is not None:
+            self.path_index_dir = os.path.join(self.file_dir, "_paths")
+        else:
+            self.path_index_dir = None
+
         if not mkdir(config.cache_dir) or not mkdir(self.file_dir) \
-                or not mkdir(self.temp_dir):
+                or not mkdir(self.temp_dir) or \
+                (self.path_index_dir is not None and
+                 not mkdir(self.path_index_dir)):
             logger.error("Cannot create necessary directories.")
             raise RuntimeError("Cannot create necessary directories.")
 
@@ -482,10 +509,13 @@ class FileCacher(object):
         if not os.path.exists(cache_file_path):
             logger.debug("File %s not in cache, downloading "
                          "from database." % digest)
+            cache_lookups.inc(result="miss")
 
             self.load(digest)
 
             logger.debug("File %s downloaded." % digest)
+        else:
+            cache_lookups.inc(result="hit")
 
         return io.open(cache_file_path, 'rb')
 
@@ -643,7 +673,9 @@ class FileCacher(object):
         """Store a file in the storage.
 
         See `put_file_from_fobj'. This method will read the content of
-        the file from the given file-system location.
+        the file from the given file-system location (unless the cache
+        is persistent and the file didn't change since the last time
+        it was stored).
 
         src_path (string): an accessible location on the file-system
             from which to read the contents of the file.
@@ -653,8 +685,44 @@ class FileCacher(object):
         return (unicode): the digest of the stored file.
 
         """
+        if self.path_index_dir is None:
+            with io.open(src_path, 'rb') as src:
+                return self.put_file_from_fobj(src, desc)
+
+        # Stat the file before reading it, so that if it changes in
+        # the meantime it will be read again the next time.
+        src_stat = os.stat(src_path)
+        stamp = "%r %d" % (src_stat.st_mtime, src_stat.st_size)
+        index_path = os.path.join(
+            self.path_index_dir,
+            hashlib.sha1(os.path.abspath(src_path).encode('utf-8'))
+            .hexdigest().decode("ascii"))
+
+        try:
+            with io.open(index_path, 'rt', encoding='utf-8') as index:
+                index_stamp, digest = index.read().rsplit(" ", 1)
+        except (IOError, ValueError):
+            pass
+        else:
+            if index_stamp == stamp and \
+                    os.path.exists(os.path.join(self.file_dir, digest)):
+                logger.debug("File %s unchanged, not reading it again." %
+                             src_path)
+                self.save(digest, desc)
+                return digest
+
         with io.open(src_path, 'rb') as src:
-            return self.put_file_from_fobj(src, desc)
+            digest = self.put_file_from_fobj(src, desc)
+
+        # Write the index entry atomically, as other processes may be
+        # using the same cache.
+        ftmp_handle, temp_index_path = tempfile.mkstemp(dir=self.temp_dir,
+                                                        text=False)
+        with os.fdopen(ftmp_handle, 'wb') as ftmp:
+            ftmp.write(("%s %s" % (stamp, digest)).encode('utf-8'))
+        os.rename(temp_index_path, index_path)
+
+        return digest
 
     def describe(self, digest):
         """Return the description of a file given its digest.
@@ -708,7 +776,10 @@ class FileCacher(object):
 
         """
         self.destroy_cache()
-        if not mkdir(config.cache_dir) or not mkdir(self.file_dir):
+        if not mkdir(config.cache_dir) or not mkdir(self.file_dir) \
+                or not mkdir(self.temp_dir) or \
+                (self.path_index_dir is not None and
+                 not mkdir(self.path_index_dir)):
             logger.error("Cannot create necessary directories.")
             raise RuntimeError("Cannot create necessary directories.")
 
@@ -31,19 +31,37 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import logging
+
 import psycopg2
 
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.engine.url import make_url
 
 from cms import config
+from cmscommon.datetime import monotonic_time
+from cmscommon.metrics import registry
+
+from . import engine, replica_engine
+
+
+logger = logging.getLogger(__name__)
 
-from . import engine
+
+session_duration = registry.histogram(
+    "cms_db_session_duration_seconds",
+    "Time between the opening and the closing of the sessions created "
+    "by SessionGen (and ReadOnlySessionGen).")
 
 
 Session = sessionmaker(engine, twophase=config.twophase_commit)
 ScopedSession = scoped_session(Session)
 
+# Sessions on the read-only replica of the database (if configured),
+# to be obtained through get_read_only_session.
+ReplicaSession = sessionmaker(replica_engine)
+
 # For two-phases transactions:
 # Session = sessionmaker(db, twophase=True)
 
@@ -61,14 +79,107 @@ class SessionGen(object):
     """
     def __init__(self):
         self.session = None
+        self.start_time = None
 
     def __enter__(self):
+        self.start_time = monotonic_time()
         self.session = Session()
         return self.session
 
     def __exit__(self, unused1, unused2, unused3):
         self.session.rollback()
         self.session.close()
+        session_duration.observe(monotonic_time() - self.start_time)
+
+
+# How many seconds the lag of the replica is trusted for.
+REPLICA_LAG_CHECK_INTERVAL = 1.0
+
+# The seconds since the last transaction replayed on the replica, or
+# zero if it isn't replaying (hence it's a primary).
+_REPLICA_LAG_QUERY = """\
+SELECT CASE WHEN pg_is_in_recovery()
+       THEN EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+       ELSE 0 END"""
+
+# The last measured lag (None if unknown) and when it was measured.
+_replica_lag = {"lag": None, "time": None}
+
+
+def get_replica_lag():
+    """Return how far behind the primary the replica is.
+
+    The lag is the time since the last transaction the replica applied
+    hence, when the primary doesn't receive writes, it grows even if
+    the replica is up to date: the replica isn't used then, which is
+    safe. It's measured at most once every REPLICA_LAG_CHECK_INTERVAL
+    seconds, and in between the time elapsed since the measurement is
+    added to it (as the replica may not have applied anything since
+    then).
+
+    return (float|None): the lag in seconds, or None if there's no
+        replica or it couldn't be measured.
+
+    """
+    if replica_engine is None:
+        return None
+    now = monotonic_time()
+    if _replica_lag["time"] is None or \
+            now - _replica_lag["time"] >= REPLICA_LAG_CHECK_INTERVAL:
+        _replica_lag["time"] = now
+        try:
+            lag = replica_engine.scalar(_REPLICA_LAG_QUERY)
+        except SQLAlchemyError as error:
+            logger.warning("Couldn't measure the lag of the replica: %s",
+                           error)
+            lag = None
+        _replica_lag["lag"] = float(lag) if lag is not None else None
+    if _replica_lag["lag"] is None:
+        return None
+    return _replica_lag["lag"] + (now - _replica_lag["time"])
+
+
+def get_read_only_session(max_lag=None):
+    """Return a session on the replica, if it's fresh enough.
+
+    The session is only meant to read data, possibly a bit older than
+    the one on the primary, to move load away from it. The caller has
+    to close it.
+
+    max_lag (float|None): the maximum acceptable lag of the replica,
+        in seconds; if None, database_replica_max_lag from the
+        configuration.
+
+    return (Session|None): a new session bound to the replica, or None
+        if there's no replica or it's lagging too much (the caller
+        should use a session on the primary instead).
+
+    """
+    if max_lag is None:
+        max_lag = config.database_replica_max_lag
+    lag = get_replica_lag()
+    if lag is None or lag > max_lag:
+        return None
+    return ReplicaSession()
+
+
+class ReadOnlySessionGen(SessionGen):
+    """Like SessionGen, with a session on the replica if possible.
+
+    See get_read_only_session; when the replica cannot be used the
+    session is on the primary.
+
+    """
+    def __init__(self, max_lag=None):
+        SessionGen.__init__(self)
+        self.max_lag = max_lag
+
+    def __enter__(self):
+        self.start_time = monotonic_time()
+        self.session = get_read_only_session(self.max_lag)
+        if self.session is None:
+            self.session = Session()
+        return self.session
 
 
 def custom_psycopg2_connection(**kwargs):
@@ -31,7 +31,8 @@ from __future__ import unicode_literals
 
 from sqlalchemy.schema import Column, ForeignKey, ForeignKeyConstraint, \
     UniqueConstraint
-from sqlalchemy.types import Integer, Float, String, Unicode, DateTime
+from sqlalchemy.types import Boolean, Integer, Float, String, Unicode, \
+    DateTime
 from sqlalchemy.orm import relationship, backref
 
 from . import Base, User, Task, Dataset, Testcase
@@ -622,3 +623,46 @@ class Evaluation(Base):
     def codename(self):
         """Return the codename of the testcase."""
         return self.testcase.codename
+
+
+class UserTaskScore(Base):
+    """Class to store the score of a user on a task.
+
+    This is a materialization of what cms.grading.task_score would
+    return for the user and the task, computed on the active dataset.
+    It's kept up to date by ScoringService and it's used to build the
+    rankings without loading all the submissions of the contest.
+
+    """
+    __tablename__ = 'user_task_scores'
+
+    # Primary key is (user_id, task_id).
+    user_id = Column(
+        Integer,
+        ForeignKey(User.id,
+                   onupdate="CASCADE", ondelete="CASCADE"),
+        primary_key=True)
+    user = relationship(
+        User)
+
+    task_id = Column(
+        Integer,
+        ForeignKey(Task.id,
+                   onupdate="CASCADE", ondelete="CASCADE"),
+        primary_key=True,
+        index=True)
+    task = relationship(
+        Task)
+
+    # The score of the user on the task.
+    score = Column(
+        Float,
+        nullable=False,
+        default=0.0)
+
+    # True if the score could change because of a submission yet to
+    # be scored.
+    partial = Column(
+        Boolean,
+        nullable=False,
+        default=False)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+# Copyright © 2014 Luca Wehrstedt <luca.wehrstedt@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A cache of the outcomes of compilations.
+
+The outcome of a compilation depends only on the task type (and its
+parameters), the language, the digests of the files and those of the
+managers the task type uses to compile. Hence a compilation with the
+same ones (a resubmission of the same source, the same submission on
+another dataset, a user test of a submitted source...) can reuse the
+executables and the compiler output of a previous one, instead of
+running the compiler again.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+from copy import deepcopy
+
+from cms.grading.Job import CompilationJob
+from cms.grading.Sandbox import Sandbox
+
+
+logger = logging.getLogger(__name__)
+
+
+class CompilationCache(object):
+    """Keep the outcomes of the last compilations, by their inputs.
+
+    """
+    # The exit statuses of the compilations whose outcome depends only
+    # on their inputs (a timeout, for example, may be caused by a
+    # loaded machine).
+    CACHEABLE_EXIT_STATUSES = [Sandbox.EXIT_OK, Sandbox.EXIT_NONZERO_RETURN]
+
+    def __init__(self, size=10000):
+        """Create an empty cache.
+
+        size (int): the maximum number of outcomes to keep; the least
+            recently used ones are discarded first.
+
+        """
+        self._size = size
+        # The exported jobs, by key, from the least recently used.
+        self._outcomes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_key(job):
+        """Return the key of the inputs of a compilation job.
+
+        job (CompilationJob): a job, filled with its input data.
+
+        return (unicode): the key.
+
+        """
+        # Imported here to avoid circular dependencies.
+        from cms.grading.tasktypes import get_task_type
+        task_type = get_task_type(job.task_type, job.task_type_parameters)
+        managers = task_type.get_compilation_managers(job)
+        inputs = [job.task_type, job.task_type_parameters, job.language,
+                  sorted((filename, file_.digest)
+                         for filename, file_ in job.files.iteritems()),
+                  sorted((filename, job.managers[filename].digest)
+                         for filename in managers
+                         if filename in job.managers)]
+        return hashlib.sha1(json.dumps(inputs)).hexdigest().decode('ascii')
+
+    def get(self, job):
+        """Fill a job with the outcome of a previous compilation.
+
+        job (CompilationJob): a job, filled with its input data.
+
+        return (bool): whether the outcome was in the cache (and the
+            job has been filled).
+
+        """
+        key = self.get_key(job)
+        if key not in self._outcomes:
+            self.misses += 1
+            return False
+        self.hits += 1
+        data = self._outcomes.pop(key)
+        self._outcomes[key] = data
+        # A copy, as the importer changes it.
+        cached = CompilationJob.import_from_dict(deepcopy(data))
+        job.success = cached.success
+        job.compilation_success = cached.compilation_success
+        job.executables = cached.executables
+        job.text = cached.text
+        job.plus = cached.plus
+        # The shard and the sandboxes are left alone: they are the ones
+        # of the job that was actually run, and this one wasn't.
+        return True
+
+    def put(self, job):
+        """Store the outcome of a compilation, if it can be reused.
+
+        job (CompilationJob): a completed job.
+
+        """
+        if not job.success or job.plus is None or \
+                job.plus.get("exit_status") not in \
+                self.CACHEABLE_EXIT_STATUSES:
+            return
+        key = self.get_key(job)
+        self._outcomes.pop(key, None)
+        data = job.export_to_dict()
+        del data['type']
+        self._outcomes[key] = data
+        while len(self._outcomes) > self._size:
+            self._outcomes.popitem(last=False)
+
+    def get_status(self):
+        """Return the statistics of the cache.
+
+        return (dict): the number of hits and misses, the ratio of the
+            hits over all lookups and the number of stored outcomes.
+
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": float(self.hits) / lookups if lookups > 0 else None,
+            "size": len(self._outcomes),
+            }
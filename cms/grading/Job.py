@@ -49,14 +49,14 @@ class Job(object):
     """Base class for all jobs.
 
     Input data (usually filled by ES): task_type,
-    task_type_parameters. Metadata: shard, sandboxes, info.
+    task_type_parameters. Metadata: shard, sandboxes, info, timings.
 
     """
 
     # TODO Move 'success' inside Job.
 
     def __init__(self, task_type=None, task_type_parameters=None,
-                 shard=None, sandboxes=None, info=None):
+                 shard=None, sandboxes=None, info=None, timings=None):
         """Initialization.
 
         task_type (string|None): the name of the task type.
@@ -66,6 +66,10 @@ class Job(object):
         sandboxes ([string]|None): the paths of the sandboxes used in
             the Worker during the execution of the job.
         info (string|None): a human readable description of the job.
+        timings ({string: float}|None): the seconds the Worker spent
+            in each phase of the job: sandbox_init, fetch (getting
+            files into the sandboxes), run, checker, upload (storing
+            files from the sandboxes), cleanup and total.
 
         """
         if task_type is None:
@@ -76,12 +80,15 @@ class Job(object):
             sandboxes = []
         if info is None:
             info = ""
+        if timings is None:
+            timings = {}
 
         self.task_type = task_type
         self.task_type_parameters = task_type_parameters
         self.shard = shard
         self.sandboxes = sandboxes
         self.info = info
+        self.timings = timings
 
     def export_to_dict(self):
         res = {
@@ -90,9 +97,19 @@ class Job(object):
             'shard': self.shard,
             'sandboxes': self.sandboxes,
             'info': self.info,
+            'timings': self.timings,
             }
         return res
 
+    def add_timing(self, phase, elapsed):
+        """Add to the time spent in a phase of the job.
+
+        phase (string): the phase (see timings in __init__).
+        elapsed (float): the seconds spent.
+
+        """
+        self.timings[phase] = self.timings.get(phase, 0.0) + elapsed
+
     @staticmethod
     def import_from_dict_with_type(data):
         type_ = data['type']
@@ -123,7 +140,7 @@ class CompilationJob(Job):
     """
 
     def __init__(self, task_type=None, task_type_parameters=None,
-                 shard=None, sandboxes=None, info=None,
+                 shard=None, sandboxes=None, info=None, timings=None,
                  language=None, files=None, managers=None,
                  success=None, compilation_success=None,
                  executables=None, text=None, plus=None):
@@ -156,7 +173,7 @@ class CompilationJob(Job):
             executables = {}
 
         Job.__init__(self, task_type, task_type_parameters,
-                     shard, sandboxes, info)
+                     shard, sandboxes, info, timings)
         self.language = language
         self.files = files
         self.managers = managers
@@ -208,7 +225,7 @@ class EvaluationJob(Job):
 
     """
     def __init__(self, task_type=None, task_type_parameters=None,
-                 shard=None, sandboxes=None, info=None,
+                 shard=None, sandboxes=None, info=None, timings=None,
                  language=None, files=None, managers=None,
                  executables=None, input=None, output=None,
                  time_limit=None, memory_limit=None,
@@ -256,7 +273,7 @@ class EvaluationJob(Job):
             executables = {}
 
         Job.__init__(self, task_type, task_type_parameters,
-                     shard, sandboxes, info)
+                     shard, sandboxes, info, timings)
         self.language = language
         self.files = files
         self.managers = managers
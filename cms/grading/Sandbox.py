@@ -216,6 +216,20 @@ class SandboxBase(object):
 
         """
         self.file_cacher = file_cacher
+        # The timings of the job using the sandbox (see Job.timings),
+        # if any.
+        self.timings = None
+
+    def add_timing(self, phase, elapsed):
+        """Add to the time spent in a phase of the job using the
+        sandbox, if any.
+
+        phase (string): the phase (see Job.timings).
+        elapsed (float): the seconds spent.
+
+        """
+        if self.timings is not None:
+            self.timings[phase] = self.timings.get(phase, 0.0) + elapsed
 
     def get_stats(self):
         """Return a human-readable string representing execution time
@@ -311,9 +325,11 @@ class SandboxBase(object):
         executable (bool): to set permissions.
 
         """
+        start_time = monotonic_time()
         file_ = self.create_file(path, executable)
         self.file_cacher.get_file_to_fobj(digest, file_)
         file_.close()
+        self.add_timing("fetch", monotonic_time() - start_time)
 
     def create_file_from_string(self, path, content, executable=False):
         """Write some data to a file in the sandbox.
@@ -392,9 +408,11 @@ class SandboxBase(object):
         return (string): the digest of the file.
 
         """
+        start_time = monotonic_time()
         file_ = self.get_file(path, trunc_len=trunc_len)
         digest = self.file_cacher.put_file_from_fobj(file_, description)
         file_.close()
+        self.add_timing("upload", monotonic_time() - start_time)
         return digest
 
     def stat_file(self, path):
@@ -425,6 +443,13 @@ class SandboxBase(object):
         """
         os.remove(self.relative_path(path))
 
+    def cleanup(self):
+        """Release the resources the sandbox holds, other than the
+        directory where it operated (that delete() removes too).
+
+        """
+        pass
+
 
 class StupidSandbox(SandboxBase):
     """A stupid sandbox implementation. It has very few features and
@@ -757,6 +782,11 @@ class IsolateSandbox(SandboxBase):
        command number N.
 
     """
+    # The highest box id isolate accepts.
+    MAX_BOX_ID = 99
+    # The box ids used by console sandboxes not yet cleaned up.
+    console_box_ids = set()
+
     def __init__(self, file_cacher=None, temp_dir=None):
         """Initialization.
 
@@ -772,8 +802,21 @@ class IsolateSandbox(SandboxBase):
             # We add 1 to avoid conflicting with console users of the
             # sandbox who use the default box id of 0.
             box_id = file_cacher.service.shard + 1
+            self.console_box = False
         else:
+            # Console users (e.g. cmsMake) may run many sandboxes at
+            # the same time: the first one gets the default box id and
+            # the others the highest free ones, which are the least
+            # likely to be used by the workers.
             box_id = 0
+            if box_id in IsolateSandbox.console_box_ids:
+                box_id = IsolateSandbox.MAX_BOX_ID
+                while box_id in IsolateSandbox.console_box_ids:
+                    box_id -= 1
+                if box_id <= 0:
+                    raise OSError("No free box ids.")
+            IsolateSandbox.console_box_ids.add(box_id)
+            self.console_box = True
 
         # We create a directory "tmp" inside the outer temporary directory,
         # because the sandbox will bind-mount the inner one. The sandbox also
@@ -1225,17 +1268,26 @@ class IsolateSandbox(SandboxBase):
         else:
             raise SandboxInterfaceException("Sandbox exit status unknown")
 
-    def delete(self):
-        """Delete the directory where the sandbox operated.
+    def cleanup(self):
+        """See SandboxBase.cleanup().
 
         """
-        logger.debug("Deleting sandbox in %s" % self.path)
-
         # Tell isolate to cleanup the sandbox.
         box_cmd = [self.box_exec] + (["--cg"] if self.cgroup else []) \
             + ["--box-id=%d" % self.box_id]
         subprocess.call(box_cmd + ["--cleanup"])
 
+        if self.console_box:
+            IsolateSandbox.console_box_ids.discard(self.box_id)
+
+    def delete(self):
+        """Delete the directory where the sandbox operated.
+
+        """
+        logger.debug("Deleting sandbox in %s" % self.path)
+
+        self.cleanup()
+
         # Delete the working directory.
         rmtree(self.outer_temp_dir)
 
@@ -35,13 +35,18 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import logging
+import os
 import re
+import tempfile
 import traceback
+from copy import deepcopy
 
 from cms import config
 from cms.grading import JobException
 from cms.grading.Sandbox import Sandbox
 from cms.grading.Job import CompilationJob, EvaluationJob
+from cms.io.GeventUtils import rmtree
+from cmscommon.datetime import monotonic_time
 
 
 logger = logging.getLogger(__name__)
@@ -49,38 +54,108 @@ logger = logging.getLogger(__name__)
 
 ## Sandbox lifecycle. ##
 
-def create_sandbox(file_cacher):
+def create_sandbox(file_cacher, job=None):
     """Create a sandbox, and return it.
 
     file_cacher (FileCacher): a file cacher instance.
+    job (Job|None): the job the sandbox is for, if any, to record the
+        time spent using it in the job's timings.
 
     return (Sandbox): a sandbox.
 
     raise (JobException): if the sandbox cannot be created.
 
     """
+    start_time = monotonic_time()
     try:
         sandbox = Sandbox(file_cacher)
     except (OSError, IOError):
         err_msg = "Couldn't create sandbox."
         logger.error("%s\n%s" % (err_msg, traceback.format_exc()))
         raise JobException(err_msg)
+    if job is not None:
+        sandbox.timings = job.timings
+    sandbox.add_timing("sandbox_init", monotonic_time() - start_time)
     return sandbox
 
 
 def delete_sandbox(sandbox):
     """Delete the sandbox, if the configuration allows it to be
-    deleted.
+    deleted, or just clean it up otherwise.
 
     sandbox (Sandbox): the sandbox to delete.
 
     """
-    if not config.keep_sandbox:
-        try:
+    start_time = monotonic_time()
+    try:
+        if not config.keep_sandbox:
             sandbox.delete()
-        except (IOError, OSError):
-            err_msg = "Couldn't delete sandbox."
-            logger.warning("%s\n%s" % (err_msg, traceback.format_exc()))
+        else:
+            sandbox.cleanup()
+    except (IOError, OSError):
+        err_msg = "Couldn't delete sandbox."
+        logger.warning("%s\n%s" % (err_msg, traceback.format_exc()))
+    sandbox.add_timing("cleanup", monotonic_time() - start_time)
+
+
+# The attributes of a sandbox that determine how it runs the commands.
+# The steps (see e.g. evaluation_step_before_run) change them as they
+# need, so a sandbox is reused only after restoring their initial
+# values.
+SANDBOX_PARAMETERS = [
+    "chdir", "dirs", "preserve_env", "inherit_env", "set_env",
+    "stdin_file", "stdout_file", "stderr_file", "stack_space",
+    "address_space", "timeout", "wallclock_timeout", "extra_timeout",
+    "max_processes", "verbosity",
+    ]
+
+
+def get_sandbox_parameters(sandbox):
+    """Return a copy of the parameters of a sandbox.
+
+    sandbox (Sandbox): the sandbox.
+
+    return ({unicode: object}): the values of SANDBOX_PARAMETERS.
+
+    """
+    return deepcopy(dict((name, getattr(sandbox, name))
+                         for name in SANDBOX_PARAMETERS))
+
+
+def set_sandbox_parameters(sandbox, parameters):
+    """Give back to a sandbox the parameters it had.
+
+    sandbox (Sandbox): the sandbox.
+    parameters ({unicode: object}): as returned by
+        get_sandbox_parameters.
+
+    """
+    for name, value in deepcopy(parameters).iteritems():
+        setattr(sandbox, name, value)
+
+
+def clear_sandbox(sandbox):
+    """Delete all the files in the sandbox, so that it can be used
+    again as if it were new.
+
+    sandbox (Sandbox): the sandbox to clear.
+
+    return (bool): whether all the files were deleted; if not, the
+        sandbox shouldn't be used again.
+
+    """
+    try:
+        for filename in os.listdir(sandbox.path):
+            path = os.path.join(sandbox.path, filename)
+            if os.path.isdir(path) and not os.path.islink(path):
+                rmtree(path)
+            else:
+                os.unlink(path)
+    except (IOError, OSError):
+        err_msg = "Couldn't clear sandbox."
+        logger.warning("%s\n%s" % (err_msg, traceback.format_exc()))
+        return False
+    return True
 
 
 class TaskType(object):
@@ -142,6 +217,13 @@ class TaskType(object):
         """
         self.parameters = parameters
 
+        # The sandboxes and FIFOs used by previous evaluations, that
+        # the next ones can reuse (see acquire_evaluation_environment),
+        # and the initial parameters of the sandboxes of each
+        # environment (by directory of the FIFOs).
+        self._idle_environments = []
+        self._environment_parameters = {}
+
     @property
     def name(self):
         """Returns the name of the TaskType.
@@ -197,6 +279,24 @@ class TaskType(object):
         """
         raise NotImplementedError("Please subclass this class.")
 
+    def get_compilation_managers(self, job):
+        """Return the managers that compile uses for the given job.
+
+        Together with the files, the language and the parameters they
+        determine the outcome of the compilation, which can then be
+        reused for other jobs with the same ones (see
+        cms.grading.CompilationCache). The default, all the managers of
+        the job, is always correct; task types can be more precise, to
+        share compilations among datasets with, e.g., different
+        checkers.
+
+        job (CompilationJob): the job.
+
+        return ([unicode]): the filenames of the managers.
+
+        """
+        return list(job.managers.iterkeys())
+
     def compile(self, job, file_cacher):
         """Try to compile the given CompilationJob.
 
@@ -240,6 +340,7 @@ class TaskType(object):
         when constructing the TaskType.
 
         """
+        start_time = monotonic_time()
         if isinstance(job, CompilationJob):
             self.compile(job, file_cacher)
         elif isinstance(job, EvaluationJob):
@@ -247,3 +348,97 @@ class TaskType(object):
         else:
             raise ValueError("The job isn't neither CompilationJob "
                              "or EvaluationJob")
+        job.add_timing("total", monotonic_time() - start_time)
+
+    def acquire_evaluation_environment(self, file_cacher, sandbox_num,
+                                       fifo_names, job=None):
+        """Return some empty sandboxes and a directory with some FIFOs,
+        for task types whose evaluations run many communicating
+        processes.
+
+        Setting them up is expensive compared to a short evaluation,
+        so the ones released by a previous evaluation are reused,
+        after having been cleared (of their files and of the changes
+        to their parameters). They are kept until cleanup() is
+        called.
+
+        file_cacher (FileCacher): the file cacher for the sandboxes.
+        sandbox_num (int): the number of sandboxes.
+        fifo_names ([unicode]): the names of the FIFOs.
+        job (Job|None): the job they are for, if any, to record the
+            time spent using them in the job's timings.
+
+        return (([Sandbox], unicode)): the sandboxes and the path of
+            the directory with the FIFOs.
+
+        """
+        while len(self._idle_environments) > 0:
+            start_time = monotonic_time()
+            sandboxes, fifo_dir = self._idle_environments.pop()
+            if all(clear_sandbox(sandbox) for sandbox in sandboxes):
+                for sandbox, parameters in zip(
+                        sandboxes, self._environment_parameters[fifo_dir]):
+                    set_sandbox_parameters(sandbox, parameters)
+                if job is not None:
+                    for sandbox in sandboxes:
+                        sandbox.timings = job.timings
+                    job.add_timing("sandbox_init",
+                                   monotonic_time() - start_time)
+                return sandboxes, fifo_dir
+            self.discard_evaluation_environment(sandboxes, fifo_dir)
+
+        sandboxes = [create_sandbox(file_cacher, job)
+                     for _ in xrange(sandbox_num)]
+        fifo_dir = tempfile.mkdtemp(dir=config.temp_dir)
+        for name in fifo_names:
+            fifo = os.path.join(fifo_dir, name)
+            os.mkfifo(fifo)
+            os.chmod(fifo, 0o666)
+        os.chmod(fifo_dir, 0o755)
+        self._environment_parameters[fifo_dir] = \
+            [get_sandbox_parameters(sandbox) for sandbox in sandboxes]
+        return sandboxes, fifo_dir
+
+    def release_evaluation_environment(self, sandboxes, fifo_dir):
+        """Give back what acquire_evaluation_environment returned, to
+        let the next evaluations reuse it.
+
+        If the sandboxes have to be kept, to be inspected, they are
+        deleted (i.e., kept) instead. If the evaluation didn't
+        complete, use discard_evaluation_environment.
+
+        sandboxes ([Sandbox]): the sandboxes.
+        fifo_dir (unicode): the path of the directory with the FIFOs.
+
+        """
+        if config.keep_sandbox:
+            self.discard_evaluation_environment(sandboxes, fifo_dir)
+        else:
+            for sandbox in sandboxes:
+                sandbox.timings = None
+            self._idle_environments.append((sandboxes, fifo_dir))
+
+    def discard_evaluation_environment(self, sandboxes, fifo_dir):
+        """Delete what acquire_evaluation_environment returned,
+        instead of giving it back (e.g., because the evaluation raised
+        an exception, and processes may still be using it).
+
+        sandboxes ([Sandbox]): the sandboxes.
+        fifo_dir (unicode): the path of the directory with the FIFOs.
+
+        """
+        self._environment_parameters.pop(fifo_dir, None)
+        for sandbox in sandboxes:
+            delete_sandbox(sandbox)
+        rmtree(fifo_dir)
+
+    def cleanup(self):
+        """Release the resources kept to be reused by the next jobs.
+
+        To be called when no more jobs will be executed by this
+        object.
+
+        """
+        while len(self._idle_environments) > 0:
+            self.discard_evaluation_environment(
+                *self._idle_environments.pop())
@@ -38,6 +38,7 @@ from sqlalchemy.orm import joinedload
 from cms import LANG_C, LANG_CPP, LANG_PASCAL, LANG_PYTHON, LANG_PHP, LANG_JAVA
 from cms.db import Submission
 from cms.grading.Sandbox import Sandbox
+from cmscommon.datetime import monotonic_time
 
 
 logger = logging.getLogger(__name__)
@@ -231,12 +232,15 @@ def compilation_step(sandbox, commands):
 
     # Actually run the compilation commands.
     logger.debug("Starting compilation step.")
+    start_time = monotonic_time()
     for command in commands:
         box_success = sandbox.execute_without_std(command, wait=True)
         if not box_success:
+            sandbox.add_timing("run", monotonic_time() - start_time)
             logger.error("Compilation aborted because of "
                          "sandbox error in `%s'." % sandbox.path)
             return False, None, None, None
+    sandbox.add_timing("run", monotonic_time() - start_time)
 
     # Detect the outcome of the compilation.
     exit_status = sandbox.get_exit_status()
@@ -327,7 +331,8 @@ def compilation_step(sandbox, commands):
 def evaluation_step(sandbox, commands,
                     time_limit=0.0, memory_limit=0,
                     allow_dirs=None,
-                    stdin_redirect=None, stdout_redirect=None):
+                    stdin_redirect=None, stdout_redirect=None,
+                    phase="run"):
     """Execute some evaluation commands in the sandbox. Note that in
     some task types, there may be more than one evaluation commands
     (per testcase) (in others there can be none, of course).
@@ -336,20 +341,25 @@ def evaluation_step(sandbox, commands,
     commands ([[string]]): the actual evaluation lines.
     time_limit (float): time limit in seconds.
     memory_limit (int): memory limit in MB.
+    phase (string): the phase of the job the time taken counts for
+        (see Job.timings).
 
     return ((bool, dict)): True if the evaluation was successful, or
         False; and additional data.
 
     """
+    start_time = monotonic_time()
     for command in commands:
         success = evaluation_step_before_run(
             sandbox, command, time_limit, memory_limit, allow_dirs,
             stdin_redirect, stdout_redirect, wait=True)
         if not success:
+            sandbox.add_timing(phase, monotonic_time() - start_time)
             logger.debug("Job failed in evaluation_step_before_run.")
             return False, None
 
     success, plus = evaluation_step_after_run(sandbox)
+    sandbox.add_timing(phase, monotonic_time() - start_time)
     if not success:
         logger.debug("Job failed in evaluation_step_after_run: %r" % plus)
 
@@ -660,6 +670,7 @@ def white_diff_step(sandbox, output_filename,
         description text.
 
     """
+    start_time = monotonic_time()
     if sandbox.file_exists(output_filename):
         out_file = sandbox.get_file(output_filename)
         res_file = sandbox.get_file("res.txt")
@@ -672,6 +683,7 @@ def white_diff_step(sandbox, output_filename,
     else:
         outcome = 0.0
         text = [N_("Evaluation didn't produce file %s"), output_filename]
+    sandbox.add_timing("checker", monotonic_time() - start_time)
     return outcome, text
 
 
@@ -748,7 +760,22 @@ def task_score(user, task):
     # come from a joinedload with the submissions, tokens and
     # submission_results table.  Doing so means that this function should incur
     # no exta database queries.
+    submissions = [s for s in user.submissions if s.task is task]
+    return submissions_score(submissions, task.active_dataset)
+
+
+def submissions_score(submissions, dataset):
+    """Return the score obtained by a set of submissions on a dataset.
+
+    submissions ([Submission]): all the submissions of a user on the
+        task the dataset belongs to (in any order); their tokens and
+        results should be already loaded to avoid extra queries.
+    dataset (Dataset): the dataset to use, usually the active one.
 
+    return ((float, bool)): the score of the submissions, and True if
+        the score could change because of a submission yet to score.
+
+    """
     # The score of the last submission (if valid, otherwise 0.0).
     last_score = 0.0
     # The maximum score amongst the tokened submissions (invalid
@@ -758,8 +785,7 @@ def task_score(user, task):
     # / evaluated / scored.
     partial = False
 
-    submissions = [s for s in user.submissions if s.task is task]
-    submissions.sort(key=lambda s: s.timestamp)
+    submissions = sorted(submissions, key=lambda s: s.timestamp)
 
     if submissions == []:
         return 0.0, False
@@ -768,7 +794,7 @@ def task_score(user, task):
     # otherwise we use 0.0 (and mark that the score is partial
     # when the last submission could be scored).
     last_s = submissions[-1]
-    last_sr = last_s.get_result(task.active_dataset)
+    last_sr = last_s.get_result(dataset)
 
     if last_sr is not None and last_sr.scored():
         last_score = last_sr.score
@@ -776,7 +802,7 @@ def task_score(user, task):
         partial = True
 
     for s in submissions:
-        sr = s.get_result(task.active_dataset)
+        sr = s.get_result(dataset)
         if s.tokened():
             if sr is not None and sr.scored():
                 max_tokened_score = max(max_tokened_score, sr.score)
@@ -132,6 +132,19 @@ class Batch(TaskType):
         """See TaskType.get_auto_managers."""
         return None
 
+    def get_compilation_managers(self, job):
+        """See TaskType.get_compilation_managers."""
+        # The grader, if any, and all headers: see compile.
+        result = list()
+        if self.parameters[0] == "grader":
+            result.append(
+                "grader%s" % LANGUAGE_TO_SOURCE_EXT_MAP[job.language])
+        for filename in job.managers.iterkeys():
+            if any(filename.endswith(header)
+                   for header in LANGUAGE_TO_HEADER_EXT_MAP.itervalues()):
+                result.append(filename)
+        return result
+
     def compile(self, job, file_cacher):
         """See TaskType.compile."""
         # Detect the submission's language. The checks about the
@@ -153,7 +166,7 @@ class Batch(TaskType):
             return True
 
         # Create the sandbox
-        sandbox = create_sandbox(file_cacher)
+        sandbox = create_sandbox(file_cacher, job)
         job.sandboxes.append(sandbox.path)
 
         # Prepare the source files in the sandbox
@@ -210,7 +223,7 @@ class Batch(TaskType):
     def evaluate(self, job, file_cacher):
         """See TaskType.evaluate."""
         # Create the sandbox
-        sandbox = create_sandbox(file_cacher)
+        sandbox = create_sandbox(file_cacher, job)
 
         # Prepare the execution
         executable_filename = job.executables.keys()[0]
@@ -322,7 +335,8 @@ class Batch(TaskType):
                             success, _ = evaluation_step(
                                 sandbox,
                                 [["./%s" % manager_filename,
-                                  input_filename, "res.txt", output_filename]])
+                                  input_filename, "res.txt", output_filename]],
+                                phase="checker")
                         if success:
                             try:
                                 outcome, text = \
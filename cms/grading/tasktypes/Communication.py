@@ -26,10 +26,9 @@ from __future__ import unicode_literals
 
 import logging
 import os
-import tempfile
 
 from cms import LANGUAGES, LANGUAGE_TO_SOURCE_EXT_MAP, \
-    LANGUAGE_TO_HEADER_EXT_MAP, config
+    LANGUAGE_TO_HEADER_EXT_MAP
 from cms.grading.Sandbox import wait_without_std
 from cms.grading import get_compilation_commands, compilation_step, \
     human_evaluation_message, is_evaluation_passed, \
@@ -38,7 +37,7 @@ from cms.grading import get_compilation_commands, compilation_step, \
 from cms.grading.TaskType import TaskType, \
     create_sandbox, delete_sandbox
 from cms.db import Executable
-from cms.io.GeventUtils import rmtree
+from cmscommon.datetime import monotonic_time
 
 
 logger = logging.getLogger(__name__)
@@ -91,6 +90,16 @@ class Communication(TaskType):
         """See TaskType.get_auto_managers."""
         return ["manager"]
 
+    def get_compilation_managers(self, job):
+        """See TaskType.get_compilation_managers."""
+        # The stub and all headers: see compile.
+        result = ["stub%s" % LANGUAGE_TO_SOURCE_EXT_MAP[job.language]]
+        for filename in job.managers.iterkeys():
+            if any(filename.endswith(header)
+                   for header in LANGUAGE_TO_HEADER_EXT_MAP.itervalues()):
+                result.append(filename)
+        return result
+
     def compile(self, job, file_cacher):
         """See TaskType.compile."""
         # Detect the submission's language. The checks about the
@@ -112,7 +121,7 @@ class Communication(TaskType):
             return True
 
         # Create the sandbox
-        sandbox = create_sandbox(file_cacher)
+        sandbox = create_sandbox(file_cacher, job)
         job.sandboxes.append(sandbox.path)
 
         # Prepare the source files in the sandbox
@@ -166,102 +175,105 @@ class Communication(TaskType):
 
     def evaluate(self, job, file_cacher):
         """See TaskType.evaluate."""
-        # Create sandboxes and FIFOs
-        sandbox_mgr = create_sandbox(file_cacher)
-        sandbox_user = create_sandbox(file_cacher)
-        fifo_dir = tempfile.mkdtemp(dir=config.temp_dir)
-        fifo_in = os.path.join(fifo_dir, "in")
-        fifo_out = os.path.join(fifo_dir, "out")
-        os.mkfifo(fifo_in)
-        os.mkfifo(fifo_out)
-        os.chmod(fifo_dir, 0o755)
-        os.chmod(fifo_in, 0o666)
-        os.chmod(fifo_out, 0o666)
-
-        # First step: we start the manager.
-        manager_filename = "manager"
-        manager_command = ["./%s" % manager_filename, fifo_in, fifo_out]
-        manager_executables_to_get = {
-            manager_filename:
-            job.managers[manager_filename].digest
-            }
-        manager_files_to_get = {
-            "input.txt": job.input
-            }
-        manager_allow_dirs = [fifo_dir]
-        for filename, digest in manager_executables_to_get.iteritems():
-            sandbox_mgr.create_file_from_storage(
-                filename, digest, executable=True)
-        for filename, digest in manager_files_to_get.iteritems():
-            sandbox_mgr.create_file_from_storage(filename, digest)
-        manager = evaluation_step_before_run(
-            sandbox_mgr,
-            manager_command,
-            job.time_limit,
-            0,
-            allow_dirs=manager_allow_dirs,
-            stdin_redirect="input.txt")
-
-        # Second step: we start the user submission compiled with the
-        # stub.
-        executable_filename = job.executables.keys()[0]
-        command = ["./%s" % executable_filename, fifo_out, fifo_in]
-        executables_to_get = {
-            executable_filename:
-            job.executables[executable_filename].digest
-            }
-        user_allow_dirs = [fifo_dir]
-        for filename, digest in executables_to_get.iteritems():
-            sandbox_user.create_file_from_storage(
-                filename, digest, executable=True)
-        process = evaluation_step_before_run(
-            sandbox_user,
-            command,
-            job.time_limit,
-            job.memory_limit,
-            allow_dirs=user_allow_dirs)
-
-        # Consume output.
-        wait_without_std([process, manager])
-        # TODO: check exit codes with translate_box_exitcode.
-
-        success_user, plus_user = \
-            evaluation_step_after_run(sandbox_user)
-        success_mgr, plus_mgr = \
-            evaluation_step_after_run(sandbox_mgr)
-
-        job.sandboxes = [sandbox_user.path,
-                         sandbox_mgr.path]
-        job.plus = plus_user
-
-        # If at least one evaluation had problems, we report the
-        # problems.
-        if not success_user or not success_mgr:
-            success, outcome, text = False, None, None
-        # If the user sandbox detected some problem (timeout, ...),
-        # the outcome is 0.0 and the text describes that problem.
-        elif not is_evaluation_passed(plus_user):
-            success = True
-            outcome, text = 0.0, human_evaluation_message(plus_user)
-        # Otherwise, we use the manager to obtain the outcome.
-        else:
-            success = True
-            outcome, text = extract_outcome_and_text(sandbox_mgr)
-
-        # If asked so, save the output file, provided that it exists
-        if job.get_output:
-            if sandbox_mgr.file_exists("output.txt"):
-                job.user_output = sandbox_mgr.get_file_to_storage(
-                    "output.txt",
-                    "Output file in job %s" % job.info)
+        # Get sandboxes and FIFOs (possibly the ones of the previous
+        # evaluation)
+        (sandbox_mgr, sandbox_user), fifo_dir = \
+            self.acquire_evaluation_environment(file_cacher, 2,
+                                                ["in", "out"], job)
+        try:
+            fifo_in = os.path.join(fifo_dir, "in")
+            fifo_out = os.path.join(fifo_dir, "out")
+
+            # First step: we start the manager.
+            manager_filename = "manager"
+            manager_command = ["./%s" % manager_filename, fifo_in, fifo_out]
+            manager_executables_to_get = {
+                manager_filename:
+                job.managers[manager_filename].digest
+                }
+            manager_files_to_get = {
+                "input.txt": job.input
+                }
+            manager_allow_dirs = [fifo_dir]
+            for filename, digest in manager_executables_to_get.iteritems():
+                sandbox_mgr.create_file_from_storage(
+                    filename, digest, executable=True)
+            for filename, digest in manager_files_to_get.iteritems():
+                sandbox_mgr.create_file_from_storage(filename, digest)
+            manager = evaluation_step_before_run(
+                sandbox_mgr,
+                manager_command,
+                job.time_limit,
+                0,
+                allow_dirs=manager_allow_dirs,
+                stdin_redirect="input.txt")
+
+            # Second step: we start the user submission compiled with the
+            # stub.
+            executable_filename = job.executables.keys()[0]
+            command = ["./%s" % executable_filename, fifo_out, fifo_in]
+            executables_to_get = {
+                executable_filename:
+                job.executables[executable_filename].digest
+                }
+            user_allow_dirs = [fifo_dir]
+            for filename, digest in executables_to_get.iteritems():
+                sandbox_user.create_file_from_storage(
+                    filename, digest, executable=True)
+            process = evaluation_step_before_run(
+                sandbox_user,
+                command,
+                job.time_limit,
+                job.memory_limit,
+                allow_dirs=user_allow_dirs)
+            run_time = monotonic_time()
+
+            # Consume output.
+            wait_without_std([process, manager])
+            job.add_timing("run", monotonic_time() - run_time)
+            # TODO: check exit codes with translate_box_exitcode.
+
+            success_user, plus_user = \
+                evaluation_step_after_run(sandbox_user)
+            success_mgr, plus_mgr = \
+                evaluation_step_after_run(sandbox_mgr)
+
+            job.sandboxes = [sandbox_user.path,
+                             sandbox_mgr.path]
+            job.plus = plus_user
+
+            # If at least one evaluation had problems, we report the
+            # problems.
+            if not success_user or not success_mgr:
+                success, outcome, text = False, None, None
+            # If the user sandbox detected some problem (timeout, ...),
+            # the outcome is 0.0 and the text describes that problem.
+            elif not is_evaluation_passed(plus_user):
+                success = True
+                outcome, text = 0.0, human_evaluation_message(plus_user)
+            # Otherwise, we use the manager to obtain the outcome.
             else:
-                job.user_output = None
-
-        # Whatever happened, we conclude.
-        job.success = success
-        job.outcome = "%s" % outcome if outcome is not None else None
-        job.text = text
-
-        delete_sandbox(sandbox_mgr)
-        delete_sandbox(sandbox_user)
-        rmtree(fifo_dir)
+                success = True
+                outcome, text = extract_outcome_and_text(sandbox_mgr)
+
+            # If asked so, save the output file, provided that it exists
+            if job.get_output:
+                if sandbox_mgr.file_exists("output.txt"):
+                    job.user_output = sandbox_mgr.get_file_to_storage(
+                        "output.txt",
+                        "Output file in job %s" % job.info)
+                else:
+                    job.user_output = None
+
+            # Whatever happened, we conclude.
+            job.success = success
+            job.outcome = "%s" % outcome if outcome is not None else None
+            job.text = text
+        except:
+            # Don't reuse them: they are in an unknown state.
+            self.discard_evaluation_environment([sandbox_mgr, sandbox_user],
+                                                fifo_dir)
+            raise
+
+        self.release_evaluation_environment([sandbox_mgr, sandbox_user],
+                                            fifo_dir)
@@ -96,7 +96,7 @@ class OutputOnly(TaskType):
 
     def evaluate(self, job, file_cacher):
         """See TaskType.evaluate."""
-        sandbox = create_sandbox(file_cacher)
+        sandbox = create_sandbox(file_cacher, job)
         job.sandboxes.append(sandbox.path)
 
         # Immediately prepare the skeleton to return
@@ -153,7 +153,8 @@ class OutputOnly(TaskType):
                 success, _ = evaluation_step(
                     sandbox,
                     [["./%s" % manager_filename,
-                      "input.txt", "res.txt", "output.txt"]])
+                      "input.txt", "res.txt", "output.txt"]],
+                    phase="checker")
                 if success:
                     outcome, text = extract_outcome_and_text(sandbox)
 
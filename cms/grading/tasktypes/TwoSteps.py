@@ -26,10 +26,9 @@ from __future__ import unicode_literals
 
 import logging
 import os
-import tempfile
 
 from cms import LANGUAGES, LANGUAGE_TO_SOURCE_EXT_MAP, \
-    LANGUAGE_TO_HEADER_EXT_MAP, config
+    LANGUAGE_TO_HEADER_EXT_MAP
 from cms.grading.Sandbox import wait_without_std
 from cms.grading import get_compilation_commands, compilation_step, \
     evaluation_step_before_run, evaluation_step_after_run, \
@@ -37,6 +36,7 @@ from cms.grading import get_compilation_commands, compilation_step, \
 from cms.grading.TaskType import TaskType, \
     create_sandbox, delete_sandbox
 from cms.db import Executable
+from cmscommon.datetime import monotonic_time
 
 
 logger = logging.getLogger(__name__)
@@ -117,7 +117,7 @@ class TwoSteps(TaskType):
             return True
 
         # First and only one compilation.
-        sandbox = create_sandbox(file_cacher)
+        sandbox = create_sandbox(file_cacher, job)
         job.sandboxes.append(sandbox.path)
         files_to_get = {}
 
@@ -174,133 +174,139 @@ class TwoSteps(TaskType):
     def evaluate(self, job, file_cacher):
         """See TaskType.evaluate."""
         # f stand for first, s for second.
-        first_sandbox = create_sandbox(file_cacher)
-        second_sandbox = create_sandbox(file_cacher)
-        fifo_dir = tempfile.mkdtemp(dir=config.temp_dir)
-        fifo = os.path.join(fifo_dir, "fifo")
-        os.mkfifo(fifo)
-        os.chmod(fifo_dir, 0o755)
-        os.chmod(fifo, 0o666)
-
-        # First step: we start the first manager.
-        first_filename = "manager"
-        first_command = ["./%s" % first_filename, "0", fifo]
-        first_executables_to_get = {
-            first_filename:
-            job.executables[first_filename].digest
-            }
-        first_files_to_get = {
-            "input.txt": job.input
-            }
-        first_allow_path = [fifo_dir]
-
-        # Put the required files into the sandbox
-        for filename, digest in first_executables_to_get.iteritems():
-            first_sandbox.create_file_from_storage(filename,
-                                                   digest,
-                                                   executable=True)
-        for filename, digest in first_files_to_get.iteritems():
-            first_sandbox.create_file_from_storage(filename, digest)
-
-        first = evaluation_step_before_run(
-            first_sandbox,
-            first_command,
-            job.time_limit,
-            job.memory_limit,
-            first_allow_path,
-            stdin_redirect="input.txt",
-            wait=False)
-
-        # Second step: we start the second manager.
-        second_filename = "manager"
-        second_command = ["./%s" % second_filename, "1", fifo]
-        second_executables_to_get = {
-            second_filename:
-            job.executables[second_filename].digest
-            }
-        second_files_to_get = {}
-        second_allow_path = [fifo_dir]
-
-        # Put the required files into the second sandbox
-        for filename, digest in second_executables_to_get.iteritems():
-            second_sandbox.create_file_from_storage(filename,
-                                                    digest,
-                                                    executable=True)
-        for filename, digest in second_files_to_get.iteritems():
-            second_sandbox.create_file_from_storage(filename, digest)
-
-        second = evaluation_step_before_run(
-            second_sandbox,
-            second_command,
-            job.time_limit,
-            job.memory_limit,
-            second_allow_path,
-            stdout_redirect="output.txt",
-            wait=False)
-
-        # Consume output.
-        wait_without_std([second, first])
-        # TODO: check exit codes with translate_box_exitcode.
-
-        success_first, first_plus = \
-            evaluation_step_after_run(first_sandbox)
-        success_second, second_plus = \
-            evaluation_step_after_run(second_sandbox)
-
-        job.sandboxes = [first_sandbox.path,
-                         second_sandbox.path]
-        job.plus = second_plus
-
-        success = True
-        outcome = None
-        text = None
-
-        # Error in the sandbox: report failure!
-        if not success_first or not success_second:
-            success = False
-
-        # Contestant's error: the marks won't be good
-        elif not is_evaluation_passed(first_plus) or \
-                not is_evaluation_passed(second_plus):
-            outcome = 0.0
-            if not is_evaluation_passed(first_plus):
-                text = human_evaluation_message(first_plus)
-            else:
-                text = human_evaluation_message(second_plus)
-            if job.get_output:
-                job.user_output = None
-
-        # Otherwise, advance to checking the solution
-        else:
-
-            # Check that the output file was created
-            if not second_sandbox.file_exists('output.txt'):
+        (first_sandbox, second_sandbox), fifo_dir = \
+            self.acquire_evaluation_environment(file_cacher, 2, ["fifo"],
+                                                job)
+        try:
+            fifo = os.path.join(fifo_dir, "fifo")
+
+            # First step: we start the first manager.
+            first_filename = "manager"
+            first_command = ["./%s" % first_filename, "0", fifo]
+            first_executables_to_get = {
+                first_filename:
+                job.executables[first_filename].digest
+                }
+            first_files_to_get = {
+                "input.txt": job.input
+                }
+            first_allow_path = [fifo_dir]
+
+            # Put the required files into the sandbox
+            for filename, digest in first_executables_to_get.iteritems():
+                first_sandbox.create_file_from_storage(filename,
+                                                       digest,
+                                                       executable=True)
+            for filename, digest in first_files_to_get.iteritems():
+                first_sandbox.create_file_from_storage(filename, digest)
+
+            first = evaluation_step_before_run(
+                first_sandbox,
+                first_command,
+                job.time_limit,
+                job.memory_limit,
+                first_allow_path,
+                stdin_redirect="input.txt",
+                wait=False)
+
+            # Second step: we start the second manager.
+            second_filename = "manager"
+            second_command = ["./%s" % second_filename, "1", fifo]
+            second_executables_to_get = {
+                second_filename:
+                job.executables[second_filename].digest
+                }
+            second_files_to_get = {}
+            second_allow_path = [fifo_dir]
+
+            # Put the required files into the second sandbox
+            for filename, digest in second_executables_to_get.iteritems():
+                second_sandbox.create_file_from_storage(filename,
+                                                        digest,
+                                                        executable=True)
+            for filename, digest in second_files_to_get.iteritems():
+                second_sandbox.create_file_from_storage(filename, digest)
+
+            second = evaluation_step_before_run(
+                second_sandbox,
+                second_command,
+                job.time_limit,
+                job.memory_limit,
+                second_allow_path,
+                stdout_redirect="output.txt",
+                wait=False)
+            run_time = monotonic_time()
+
+            # Consume output.
+            wait_without_std([second, first])
+            job.add_timing("run", monotonic_time() - run_time)
+            # TODO: check exit codes with translate_box_exitcode.
+
+            success_first, first_plus = \
+                evaluation_step_after_run(first_sandbox)
+            success_second, second_plus = \
+                evaluation_step_after_run(second_sandbox)
+
+            job.sandboxes = [first_sandbox.path,
+                             second_sandbox.path]
+            job.plus = second_plus
+
+            success = True
+            outcome = None
+            text = None
+
+            # Error in the sandbox: report failure!
+            if not success_first or not success_second:
+                success = False
+
+            # Contestant's error: the marks won't be good
+            elif not is_evaluation_passed(first_plus) or \
+                    not is_evaluation_passed(second_plus):
                 outcome = 0.0
-                text = [N_("Evaluation didn't produce file %s"), "output.txt"]
+                if not is_evaluation_passed(first_plus):
+                    text = human_evaluation_message(first_plus)
+                else:
+                    text = human_evaluation_message(second_plus)
                 if job.get_output:
                     job.user_output = None
 
+            # Otherwise, advance to checking the solution
             else:
-                # If asked so, put the output file into the storage
-                if job.get_output:
-                    job.user_output = second_sandbox.get_file_to_storage(
-                        "output.txt",
-                        "Output file in job %s" % job.info)
-
-                # If not asked otherwise, evaluate the output file
-                if not job.only_execution:
-                    # Put the reference solution into the sandbox
-                    second_sandbox.create_file_from_storage(
-                        "res.txt",
-                        job.output)
-
-                    outcome, text = white_diff_step(
-                        second_sandbox, "output.txt", "res.txt")
-
-        # Whatever happened, we conclude.
-        job.success = success
-        job.outcome = str(outcome)
-        job.text = text
 
-        delete_sandbox(first_sandbox)
-        delete_sandbox(second_sandbox)
+                # Check that the output file was created
+                if not second_sandbox.file_exists('output.txt'):
+                    outcome = 0.0
+                    text = [N_("Evaluation didn't produce file %s"),
+                            "output.txt"]
+                    if job.get_output:
+                        job.user_output = None
+
+                else:
+                    # If asked so, put the output file into the storage
+                    if job.get_output:
+                        job.user_output = second_sandbox.get_file_to_storage(
+                            "output.txt",
+                            "Output file in job %s" % job.info)
+
+                    # If not asked otherwise, evaluate the output file
+                    if not job.only_execution:
+                        # Put the reference solution into the sandbox
+                        second_sandbox.create_file_from_storage(
+                            "res.txt",
+                            job.output)
+
+                        outcome, text = white_diff_step(
+                            second_sandbox, "output.txt", "res.txt")
+
+            # Whatever happened, we conclude.
+            job.success = success
+            job.outcome = str(outcome)
+            job.text = text
+        except:
+            # Don't reuse them: they are in an unknown state.
+            self.discard_evaluation_environment(
+                [first_sandbox, second_sandbox], fifo_dir)
+            raise
+
+        self.release_evaluation_environment([first_sandbox, second_sandbox],
+                                            fifo_dir)
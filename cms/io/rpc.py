@@ -38,11 +38,22 @@ import gevent.socket
 import gevent.event
 
 from cms import get_service_address
+from cmscommon.datetime import monotonic_time
+from cmscommon.metrics import registry
 
 
 logger = logging.getLogger(__name__)
 
 
+rpc_duration = registry.histogram(
+    "cms_rpc_duration_seconds",
+    "Time spent serving the RPC requests, by method.", ["method"])
+rpc_errors = registry.counter(
+    "cms_rpc_errors_total",
+    "RPC requests whose method raised an exception, by method.",
+    ["method"])
+
+
 class RPCError(Exception):
     """Generic error during RPC communication."""
     pass
@@ -372,12 +383,16 @@ class RemoteServiceServer(RemoteServiceBase):
             if not getattr(method, "rpc_callable", False):
                 response["__error"] = "Method %s isn't callable." % method_name
             else:
+                start_time = monotonic_time()
                 try:
                     response["__data"] = method(**request["__data"])
                 except Exception as error:
                     response["__error"] = "%s: %s\n%s" % \
                         (error.__class__.__name__, error,
                          traceback.format_exc())
+                    rpc_errors.inc(method=method_name)
+                rpc_duration.observe(monotonic_time() - start_time,
+                                     method=method_name)
 
         # Encode it.
         try:
@@ -45,11 +45,13 @@ import gevent.socket
 import gevent.event
 from gevent.server import StreamServer
 from gevent.backdoor import BackdoorServer
+from gevent.pywsgi import WSGIServer
 
 from cms import config, mkdir, ServiceCoord, Address, get_service_address
 from cms.log import root_logger, shell_handler, ServiceFilter, \
     CustomFormatter, LogServiceHandler, FileHandler
 from cmscommon.datetime import monotonic_time
+from cmscommon.metrics import registry
 
 from .rpc import rpc_method, RemoteServiceServer, RemoteServiceClient
 
@@ -106,6 +108,15 @@ class Service(object):
         self.rpc_server = StreamServer(address, self._connection_handler)
         self.backdoor = None
 
+        # The metrics of this process, served over HTTP (if enabled)
+        # on the port of the RPC server plus metrics_port_offset.
+        self.metrics = registry
+        self.metrics_server = None
+        if config.metrics_port_offset is not None:
+            self.metrics_server = WSGIServer(
+                (address.ip, address.port + config.metrics_port_offset),
+                self.metrics, log=None)
+
     def initialize_logging(self):
         """Set up additional logging handlers.
 
@@ -306,6 +317,15 @@ class Service(object):
         if config.backdoor:
             self.start_backdoor()
 
+        if self.metrics_server is not None:
+            try:
+                self.metrics_server.start()
+            except socket.error:
+                logger.error("Couldn't serve the metrics of %s on port "
+                             "%s.", self.name,
+                             self.metrics_server.address[1], exc_info=True)
+                self.metrics_server = None
+
         logger.info("%s %d up and running!", *self._my_coord)
 
         # This call will block until self.rpc_server.stop() is called.
@@ -316,6 +336,9 @@ class Service(object):
         if config.backdoor:
             self.stop_backdoor()
 
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+
         self._disconnect_all()
         return True
 
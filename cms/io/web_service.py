@@ -47,15 +47,28 @@ class WebService(Service):
 
     """
     def __init__(self, listen_port, handlers, parameters, shard=0,
-                 listen_address=""):
+                 listen_address="", mounts=None):
+        """Create the web service.
+
+        listen_port (int): the port to listen on.
+        handlers ([tuple]): the Tornado handlers of the application.
+        parameters ({str: object}): the settings of the application.
+        shard (int): the shard of the service.
+        listen_address (string): the address to listen on.
+        mounts ({unicode: callable}|None): additional WSGI applications
+            to serve, indexed by the path prefix they're mounted on.
+
+        """
         super(WebService, self).__init__(shard)
 
         self.wsgi_app = tornado.wsgi.WSGIApplication(handlers, **parameters)
         self.wsgi_app.service = self
 
+        mounts = dict(mounts) if mounts is not None else dict()
         if parameters.get('rpc_enabled', False):
-            self.wsgi_app = DispatcherMiddleware(
-                self.wsgi_app, {"/rpc": RPCMiddleware(self)})
+            mounts["/rpc"] = RPCMiddleware(self)
+        if len(mounts) > 0:
+            self.wsgi_app = DispatcherMiddleware(self.wsgi_app, mounts)
 
         # If is_proxy_used is set to True we'll use the content of the
         # X-Forwarded-For HTTP header (if provided) to determine the
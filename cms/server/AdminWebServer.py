@@ -50,7 +50,7 @@ from cms import config, ServiceCoord, get_service_shards, get_service_address
 from cms.io import WebService
 from cms.db import Session, Contest, User, Announcement, Question, Message, \
     Submission, SubmissionResult, File, Task, Dataset, Attachment, Manager, \
-    Testcase, SubmissionFormatElement, Statement
+    Testcase, SubmissionFormatElement, Statement, UserTaskScore
 from cms.db.filecacher import FileCacher
 from cms.grading import compute_changes_for_dataset
 from cms.grading.tasktypes import get_task_type_class
@@ -246,6 +246,11 @@ class BaseHandler(CommonRequestHandler):
         that. So far I'm leaving it to minimize changes.
 
         """
+        # ContestWebServers cache the data of the contest: tell them
+        # that it may have changed.
+        if self.request.method == "POST" and self.contest is not None:
+            self.application.service.contest_updated(self.contest.id)
+        self.close_read_only_session()
         self.sql_session.close()
         try:
             tornado.web.RequestHandler.finish(self, *args, **kwds)
@@ -482,6 +487,10 @@ class AdminWebServer(WebService):
             self.resource_services.append(self.connect_to(
                 ServiceCoord("ResourceService", i)))
         self.logservice = self.connect_to(ServiceCoord("LogService", 0))
+        self.contest_web_servers = []
+        for i in xrange(get_service_shards("ContestWebServer")):
+            self.contest_web_servers.append(self.connect_to(
+                ServiceCoord("ContestWebServer", i)))
 
     def add_notification(self, timestamp, subject, text):
         """Store a new notification to send at the first
@@ -494,6 +503,31 @@ class AdminWebServer(WebService):
         """
         self.notifications.append((timestamp, subject, text))
 
+    def contest_updated(self, contest_id):
+        """Tell all ContestWebServers that a contest may have changed.
+
+        contest_id (int): the id of the contest.
+
+        """
+        for contest_web_server in self.contest_web_servers:
+            contest_web_server.invalidate_cache(contest_id=contest_id)
+
+    def notify_contestants(self, contest_id, notification_type,
+                           username=None):
+        """Tell all ContestWebServers to push a notification to users.
+
+        contest_id (int): the id of the contest.
+        notification_type (unicode): "announcement", "message" or
+            "question".
+        username (unicode|None): the recipient, or None if everybody.
+
+        """
+        for contest_web_server in self.contest_web_servers:
+            contest_web_server.new_notification(
+                contest_id=contest_id,
+                notification_type=notification_type,
+                username=username)
+
 
 class MainHandler(BaseHandler):
     """Home page handler, with queue and workers statuses.
@@ -1169,7 +1203,8 @@ class ActivateDatasetHandler(BaseHandler):
         task.active_dataset = dataset
 
         if try_commit(self.sql_session, self):
-            # self.application.service.scoring_service.reinitialize()
+            self.application.service.scoring_service.dataset_updated(
+                task_id=task.id)
             self.application.service.proxy_service.dataset_updated(
                 task_id=task.id)
 
@@ -1182,7 +1217,7 @@ class ActivateDatasetHandler(BaseHandler):
         datetime = make_datetime()
 
         r = re.compile('notify_([0-9]+)$')
-        count = 0
+        notified = []
         for k, v in self.request.arguments.iteritems():
             m = r.match(k)
             if not m:
@@ -1193,12 +1228,15 @@ class ActivateDatasetHandler(BaseHandler):
                               self.get_argument("message_text", ""),
                               user=user)
             self.sql_session.add(message)
-            count += 1
+            notified.append(user.username)
 
         if try_commit(self.sql_session, self):
             self.application.service.add_notification(
                 make_datetime(),
-                "Messages sent to %d users." % count, "")
+                "Messages sent to %d users." % len(notified), "")
+            for username in notified:
+                self.application.service.notify_contestants(
+                    task.contest_id, "message", username)
 
         self.redirect("/task/%s" % task.id)
 
@@ -1673,17 +1711,27 @@ class RankingHandler(BaseHandler):
         # This validates the contest id.
         self.safe_get_item(Contest, contest_id)
 
-        # This massive joined load gets all the information which we will need
-        # to generating the rankings.
-        self.contest = self.sql_session.query(Contest)\
+        # Possibly slightly stale data is fine here, so read it from
+        # the replica, if any.
+        session = self.get_read_only_session()
+        self.contest = session.query(Contest)\
             .filter(Contest.id == contest_id)\
             .options(joinedload('users'))\
-            .options(joinedload('users.submissions'))\
-            .options(joinedload('users.submissions.token'))\
-            .options(joinedload('users.submissions.results'))\
+            .options(joinedload('tasks'))\
             .first()
+        if self.contest is None:
+            # Not yet on the replica.
+            raise tornado.web.HTTPError(404)
+
+        # The scores are kept up to date by ScoringService: we just
+        # need to read them, without touching the submissions.
+        task_scores = dict(
+            ((uts.user_id, uts.task_id), (uts.score, uts.partial))
+            for uts in session.query(UserTaskScore)
+            .join(Task).filter(Task.contest_id == self.contest.id))
 
         self.r_params = self.render_params()
+        self.r_params["task_scores"] = task_scores
         if format == "txt":
             self.set_header("Content-Type", "text/plain")
             self.set_header("Content-Disposition",
@@ -1711,7 +1759,9 @@ class AddAnnouncementHandler(BaseHandler):
             ann = Announcement(make_datetime(), subject, text,
                                contest=self.contest)
             self.sql_session.add(ann)
-            try_commit(self.sql_session, self)
+            if try_commit(self.sql_session, self):
+                self.application.service.notify_contestants(
+                    self.contest.id, "announcement")
         self.redirect("/announcements/%s" % contest_id)
 
 
@@ -1919,6 +1969,8 @@ class QuestionReplyHandler(BaseHandler):
         if try_commit(self.sql_session, self):
             logger.info("Reply sent to user %s for question with id %s." %
                         (question.user.username, question_id))
+            self.application.service.notify_contestants(
+                self.contest.id, "question", question.user.username)
 
         self.redirect(ref)
 
@@ -1964,6 +2016,8 @@ class MessageHandler(BaseHandler):
         if try_commit(self.sql_session, self):
             logger.info("Message submitted to user %s."
                         % user.username)
+            self.application.service.notify_contestants(
+                self.contest.id, "message", user.username)
 
         self.redirect("/user/%s" % user_id)
 
@@ -60,14 +60,15 @@ from urllib import quote
 import tornado.web
 
 from sqlalchemy import func
+from sqlalchemy.orm import joinedload
 
 from werkzeug.http import parse_accept_header
 from werkzeug.datastructures import LanguageAccept
 
 from cms import SOURCE_EXT_TO_LANGUAGE_MAP, config, ServiceCoord
-from cms.io import WebService
-from cms.db import Session, Contest, User, Task, Question, Submission, Token, \
-    File, UserTest, UserTestFile, UserTestManager
+from cms.io import WebService, rpc_method
+from cms.db import Session, SessionGen, Contest, User, Task, Question, \
+    Submission, Token, File, UserTest, UserTestFile, UserTestManager
 from cms.db.filecacher import FileCacher
 from cms.grading.tasktypes import get_task_type
 from cms.grading.scoretypes import get_score_type
@@ -78,7 +79,9 @@ from cmscommon.isocodes import is_language_code, translate_language_code, \
     is_country_code, translate_country_code, \
     is_language_country_code, translate_language_country_code
 from cmscommon.crypto import encrypt_number
-from cmscommon.datetime import make_datetime, make_timestamp, get_timezone
+from cmscommon.eventsource import EventSource, Publisher
+from cmscommon.datetime import make_datetime, make_timestamp, get_timezone, \
+    monotonic_time
 from cmscommon.mimetypes import get_type_for_file_name
 
 
@@ -103,6 +106,193 @@ def check_ip(client, wanted):
     return (wanted & snmask) == (client & snmask)
 
 
+class ContestCache(object):
+    """Cache of the data of a contest that almost all requests need.
+
+    Loading the contest (with its tasks) and the user at each request
+    is a waste, as they seldom change: we keep a detached copy of them
+    for a few seconds and merge it in the sessions of the requests
+    without querying the database. The cache is invalidated when
+    AdminWebServer tells us that the contest changed, and when we
+    change the data ourselves; the expiration only bounds the
+    staleness when this doesn't happen (e.g., changes made by other
+    shards or by command line tools).
+
+    Only attributes loaded when the objects were cached are available
+    without queries: relationships other than the tasks of the contest
+    are loaded lazily, as usual, in the session of the request.
+
+    """
+    # Seconds after which the cached objects are loaded again.
+    TTL = 10.0
+
+    def __init__(self, contest_id):
+        """Create an empty cache.
+
+        contest_id (int): the id of the contest to cache.
+
+        """
+        self.contest_id = contest_id
+        # The detached contest, and when it expires.
+        self._contest = None
+        self._contest_expiry = 0.0
+        # The detached users, and when they expire, by username.
+        self._users = dict()
+        # The names of the languages in each locale, by locale code.
+        self._lang_names = dict()
+
+    def invalidate(self):
+        """Forget all cached contest and user data.
+
+        """
+        self._contest = None
+        self._users = dict()
+
+    def invalidate_user(self, username):
+        """Forget the cached data of a user.
+
+        username (unicode): the user to forget.
+
+        """
+        self._users.pop(username, None)
+
+    def _attach(self, obj, session):
+        """Return a copy of a cached object attached to session.
+
+        obj (Base): a detached object.
+        session (Session): the session to attach the copy to.
+
+        return (Base): the copy, as if loaded by session.
+
+        """
+        return session.merge(obj, load=False)
+
+    def get_contest(self, session):
+        """Return the contest, with its tasks loaded.
+
+        session (Session): the session to attach the contest to.
+
+        return (Contest|None): the contest.
+
+        """
+        if self._contest is not None and \
+                monotonic_time() < self._contest_expiry:
+            return self._attach(self._contest, session)
+
+        # We load the objects to cache in a separate session, to be
+        # sure they're not shared with the request.
+        with SessionGen() as cache_session:
+            contest = cache_session.query(Contest)\
+                .filter(Contest.id == self.contest_id)\
+                .options(joinedload(Contest.tasks))\
+                .first()
+            cache_session.expunge_all()
+        if contest is None:
+            return None
+        self._contest = contest
+        self._contest_expiry = monotonic_time() + self.TTL
+        return self._attach(contest, session)
+
+    def get_user(self, username, session):
+        """Return a user of the contest.
+
+        username (unicode): the username of the user.
+        session (Session): the session to attach the user to.
+
+        return (User|None): the user, or None if it doesn't exist.
+
+        """
+        if username in self._users:
+            user, expiry = self._users[username]
+            if monotonic_time() < expiry:
+                return self._attach(user, session)
+
+        with SessionGen() as cache_session:
+            user = cache_session.query(User)\
+                .filter(User.contest_id == self.contest_id)\
+                .filter(User.username == username)\
+                .first()
+            cache_session.expunge_all()
+        if user is None:
+            self._users.pop(username, None)
+            return None
+        self._users[username] = (user, monotonic_time() + self.TTL)
+        return self._attach(user, session)
+
+    def get_lang_names(self, langs, locale):
+        """Return the names of the languages, translated in locale.
+
+        Translations never change, so these are cached forever.
+
+        langs ([unicode]): the language codes.
+        locale (tornado.locale.Locale): the locale to use.
+
+        return ({unicode: unicode}): the name of each language.
+
+        """
+        key = (tuple(langs), locale.code)
+        if key not in self._lang_names:
+            # TODO Now all language names are shown in the active
+            # language. It would be better to show them in the
+            # corresponding one.
+            lang_names = {}
+            for lang in langs:
+                language_name = None
+                try:
+                    language_name = translate_language_country_code(
+                        lang.replace("-", "_"), locale)
+                except ValueError:
+                    language_name = translate_language_code(
+                        lang.replace("-", "_"), locale)
+                lang_names[lang] = language_name
+            self._lang_names[key] = lang_names
+        return self._lang_names[key]
+
+
+def get_user_from_cookie(cookie, contest_cache, remote_ip, timestamp,
+                         session):
+    """Return the user that a login cookie authenticates.
+
+    cookie (bytes): the content of the (already verified) secure
+        cookie, i.e., the pickled (username, password, timestamp).
+    contest_cache (ContestCache): the cache of the contest the user
+        has to belong to.
+    remote_ip (string): the IP address of the client.
+    timestamp (datetime): the time of the request.
+    session (Session): the session to use to load the user.
+
+    return (User|None): the user, or None if the cookie is malformed
+        or expired, or if it doesn't allow to log in anymore.
+
+    """
+    # Parse cookie.
+    try:
+        cookie = pickle.loads(cookie)
+        username = cookie[0]
+        password = cookie[1]
+        last_update = make_datetime(cookie[2])
+    except:
+        return None
+
+    # Check if the cookie is expired.
+    if timestamp - last_update > timedelta(seconds=config.cookie_duration):
+        return None
+
+    # Load the user.
+    user = contest_cache.get_user(username, session)
+
+    # Check if user exists and is allowed to login.
+    if user is None or user.password != password:
+        return None
+    if config.ip_lock and user.ip is not None \
+            and not check_ip(remote_ip, user.ip):
+        return None
+    if config.block_hidden_users and user.hidden:
+        return None
+
+    return user
+
+
 class BaseHandler(CommonRequestHandler):
     """Base RequestHandler for this application.
 
@@ -125,8 +315,8 @@ class BaseHandler(CommonRequestHandler):
         self.set_header("Cache-Control", "no-cache, must-revalidate")
 
         self.sql_session = Session()
-        self.contest = Contest.get_from_id(self.application.service.contest,
-                                           self.sql_session)
+        self.contest = self.application.service.contest_cache.get_contest(
+            self.sql_session)
 
         self._ = self.locale.translate
 
@@ -139,39 +329,14 @@ class BaseHandler(CommonRequestHandler):
         username specified in the cookie. Otherwise, return None.
 
         """
-        if self.get_secure_cookie("login") is None:
-            return None
-
-        # Parse cookie.
-        try:
-            cookie = pickle.loads(self.get_secure_cookie("login"))
-            username = cookie[0]
-            password = cookie[1]
-            last_update = make_datetime(cookie[2])
-        except:
-            self.clear_cookie("login")
+        cookie = self.get_secure_cookie("login")
+        if cookie is None:
             return None
 
-        # Check if the cookie is expired.
-        if self.timestamp - last_update > \
-                timedelta(seconds=config.cookie_duration):
-            self.clear_cookie("login")
-            return None
-
-        # Load the user from DB.
-        user = self.sql_session.query(User)\
-            .filter(User.contest == self.contest)\
-            .filter(User.username == username).first()
-
-        # Check if user exists and is allowed to login.
-        if user is None or user.password != password:
-            self.clear_cookie("login")
-            return None
-        if config.ip_lock and user.ip is not None \
-                and not check_ip(self.request.remote_ip, user.ip):
-            self.clear_cookie("login")
-            return None
-        if config.block_hidden_users and user.hidden:
+        user = get_user_from_cookie(
+            cookie, self.application.service.contest_cache,
+            self.request.remote_ip, self.timestamp, self.sql_session)
+        if user is None:
             self.clear_cookie("login")
             return None
 
@@ -184,6 +349,38 @@ class BaseHandler(CommonRequestHandler):
 
         return user
 
+    def get_read_only_session(self, max_lag=None):
+        """Return a session for the read-only queries of the request.
+
+        As BaseHandler.get_read_only_session, but the replica is used
+        only if it already has the last changes the user made (that
+        have been recorded by mark_write).
+
+        """
+        if max_lag is None:
+            max_lag = config.database_replica_max_lag
+        last_write = self.get_secure_cookie("last_write")
+        if last_write is not None:
+            try:
+                max_lag = min(max_lag,
+                              make_timestamp(self.timestamp) -
+                              float(last_write))
+            except ValueError:
+                pass
+        return super(BaseHandler, self).get_read_only_session(max_lag)
+
+    def mark_write(self):
+        """Record that the user changed their data in the database.
+
+        So that the pages showing it are read from the primary database
+        until the replica has the change too.
+
+        """
+        if config.database_replica is not None:
+            self.set_secure_cookie("last_write",
+                                   "%f" % make_timestamp(self.timestamp),
+                                   expires_days=None)
+
     def get_user_locale(self):
         self.langs = self.application.service.langs
 
@@ -329,18 +526,9 @@ class BaseHandler(CommonRequestHandler):
 
         ret["langs"] = self.langs
 
-        # TODO Now all language names are shown in the active language.
-        # It would be better to show them in the corresponding one.
-        ret["lang_names"] = {}
-        for lang in self.langs:
-            language_name = None
-            try:
-                language_name = translate_language_country_code(
-                    lang.replace("-", "_"), self.locale)
-            except ValueError:
-                language_name = translate_language_code(
-                    lang.replace("-", "_"), self.locale)
-            ret["lang_names"][lang] = language_name
+        ret["lang_names"] = \
+            self.application.service.contest_cache.get_lang_names(
+                self.langs, self.locale)
 
         ret["cookie_lang"] = self.cookie_lang
         ret["browser_lang"] = self.browser_lang
@@ -357,6 +545,10 @@ class BaseHandler(CommonRequestHandler):
         that. So far I'm leaving it to minimize changes.
 
         """
+        try:
+            self.close_read_only_session()
+        except Exception as error:
+            logger.warning("Couldn't close SQL connection: %r" % error)
         if hasattr(self, "sql_session"):
             try:
                 self.sql_session.close()
@@ -392,18 +584,98 @@ class BaseHandler(CommonRequestHandler):
 FileHandler = file_handler_gen(BaseHandler)
 
 
+class NotificationsEventSource(EventSource):
+    """Push to each contestant the events regarding him/her.
+
+    Two types of events are sent, over a stream which is private to
+    each user (authenticated with the login cookie):
+    - "notification", when there's something new to fetch from
+      NotificationsHandler (an announcement, a message or the reply
+      to a question); its data is the kind of notification;
+    - "submission", when the status of a submission changed; its data
+      is the name of the task.
+    This allows clients to make a request only when there is actually
+    something new, instead of polling the server periodically.
+
+    """
+    # Number of events kept for each user, to be resent to clients
+    # reconnecting after a short disconnection.
+    _USER_CACHE_SIZE = 20
+
+    def __init__(self, service):
+        """Create the event source.
+
+        service (ContestWebServer): the service we're part of.
+
+        """
+        super(NotificationsEventSource, self).__init__()
+        self.service = service
+
+        # The publishers of the users that connected at least once,
+        # indexed by username.
+        self._user_pubs = dict()
+
+    def get_publisher(self, request):
+        """Return the publisher of the user logged in the request.
+
+        See EventSource.get_publisher.
+
+        """
+        cookie = request.cookies.get("login")
+        if cookie is None:
+            return None
+        cookie = tornado.web.decode_signed_value(
+            self.service.cookie_secret, "login", cookie)
+        if cookie is None:
+            return None
+
+        with SessionGen() as session:
+            user = get_user_from_cookie(cookie, self.service.contest_cache,
+                                        request.remote_addr, make_datetime(),
+                                        session)
+            if user is None:
+                return None
+            username = user.username
+
+        if username not in self._user_pubs:
+            self._user_pubs[username] = Publisher(self._USER_CACHE_SIZE)
+        return self._user_pubs[username]
+
+    def send(self, event, data, username=None):
+        """Send the event to a user, or to all of them.
+
+        event (unicode): the type of the event.
+        data (unicode): the data of the event.
+        username (unicode|None): the user to send the event to, or
+            None to send it to everybody.
+
+        """
+        if username is None:
+            pubs = list(self._user_pubs.itervalues())
+        elif username in self._user_pubs:
+            pubs = [self._user_pubs[username]]
+        else:
+            # The user never connected: whatever he/she will load
+            # will already be up to date.
+            pubs = []
+        for pub in pubs:
+            pub.put(event, data)
+
+
 class ContestWebServer(WebService):
     """Service that runs the web server serving the contestants.
 
     """
     def __init__(self, shard, contest):
+        self.cookie_secret = base64.b64encode(config.secret_key)
+        self.notifications_source = NotificationsEventSource(self)
         parameters = {
             "login_url": "/",
             "template_path": pkg_resources.resource_filename(
                 "cms.server", "templates/contest"),
             "static_path": pkg_resources.resource_filename(
                 "cms.server", "static"),
-            "cookie_secret": base64.b64encode(config.secret_key),
+            "cookie_secret": self.cookie_secret,
             "debug": config.tornado_debug,
             "is_proxy_used": config.is_proxy_used,
         }
@@ -412,9 +684,11 @@ class ContestWebServer(WebService):
             _cws_handlers,
             parameters,
             shard=shard,
-            listen_address=config.contest_listen_address[shard])
+            listen_address=config.contest_listen_address[shard],
+            mounts={"/events": self.notifications_source})
 
         self.contest = contest
+        self.contest_cache = ContestCache(contest)
 
         # This is a dictionary (indexed by username) of pending
         # notification. Things like "Yay, your submission went
@@ -462,6 +736,52 @@ class ContestWebServer(WebService):
             self.notifications[username] = []
         self.notifications[username].append((timestamp, subject, text, level))
 
+    @rpc_method
+    def invalidate_cache(self, contest_id):
+        """Forget the cached data of a contest, as it changed.
+
+        contest_id (int): the id of the contest that changed; other
+            contests are ignored.
+
+        """
+        if contest_id == self.contest:
+            self.contest_cache.invalidate()
+
+    @rpc_method
+    def new_notification(self, contest_id, notification_type, username=None):
+        """Tell the clients that there is a new notification for them.
+
+        Called by AdminWebServer when an announcement is published or
+        when a message or a reply to a question is sent.
+
+        contest_id (int): the id of the contest of the notification;
+            other contests' notifications are ignored.
+        notification_type (unicode): "announcement", "message" or
+            "question".
+        username (unicode|None): the recipient, or None if everybody.
+
+        """
+        if contest_id == self.contest:
+            self.notifications_source.send(
+                "notification", notification_type, username)
+
+    @rpc_method
+    def submission_updated(self, contest_id, username, task_name):
+        """Tell a user that the status of a submission changed.
+
+        Called by EvaluationService when a submission is compiled and
+        by ScoringService when it is scored.
+
+        contest_id (int): the id of the contest of the submission;
+            other contests' submissions are ignored.
+        username (unicode): the owner of the submission.
+        task_name (unicode): the name of the task of the submission.
+
+        """
+        if contest_id == self.contest:
+            self.notifications_source.send(
+                "submission", task_name, username)
+
 
 class MainHandler(BaseHandler):
     """Home page handler.
@@ -537,6 +857,8 @@ class StartHandler(BaseHandler):
         logger.info("Starting now for user %s" % user.username)
         user.starting_time = self.timestamp
         self.sql_session.commit()
+        self.application.service.contest_cache.invalidate_user(
+            user.username)
 
         self.redirect("/")
 
@@ -563,7 +885,7 @@ class TaskDescriptionHandler(BaseHandler):
             raise tornado.web.HTTPError(404)
 
         # FIXME are submissions actually needed by this handler?
-        submissions = self.sql_session.query(Submission)\
+        submissions = self.get_read_only_session().query(Submission)\
             .filter(Submission.user == self.current_user)\
             .filter(Submission.task == task).all()
 
@@ -597,7 +919,7 @@ class TaskSubmissionsHandler(BaseHandler):
         except KeyError:
             raise tornado.web.HTTPError(404)
 
-        submissions = self.sql_session.query(Submission)\
+        submissions = self.get_read_only_session().query(Submission)\
             .filter(Submission.user == self.current_user)\
             .filter(Submission.task == task).all()
 
@@ -1117,8 +1439,11 @@ class SubmitHandler(BaseHandler):
             self.sql_session.add(File(filename, digest, submission=submission))
         self.sql_session.add(submission)
         self.sql_session.commit()
+        self.mark_write()
         self.application.service.evaluation_service.new_submission(
             submission_id=submission.id)
+        self.application.service.scoring_service.new_submission(
+            submission_id=submission.id)
         self.application.service.add_notification(
             self.current_user.username,
             self.timestamp,
@@ -1180,6 +1505,7 @@ class UseTokenHandler(BaseHandler):
             token = Token(self.timestamp, submission=submission)
             self.sql_session.add(token)
             self.sql_session.commit()
+            self.mark_write()
         else:
             self.application.service.add_notification(
                 self.current_user.username,
@@ -1193,6 +1519,8 @@ class UseTokenHandler(BaseHandler):
 
         # Inform ScoringService and eventually the ranking that the
         # token has been played.
+        self.application.service.scoring_service.submission_tokened(
+            submission_id=submission.id)
         self.application.service.proxy_service.submission_tokened(
             submission_id=submission.id)
 
@@ -41,6 +41,7 @@ import tornado.locale
 
 import gevent
 
+from cms.db import get_read_only_session
 from cms.db.filecacher import FileCacher
 from cmscommon.datetime import make_datetime, utc
 
@@ -695,3 +696,31 @@ class CommonRequestHandler(RequestHandler):
         self.set_status(302)
         self.set_header("Location", url)
         self.finish()
+
+    def get_read_only_session(self, max_lag=None):
+        """Return a session for the read-only queries of the request.
+
+        It's on the replica of the database if there is one and it's
+        fresh enough (see cms.db.get_read_only_session), otherwise it's
+        the session of the request (sql_session). Subclasses have to
+        call close_read_only_session when the request ends.
+
+        max_lag (float|None): the maximum acceptable lag, in seconds.
+
+        return (Session): the session.
+
+        """
+        if getattr(self, "read_only_sql_session", None) is None:
+            self.read_only_sql_session = \
+                get_read_only_session(max_lag) or self.sql_session
+        return self.read_only_sql_session
+
+    def close_read_only_session(self):
+        """Close the session given by get_read_only_session, if any.
+
+        """
+        session = getattr(self, "read_only_sql_session", None)
+        if session is not None and \
+                session is not getattr(self, "sql_session", None):
+            session.close()
+        self.read_only_sql_session = None
@@ -37,6 +37,62 @@ CMS.CWSUtils = function(url_root, timestamp, timezoned_timestamp,
     this.phase = phase;
     this.remaining_div = null;
     this.unread_count = 0;
+    this.event_source = null;
+};
+
+
+/**
+ * Keep notifications (and the status of submissions) up to date.
+ *
+ * The server pushes an event whenever there is something new for the
+ * user, so we fetch the notifications only when needed. Browsers that
+ * don't support Server-Sent Events fall back to periodic polling. In
+ * case the events get delayed or lost on the way (e.g., by a buffering
+ * proxy), we also poll, rarely, when no event arrived for a while.
+ * Changes in submissions are dispatched on the document as
+ * "submission_updated" events, whose argument is the name of the task
+ * (or null if any task may be affected, e.g., after a reconnection).
+ */
+CMS.CWSUtils.prototype.listen_notifications = function() {
+    var self = this;
+    this.update_notifications();
+
+    if (!window.EventSource) {
+        setInterval(function() { self.update_notifications(); }, 15000);
+        return;
+    }
+
+    var last_event = $.now();
+    var missed_events = function() {
+        last_event = $.now();
+        self.update_notifications();
+        $(document).trigger("submission_updated", [null]);
+    };
+
+    setInterval(function() {
+        if ($.now() - last_event >= 30000) {
+            missed_events();
+        }
+    }, 30000);
+
+    this.event_source = new EventSource(this.url_root + "/events");
+    this.event_source.addEventListener("open", missed_events, false);
+    this.event_source.addEventListener("reinit", missed_events, false);
+    this.event_source.addEventListener("notification", function(event) {
+        last_event = $.now();
+        if (event.data == "announcement") {
+            // Announcements reach all users at once: spread their
+            // requests over some seconds.
+            setTimeout(function() { self.update_notifications(); },
+                       Math.random() * 5000);
+        } else {
+            self.update_notifications();
+        }
+    }, false);
+    this.event_source.addEventListener("submission", function(event) {
+        last_event = $.now();
+        $(document).trigger("submission_updated", [event.data]);
+    }, false);
 };
 
 
@@ -35,6 +35,7 @@ from __future__ import unicode_literals
 
 import logging
 import random
+from bisect import bisect_left
 from datetime import timedelta
 from collections import namedtuple
 from functools import wraps
@@ -47,6 +48,7 @@ from cms.db import SessionGen, Contest, Dataset, Submission, \
     SubmissionResult, UserTest, UserTestResult
 from cms.service import get_submission_results, get_datasets_to_judge
 from cmscommon.datetime import make_datetime, make_timestamp
+from cms.grading.CompilationCache import CompilationCache
 from cms.grading.Job import JobGroup
 
 
@@ -662,6 +664,60 @@ def with_post_finish_lock(func):
     return wrapped
 
 
+class PhaseTimings(object):
+    """Aggregate the per-phase timings of the jobs in histograms.
+
+    For each job type and phase (see Job.timings) keep how many jobs
+    went through the phase, the total time they spent in it, and how
+    many of them fell into each bucket.
+
+    """
+    # The upper bounds (in seconds) of the buckets; a last bucket
+    # collects the longer ones.
+    BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 50, 100]
+
+    def __init__(self):
+        # Dictionary (job_type, phase) -> histogram.
+        self._histograms = dict()
+
+    def add(self, job_type, timings):
+        """Record the timings of a job.
+
+        job_type (unicode): the type of the job (one of the constants
+            of EvaluationService).
+        timings ({unicode: float}|None): the timings of the job.
+
+        """
+        if timings is None:
+            return
+        for phase, elapsed in timings.iteritems():
+            histogram = self._histograms.setdefault(
+                (job_type, phase),
+                {"count": 0, "sum": 0.0,
+                 "buckets": [0] * (len(self.BUCKETS) + 1)})
+            histogram["count"] += 1
+            histogram["sum"] += elapsed
+            histogram["buckets"][bisect_left(self.BUCKETS, elapsed)] += 1
+
+    def get_status(self):
+        """Return the histograms.
+
+        return ([dict]): for each job type and phase, the number of
+            jobs, the total time, the upper bounds of the buckets
+            (None for the last one) and the number of jobs in each
+            bucket.
+
+        """
+        return [{"job_type": job_type,
+                 "phase": phase,
+                 "count": histogram["count"],
+                 "sum": histogram["sum"],
+                 "bounds": self.BUCKETS + [None],
+                 "buckets": histogram["buckets"]}
+                for (job_type, phase), histogram
+                in sorted(self._histograms.iteritems())]
+
+
 class EvaluationService(Service):
     """Evaluation service.
 
@@ -707,9 +763,21 @@ class EvaluationService(Service):
 
         self.queue = JobQueue()
         self.pool = WorkerPool(self)
+        self.metrics.gauge(
+            "cms_evaluation_queue_length",
+            "Jobs waiting in the queue of EvaluationService.").set_function(
+            self.queue.length)
+        self.compilation_cache = CompilationCache()
+        self.phase_timings = PhaseTimings()
+        # The last job whose outcome wasn't in the compilation cache.
+        self.last_cache_miss = None
         self.post_finish_lock = gevent.coros.RLock()
         self.scoring_service = self.connect_to(
             ServiceCoord("ScoringService", 0))
+        self.contest_web_servers = []
+        for i in xrange(get_service_shards("ContestWebServer")):
+            self.contest_web_servers.append(self.connect_to(
+                ServiceCoord("ContestWebServer", i)))
 
         for i in xrange(get_service_shards("Worker")):
             worker = ServiceCoord("Worker", i)
@@ -834,13 +902,94 @@ class EvaluationService(Service):
         except LookupError:
             return False
 
+        job_group = self.get_cached_compilation(job)
+        if job_group is not None:
+            with self.post_finish_lock:
+                # The lookup yielded to other greenlets: the job may
+                # not be on top of the queue any longer, or even not be
+                # in it at all.
+                if job in self.queue:
+                    self.queue.remove(job)
+                    self.store_results(job[0], job[1], job[2], job_group)
+            return True
+        elif self.queue.empty() or self.queue.top()[2] != job:
+            # Same as above: try again with the new top of the queue.
+            return not self.queue.empty()
+
         res = self.pool.acquire_worker(job, side_data=(priority, timestamp))
         if res is not None:
-            self.queue.pop()
+            self.queue.remove(job)
             return True
         else:
             return False
 
+    def get_cached_compilation(self, job):
+        """Look for the outcome of a compilation job in the cache.
+
+        The outcome of a job that has just been looked for is not
+        looked for again, as the job is probably still waiting for a
+        worker.
+
+        job (JobQueueEntry): the job to look for.
+
+        return (JobGroup|None): the job group of the job, filled with
+            the cached outcome, or None if the job isn't a compilation
+            or its outcome is not in the cache.
+
+        """
+        job_type, object_id, dataset_id = job
+        if job_type not in (EvaluationService.JOB_TYPE_COMPILATION,
+                            EvaluationService.JOB_TYPE_TEST_COMPILATION):
+            return None
+        if job == self.last_cache_miss:
+            return None
+
+        with SessionGen() as session:
+            dataset = Dataset.get_from_id(dataset_id, session)
+            if job_type == EvaluationService.JOB_TYPE_COMPILATION:
+                submission = Submission.get_from_id(object_id, session)
+                if submission is None or dataset is None:
+                    return None
+                job_group = \
+                    JobGroup.from_submission_compilation(submission, dataset)
+            else:
+                user_test = UserTest.get_from_id(object_id, session)
+                if user_test is None or dataset is None:
+                    return None
+                job_group = \
+                    JobGroup.from_user_test_compilation(user_test, dataset)
+
+        if not self.compilation_cache.get(job_group.jobs[""]):
+            self.last_cache_miss = job
+            return None
+
+        job_group.success = True
+        logger.info("Outcome of %s (dataset %d) taken from the "
+                    "compilation cache." % (job_group.jobs[""].info,
+                                            dataset_id))
+        return job_group
+
+    @rpc_method
+    def compilation_cache_status(self):
+        """Returns the statistics of the compilation cache (see
+        CompilationCache.get_status).
+
+        returns (dict): the number of hits and misses, the hit rate
+            and the number of stored outcomes.
+
+        """
+        return self.compilation_cache.get_status()
+
+    @rpc_method
+    def phase_timings_status(self):
+        """Returns the histograms of the time the jobs spent in each
+        phase (see PhaseTimings.get_status).
+
+        returns ([dict]): the histograms, by job type and phase.
+
+        """
+        return self.phase_timings.get_status()
+
     @rpc_method
     def submissions_status(self):
         """Returns a dictionary of statistics about the number of
@@ -1056,16 +1205,36 @@ class EvaluationService(Service):
                 job_success = False
 
             else:
+                for job in job_group.jobs.itervalues():
+                    self.phase_timings.add(job_type, job.timings)
                 if not job_group.success:
                     logger.error("Worker %s signaled action "
                                  "not successful." % shard)
                     job_success = False
 
-        _, timestamp = side_data
-
         logger.info("Action %s for submission %s completed. Success: %s." %
                     (job_type, object_id, job_success))
 
+        if job_success and job_type in (
+                EvaluationService.JOB_TYPE_COMPILATION,
+                EvaluationService.JOB_TYPE_TEST_COMPILATION):
+            self.compilation_cache.put(job_group.jobs[""])
+
+        self.store_results(job_type, object_id, dataset_id,
+                           job_group if job_success else None)
+
+    def store_results(self, job_type, object_id, dataset_id, job_group):
+        """Write the outcome of a job to the database.
+
+        job_type (unicode): the type of the job.
+        object_id (int): the id of the submission or user test.
+        dataset_id (int): the id of the dataset.
+        job_group (JobGroup|None): the completed job group, or None if
+            the job wasn't successful.
+
+        """
+        job_success = job_group is not None
+
         # We get the submission from DB and update it.
         with SessionGen() as session:
             if job_type == EvaluationService.JOB_TYPE_COMPILATION:
@@ -1149,7 +1318,8 @@ class EvaluationService(Service):
 
         """
         submission = submission_result.submission
-        # Compilation was ok, so we evaluate.
+        # Compilation was ok, so we evaluate, and we tell the user (a
+        # failed compilation is told by ScoringService, once scored).
         if submission_result.compilation_succeeded():
             self.push_in_queue(
                 JobQueueEntry(
@@ -1158,6 +1328,15 @@ class EvaluationService(Service):
                     submission_result.dataset_id),
                 EvaluationService.JOB_PRIORITY_MEDIUM,
                 submission.timestamp)
+            if submission_result.dataset_id == \
+                    submission.task.active_dataset_id:
+                # Commit first, so the user sees the new status.
+                submission_result.sa_session.commit()
+                for contest_web_server in self.contest_web_servers:
+                    contest_web_server.submission_updated(
+                        contest_id=submission.task.contest_id,
+                        username=submission.user.username,
+                        task_name=submission.task.name)
         # If instead submission failed compilation, we don't evaluate,
         # but we inform ScoringService of the new submission. We need
         # to commit before so it has up to date information.
@@ -29,9 +29,15 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import gzip
+import hashlib
+import io
 import json
 import logging
+import os
+import random
 import string
+from itertools import islice
 
 import gevent
 import gevent.queue
@@ -44,7 +50,7 @@ from cms import config
 from cms.io import Service, rpc_method
 from cms.db import SessionGen, Contest, Task, Submission
 from cms.grading.scoretypes import get_score_type
-from cmscommon.datetime import make_timestamp
+from cmscommon.datetime import make_timestamp, monotonic_time
 
 
 logger = logging.getLogger(__name__)
@@ -70,7 +76,31 @@ def encode_id(entity_id):
     return encoded_id
 
 
-def safe_put_data(ranking, resource, data, operation):
+# Request bodies smaller than this (in bytes) aren't worth compressing.
+GZIP_THRESHOLD = 1024
+
+
+def encode_data(data):
+    """JSON-encode some data, compressing it if it's large enough.
+
+    data (dict): the data to encode.
+
+    return ((bytes, dict)): the body of the request and the headers to
+        send along with it.
+
+    """
+    body = json.dumps(data, encoding="utf-8")
+    headers = {'content-type': 'application/json'}
+    if len(body) >= GZIP_THRESHOLD:
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode="wb") as gzip_file:
+            gzip_file.write(body)
+        body = buf.getvalue()
+        headers['content-encoding'] = 'gzip'
+    return body, headers
+
+
+def safe_put_data(ranking, resource, data, operation, session=None):
     """Send some data to ranking using a PUT request.
 
     ranking (bytes): the URL of ranking server.
@@ -78,19 +108,27 @@ def safe_put_data(ranking, resource, data, operation):
     data (dict): the data to JSON-encode and send.
     operation (unicode): a human-readable description of the operation
         we're performing (to produce log messages).
+    session (requests.Session|None): the session to send the request
+        with (to reuse its connections), or None to use a new one.
+
+    return ((int, dict)): the number of bytes of the body of the
+        request and the headers of the response.
 
     raise (CannotSendError): in case of communication errors.
 
     """
+    if session is None:
+        session = requests.Session()
+    body, headers = encode_data(data)
     try:
         url = urljoin(ranking, resource)
         # XXX With requests-1.2 auth is automatically extracted from
         # the URL: there is no need for this.
         auth = urlsplit(url)
-        res = requests.put(url, json.dumps(data, encoding="utf-8"),
-                           auth=(auth.username, auth.password),
-                           headers={'content-type': 'application/json'},
-                           verify=config.https_certfile)
+        res = session.put(url, body,
+                          auth=(auth.username, auth.password),
+                          headers=headers,
+                          verify=config.https_certfile)
     except requests.exceptions.RequestException as error:
         msg = "%s while %s: %s." % (type(error).__name__, operation, error)
         logger.warning(msg)
@@ -99,6 +137,43 @@ def safe_put_data(ranking, resource, data, operation):
         msg = "Status %s while %s." % (res.status_code, operation)
         logger.warning(msg)
         raise CannotSendError(msg)
+    return len(body), res.headers
+
+
+def safe_get_epoch(ranking, session=None):
+    """Ask a ranking for the epoch of its stores.
+
+    ranking (bytes): the URL of ranking server.
+    session (requests.Session|None): the session to send the request
+        with (to reuse its connections), or None to use a new one.
+
+    return (unicode|None): the epoch (see the Store-Epoch header of
+        RWS), or None if the ranking doesn't tell it.
+
+    raise (CannotSendError): in case of communication errors.
+
+    """
+    if session is None:
+        session = requests.Session()
+    operation = "asking ranking %s for its epoch" % ranking
+    try:
+        url = urljoin(ranking, b"contests/")
+        # XXX With requests-1.2 auth is automatically extracted from
+        # the URL: there is no need for this.
+        auth = urlsplit(url)
+        res = session.get(url,
+                          auth=(auth.username, auth.password),
+                          headers={'accept': 'application/json'},
+                          verify=config.https_certfile)
+    except requests.exceptions.RequestException as error:
+        msg = "%s while %s: %s." % (type(error).__name__, operation, error)
+        logger.warning(msg)
+        raise CannotSendError(msg)
+    if 400 <= res.status_code < 600:
+        msg = "Status %s while %s." % (res.status_code, operation)
+        logger.warning(msg)
+        raise CannotSendError(msg)
+    return res.headers.get('store-epoch')
 
 
 class RankingProxy(object):
@@ -110,8 +185,27 @@ class RankingProxy(object):
 
     It maintains a queue of data to send. At each "round" the queue is
     emptied (i.e. all jobs are fetched) and the data is then "combined"
-    to minimize the number of actual HTTP requests: they'll be at most
-    one per entity type.
+    to minimize the number of actual HTTP requests: they'll be one per
+    entity type, unless there are more than CHUNK_SIZE entities of the
+    same type, in which case they are split in several requests. All
+    requests go through the same keep-alive HTTP session.
+
+    The proxy remembers (a digest of) the data that the ranking
+    acknowledged and doesn't send it again. This knowledge is saved
+    on disk every SAVE_INTERVAL seconds, so that restarting
+    ProxyService only causes the differences to be sent.
+
+    The ranking acknowledges the data before writing it to disk, and
+    it may have been restarted, or had its data dropped, in the
+    meantime. So what it acknowledged is trusted only while the epoch
+    it reports (which changes at every start of RWS) stays the same:
+    the proxy checks it when it starts, after each request and, when
+    idle, every EPOCH_CHECK_INTERVAL seconds. When the epoch changes,
+    the proxy forgets what was acknowledged and, through the given
+    callback, has all the data sent again. If the ranking doesn't
+    report an epoch (e.g., it's an older RWS, or a proxy drops the
+    header) the acknowledged data can never be trusted: the proxy
+    doesn't remember it and just sends all the data it gets.
 
     Each entity type is identified by a integral class-level constant.
 
@@ -139,20 +233,216 @@ class RankingProxy(object):
     # How many different entity types we know about.
     TYPE_COUNT = len(RESOURCE_PATHS)
 
+    # How many entities we send at most in a single request.
+    CHUNK_SIZE = 1000
+
     # How long we wait after having failed to push data to a ranking
-    # before trying again.
-    FAILURE_WAIT = 60.0
+    # before trying again: the wait starts at MIN_FAILURE_WAIT and
+    # doubles at each consecutive failure, up to MAX_FAILURE_WAIT. The
+    # actual wait is randomized to avoid synchronized retries.
+    MIN_FAILURE_WAIT = 1.0
+    MAX_FAILURE_WAIT = 60.0
+
+    # How often (at most) we save on disk what the ranking
+    # acknowledged.
+    SAVE_INTERVAL = 10.0
+
+    # How often (at most) we check the epoch of the ranking when we
+    # have nothing to send.
+    EPOCH_CHECK_INTERVAL = 60.0
 
-    def __init__(self, ranking):
+    def __init__(self, ranking, state_path=None, data_lost_callback=None):
         """Create a proxy for the ranking at the given URL.
 
         ranking (bytes): a complete URL (containing protocol, username,
             password, hostname, port and prefix) where a ranking is
             supposed to listen.
+        state_path (unicode|None): the file where to persist what the
+            ranking acknowledged, or None not to persist it.
+        data_lost_callback (function|None): called without arguments
+            when the ranking may have lost data it acknowledged, to
+            put all the data in the queue again.
 
         """
         self.ranking = ranking
         self.data_queue = gevent.queue.Queue()
+        self.data_lost_callback = data_lost_callback
+
+        # For each entity type, a dictionary mapping the keys of the
+        # entities to the digests of the data acknowledged for them,
+        # and the epoch of the ranking they were acknowledged in.
+        self.state_path = state_path
+        self.acked = list(dict() for i in xrange(self.TYPE_COUNT))
+        self.epoch = None
+        self.epoch_check_time = monotonic_time()
+        self.acked_changed = False
+        self.acked_save_time = monotonic_time()
+        self._load_acked()
+        self.session = requests.Session()
+        self.failure_wait = self.MIN_FAILURE_WAIT
+
+        # Some statistics about the pushes.
+        self.bytes_sent = 0
+        self.requests_sent = 0
+        self.failures = 0
+        self.push_time = 0.0
+        self.last_push_time = None
+
+    @staticmethod
+    def _digest(value):
+        """Return a digest of some JSON-encodable data.
+
+        value (object): the data.
+
+        return (unicode): the digest.
+
+        """
+        return hashlib.sha1(json.dumps(value, sort_keys=True,
+                                       encoding="utf-8")).hexdigest()
+
+    def _load_acked(self):
+        """Load from disk what the ranking acknowledged.
+
+        """
+        if self.state_path is None or not os.path.exists(self.state_path):
+            return
+        try:
+            with io.open(self.state_path, "rb") as state_file:
+                state = json.load(state_file)
+            for i in xrange(self.TYPE_COUNT):
+                self.acked[i] = state.get(self.RESOURCE_PATHS[i], dict())
+            self.epoch = state.get("epoch")
+            if self.epoch is None:
+                # Not acknowledged in a known epoch, hence unusable.
+                self.acked = list(dict() for i in xrange(self.TYPE_COUNT))
+        except (IOError, OSError, ValueError):
+            logger.warning("Couldn't load the state of ranking %s from %s, "
+                           "all data will be sent again.", self.ranking,
+                           self.state_path, exc_info=True)
+            self.acked = list(dict() for i in xrange(self.TYPE_COUNT))
+            self.epoch = None
+
+    def _save_acked(self):
+        """Save on disk what the ranking acknowledged, if it changed.
+
+        """
+        self.acked_save_time = monotonic_time()
+        if self.state_path is None or not self.acked_changed:
+            return
+        state = dict((self.RESOURCE_PATHS[i].decode('utf-8'), self.acked[i])
+                     for i in xrange(self.TYPE_COUNT))
+        state["epoch"] = self.epoch
+        temp_path = self.state_path + ".tmp"
+        try:
+            with io.open(temp_path, "wb") as state_file:
+                json.dump(state, state_file)
+            os.rename(temp_path, self.state_path)
+        except (IOError, OSError):
+            logger.warning("Couldn't save the state of ranking %s to %s.",
+                           self.ranking, self.state_path, exc_info=True)
+        else:
+            self.acked_changed = False
+
+    def forget_acked(self):
+        """Forget what the ranking acknowledged.
+
+        To be used when the ranking may have lost its data: everything
+        will be sent again.
+
+        """
+        self.acked = list(dict() for i in xrange(self.TYPE_COUNT))
+        self.acked_changed = True
+
+    def _update_epoch(self, epoch, starting=False):
+        """Take note of the epoch reported by the ranking.
+
+        If it isn't the one of the acknowledged data, forget the data.
+        If it's a different known epoch the ranking may have lost its
+        data so, unless we are just starting (in which case all data is
+        about to be put in the queue anyway), have it sent again. An
+        unknown epoch (None) tells nothing about that.
+
+        epoch (unicode|None): the epoch reported by the ranking, or
+            None if it didn't report one.
+        starting (bool): whether the proxy is just starting.
+
+        """
+        self.epoch_check_time = monotonic_time()
+        if epoch is None and (starting or self.epoch is not None):
+            logger.warning("Ranking %s doesn't report its epoch, what it "
+                           "acknowledged won't be remembered.", self.ranking)
+        if epoch == self.epoch:
+            return
+        old_epoch = self.epoch
+        self.epoch = epoch
+        self.forget_acked()
+        if old_epoch is not None and epoch is not None:
+            logger.info("Ranking %s may have lost its data, all data will "
+                        "be sent again.", self.ranking)
+            if not starting and self.data_lost_callback is not None:
+                self.data_lost_callback()
+
+    def _check_epoch(self, starting=False):
+        """Ask the ranking for its epoch and take note of it.
+
+        starting (bool): whether the proxy is just starting.
+
+        raise (CannotSendError): in case of communication errors.
+
+        """
+        self._update_epoch(safe_get_epoch(self.ranking, self.session),
+                           starting)
+
+    def get_statistics(self):
+        """Return the statistics about the pushes to this ranking.
+
+        return (dict): number of bytes and requests sent, number of
+            failed requests, and total and last latency of the
+            successful requests (in seconds).
+
+        """
+        return {"bytes_sent": self.bytes_sent,
+                "requests_sent": self.requests_sent,
+                "failures": self.failures,
+                "push_time": self.push_time,
+                "last_push_time": self.last_push_time}
+
+    def _send(self, resource, data, operation):
+        """Send data to the ranking, keeping track of statistics.
+
+        resource (bytes): the relative path of the entity.
+        data (dict): the data to JSON-encode and send.
+        operation (unicode): a human-readable description of the
+            operation we're performing (to produce log messages).
+
+        raise (CannotSendError): in case of communication errors.
+
+        """
+        start = monotonic_time()
+        try:
+            size, headers = safe_put_data(self.ranking, resource, data,
+                                          operation, session=self.session)
+        except CannotSendError:
+            self.failures += 1
+            raise
+        elapsed = monotonic_time() - start
+        self._update_epoch(headers.get('store-epoch'))
+
+        self.bytes_sent += size
+        self.requests_sent += 1
+        self.push_time += elapsed
+        self.last_push_time = elapsed
+        logger.debug("Sent %d bytes to ranking %s in %.3f seconds.",
+                     size, self.ranking, elapsed)
+
+    def _wait_after_failure(self):
+        """Sleep after a failure, increasing the next wait time.
+
+        """
+        gevent.sleep(random.uniform(self.failure_wait / 2,
+                                    self.failure_wait))
+        self.failure_wait = min(self.failure_wait * 2,
+                                self.MAX_FAILURE_WAIT)
 
     def run(self):
         """Consume (i.e. send) the data put in the queue, forever.
@@ -161,8 +451,8 @@ class RankingProxy(object):
         block waiting until there are), combine them and send HTTP
         requests to the target ranking. Do it until something very bad
         happens (i.e. some exception is raised). If communication fails
-        don't stop, just wait FAILURE_WAIT seconds before restarting
-        the loop.
+        don't stop, just wait some time (exponentially increasing with
+        the number of consecutive failures) before restarting the loop.
 
         Do all this cooperatively: yield at every blocking operation
         (queue fetch, request send, failure wait, etc.). Since the
@@ -173,11 +463,34 @@ class RankingProxy(object):
         # built by combining items in the queue.
         data = list(dict() for i in xrange(self.TYPE_COUNT))
 
+        # Don't trust what was acknowledged in a previous run before
+        # knowing that the ranking is the same instance.
+        while True:
+            try:
+                self._check_epoch(starting=True)
+            except CannotSendError:
+                self._wait_after_failure()
+            else:
+                self.failure_wait = self.MIN_FAILURE_WAIT
+                break
+
         while True:
             # If we don't have anything left to do, block until we get
-            # something new.
+            # something new (saving our state and checking that the
+            # ranking didn't lose its data, if we're idle).
             if sum(len(data[i]) for i in xrange(self.TYPE_COUNT)) == 0:
-                self.data_queue.peek()
+                try:
+                    self.data_queue.peek(timeout=self.SAVE_INTERVAL)
+                except gevent.queue.Empty:
+                    self._save_acked()
+                    if monotonic_time() - self.epoch_check_time >= \
+                            self.EPOCH_CHECK_INTERVAL:
+                        try:
+                            self._check_epoch()
+                        except CannotSendError:
+                            # A log message has already been produced.
+                            self.epoch_check_time = monotonic_time()
+                    continue
 
             try:
                 while True:
@@ -191,6 +504,13 @@ class RankingProxy(object):
 
             try:
                 for i in xrange(self.TYPE_COUNT):
+                    # Drop the entities that the ranking already has.
+                    digests = dict()
+                    for key, value in data[i].items():
+                        digests[key] = self._digest(value)
+                        if self.acked[i].get(key) == digests[key]:
+                            del data[i][key]
+
                     # Send entities of type i.
                     if len(data[i]) > 0:
                         # XXX We abuse the resource path as the english
@@ -200,17 +520,35 @@ class RankingProxy(object):
                             "sending %s to ranking %s" % (name, self.ranking)
 
                         logger.debug(operation.capitalize())
-                        safe_put_data(
-                            self.ranking, b"%s/" % name, data[i], operation)
-                        data[i].clear()
+                        while len(data[i]) > 0:
+                            keys = list(islice(data[i].iterkeys(),
+                                               self.CHUNK_SIZE))
+                            self._send(b"%s/" % name,
+                                       dict((k, data[i][k]) for k in keys),
+                                       operation)
+                            # Forget what was sent, so that a failure
+                            # will only cause the rest to be resent.
+                            for k in keys:
+                                del data[i][k]
+                            # Remember it was acknowledged, if we can
+                            # know whether the ranking keeps it.
+                            if self.epoch is not None:
+                                for k in keys:
+                                    self.acked[i][k] = digests[k]
+                                self.acked_changed = True
+
+                self.failure_wait = self.MIN_FAILURE_WAIT
+                if monotonic_time() - self.acked_save_time >= \
+                        self.SAVE_INTERVAL:
+                    self._save_acked()
 
             except CannotSendError:
                 # A log message has already been produced.
-                gevent.sleep(self.FAILURE_WAIT)
+                self._wait_after_failure()
             except:
                 # Whoa! That's unexpected!
                 logger.error("Unexpected error.", exc_info=True)
-                gevent.sleep(self.FAILURE_WAIT)
+                self._wait_after_failure()
 
 
 class ProxyService(Service):
@@ -230,6 +568,11 @@ class ProxyService(Service):
     send_token that construct the data to send to rankings and put it
     in the queues of all proxies.
 
+    The proxies persist (in the data directory) what each ranking
+    acknowledged, hence after a restart the data that didn't change is
+    not sent again, as long as the ranking wasn't restarted too (see
+    RankingProxy). When a ranking restarts, all data is sent again.
+
     """
 
     # How often we look for submission not scored/tokened.
@@ -259,10 +602,25 @@ class ProxyService(Service):
         self.tokens_sent_to_rankings = set()
 
         # Create and spawn threads to send data to rankings.
+        state_dir = os.path.join(config.data_dir, "proxy",
+                                 "%d" % self.contest_id)
+        if not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
         self.rankings = list()
+        queue_length = self.metrics.gauge(
+            "cms_proxy_queue_length",
+            "Operations waiting to be sent to each ranking (by its "
+            "index in the configuration).", ["ranking"])
         for ranking in config.rankings:
-            proxy = RankingProxy(ranking.encode('utf-8'))
+            ranking = ranking.encode('utf-8')
+            # The URL contains the credentials: hash it.
+            state_path = os.path.join(
+                state_dir, "%s.json" % hashlib.sha1(ranking).hexdigest())
+            proxy = RankingProxy(ranking, state_path,
+                                 self.resend_everything)
             gevent.spawn(proxy.run)
+            queue_length.set_function(proxy.data_queue.qsize,
+                                      ranking=len(self.rankings))
             self.rankings.append(proxy)
 
         # Send some initial data to rankings.
@@ -429,16 +787,57 @@ class ProxyService(Service):
         self.tokens_sent_to_rankings.add(submission.id)
 
     @rpc_method
-    def reinitialize(self):
+    def get_ranking_statistics(self):
+        """Return the statistics about the pushes to the rankings.
+
+        return ({unicode: dict}): for each ranking (identified by its
+            URL, without credentials) the statistics returned by
+            RankingProxy.get_statistics.
+
+        """
+        result = dict()
+        for ranking in self.rankings:
+            url = urlsplit(ranking.ranking.decode('utf-8'))
+            # Don't disclose the credentials.
+            name = "%s://%s%s" % (url.scheme, url.netloc.rpartition("@")[2],
+                                  url.path)
+            result[name] = ranking.get_statistics()
+        return result
+
+    def resend_everything(self):
+        """Put again in the queues all the data for the rankings.
+
+        The proxies still skip what their ranking acknowledged (unless
+        they forgot it).
+
+        """
+        self.scores_sent_to_rankings.clear()
+        self.tokens_sent_to_rankings.clear()
+        self.initialize()
+        self.search_jobs_not_done()
+
+    @rpc_method
+    def reinitialize(self, forget=False):
         """Repeat the initialization procedure for all rankings.
 
         This method is usually called via RPC when someone knows that
         some basic data (i.e. contest, tasks or users) changed and
         rankings need to be updated.
 
+        forget (bool): if True, forget what the rankings acknowledged
+            and send them all the data again (including scores and
+            tokens). Restarts of the rankings, or the loss of their
+            data with them, are detected automatically: this is needed
+            only if some data was lost in other ways.
+
         """
         logger.info("Reinitializing rankings.")
-        self.initialize()
+        if forget:
+            for ranking in self.rankings:
+                ranking.forget_acked()
+            self.resend_everything()
+        else:
+            self.initialize()
 
     @rpc_method
     def submission_scored(self, submission_id):
@@ -29,10 +29,10 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
-import bisect
 import logging
 import os
 import time
+from array import array
 
 import psutil
 
@@ -62,6 +62,286 @@ else:
          "get_memory_info", "get_num_threads"]
 
 
+NAN = float("nan")
+
+
+def _to_float(value):
+    """Decode a stored value, None if missing (NaN)."""
+    return None if value != value else value
+
+
+def _to_int(value):
+    """Decode a stored value as an integer, None if missing (NaN)."""
+    return None if value != value else int(round(value))
+
+
+def _to_bool(value):
+    """Decode a stored value as a boolean, None if missing (NaN)."""
+    return None if value != value else value != 0.0
+
+
+class SampleRing(object):
+    """A fixed-size ring buffer of samples, each a row of floats.
+
+    The times and the values are kept in flat arrays, that are
+    allocated once; when full, each new sample overwrites the oldest.
+    The samples must be added in increasing order of time.
+
+    """
+    def __init__(self, capacity, width):
+        """Create an empty buffer.
+
+        capacity (int): the maximum number of samples.
+        width (int): the number of values of each sample.
+
+        """
+        self.capacity = capacity
+        self.width = width
+        self._times = array(b"d", [0.0]) * capacity
+        self._values = array(b"d", [NAN]) * (capacity * width)
+        # Position of the oldest sample, and number of samples.
+        self._start = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _position(self, index):
+        """Return the position in the arrays of the index-th oldest
+        sample.
+
+        """
+        return (self._start + index) % self.capacity
+
+    def append(self, timestamp, row):
+        """Add a sample, discarding the oldest one if full.
+
+        timestamp (float): the time of the sample.
+        row (array): its values, width of them.
+
+        """
+        if self._count < self.capacity:
+            pos = self._position(self._count)
+            self._count += 1
+        else:
+            pos = self._start
+            self._start = self._position(1)
+        self._times[pos] = timestamp
+        self._values[pos * self.width:(pos + 1) * self.width] = row
+
+    def first_time(self):
+        """Return the time of the oldest sample (None if empty)."""
+        if self._count == 0:
+            return None
+        return self._times[self._start]
+
+    def get_since(self, last_time, until=None):
+        """Return the samples in a range of time.
+
+        last_time (float): only the samples after this time...
+        until (float|None): ...and (if given) before this one.
+
+        return ([(float, array)]): the time and values of each sample,
+            oldest first.
+
+        """
+        # Binary search of the first sample after last_time.
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._times[self._position(mid)] <= last_time:
+                lo = mid + 1
+            else:
+                hi = mid
+        result = []
+        for index in xrange(lo, self._count):
+            pos = self._position(index)
+            if until is not None and self._times[pos] >= until:
+                break
+            result.append((self._times[pos],
+                           self._values[pos * self.width:
+                                        (pos + 1) * self.width]))
+        return result
+
+
+class ResourceHistory(object):
+    """The history of the resource usage, at multiple resolutions.
+
+    Each sample (the nested dictionary built by _store_resources) is
+    flattened to a row of floats, following a layout fixed by the
+    services on the machine, and kept at full resolution in a ring
+    buffer. Averages over longer periods are kept in coarser (and
+    smaller) ring buffers, that cover a longer span of time with the
+    same memory. Range queries return the finest data available for
+    each part of the range.
+
+    """
+    # Interval (in seconds) between samples at full resolution, and
+    # their number (hence 6 hours).
+    FULL_RESOLUTION = 5
+    FULL_SIZE = 4320
+    # Resolution (in seconds) and number of samples of the coarser
+    # buffers: 1 day of 1 minute averages and 1 week of 10 minutes
+    # averages.
+    DOWNSAMPLED = [(60, 1440), (600, 1008)]
+
+    CPU_FIELDS = ["user", "nice", "system", "idle", "iowait", "irq",
+                  "softirq"]
+    MEMORY_FIELDS = ["ram_total", "ram_available", "ram_cached",
+                     "ram_buffers", "ram_used", "swap_total",
+                     "swap_available", "swap_used"]
+
+    def __init__(self, services):
+        """Create an empty history.
+
+        services ([ServiceCoord]): the services whose usage is stored.
+
+        """
+        # For each value of the row: the path of keys to it in the
+        # dictionary, whether it's averaged (or the last one is taken
+        # when downsampling) and the function that decodes it.
+        self._layout = \
+            [(("cpu", field), True, _to_int) for field in self.CPU_FIELDS] + \
+            [(("cpu", "num_cpu"), False, _to_int)] + \
+            [(("memory", field), True, _to_float)
+             for field in self.MEMORY_FIELDS]
+        for service in services:
+            key = "%s" % (service,)
+            self._layout += [
+                (("services", key, "autorestart"), False, _to_bool),
+                (("services", key, "running"), False, _to_bool),
+                (("services", key, "since"), False, _to_float),
+                (("services", key, "resident"), True, _to_float),
+                (("services", key, "virtual"), True, _to_float),
+                (("services", key, "user"), True, _to_int),
+                (("services", key, "sys"), True, _to_int),
+                (("services", key, "threads"), False, _to_int),
+                ]
+        width = len(self._layout)
+        self._averaged = [averaged for unused_path, averaged, unused_decode
+                          in self._layout]
+
+        self._full = SampleRing(self.FULL_SIZE, width)
+        # For each coarser buffer, its resolution and the accumulator
+        # of the samples of the current period.
+        self._downsampled = [
+            (resolution, SampleRing(size, width), {"period": None})
+            for resolution, size in self.DOWNSAMPLED]
+
+    def _encode(self, data):
+        """Flatten a sample.
+
+        data (dict): the sample, as built by _store_resources.
+
+        return (array): its row, with NaN for the missing values.
+
+        """
+        row = array(b"d", [NAN]) * len(self._layout)
+        for idx, (path, unused_averaged, unused_decode) \
+                in enumerate(self._layout):
+            value = data
+            for key in path:
+                value = value.get(key) if isinstance(value, dict) else None
+            if value is not None:
+                row[idx] = float(value)
+        return row
+
+    def _decode(self, row):
+        """Rebuild a sample from its row.
+
+        row (array): the row.
+
+        return (dict): the sample, without the missing values.
+
+        """
+        data = {"cpu": {}, "memory": {}, "services": {}}
+        for value, (path, unused_averaged, decode) \
+                in zip(row, self._layout):
+            value = decode(value)
+            if value is None:
+                continue
+            node = data
+            for key in path[:-1]:
+                node = node.setdefault(key, {})
+            node[path[-1]] = value
+        return data
+
+    def _flush(self, ring, acc):
+        """Store the downsampled sample of the accumulated period.
+
+        """
+        row = array(b"d", [NAN]) * len(self._layout)
+        for idx, averaged in enumerate(self._averaged):
+            if not averaged:
+                row[idx] = acc["last"][idx]
+            elif acc["counts"][idx] > 0:
+                row[idx] = acc["sums"][idx] / acc["counts"][idx]
+        ring.append(acc["time"], row)
+
+    def add(self, timestamp, data):
+        """Add a sample.
+
+        timestamp (float): the time of the sample, later than the
+            ones of all previous samples.
+        data (dict): the sample, as built by _store_resources.
+
+        """
+        row = self._encode(data)
+        self._full.append(timestamp, row)
+        for resolution, ring, acc in self._downsampled:
+            period = int(timestamp // resolution)
+            if period != acc["period"]:
+                if acc["period"] is not None:
+                    self._flush(ring, acc)
+                acc["period"] = period
+                acc["sums"] = array(b"d", [0.0]) * len(row)
+                acc["counts"] = array(b"i", [0]) * len(row)
+            for idx, value in enumerate(row):
+                if value == value:
+                    acc["sums"][idx] += value
+                    acc["counts"][idx] += 1
+            acc["last"] = row
+            # Downsampled samples are timed as the last sample of
+            # their period, so that times are increasing across all
+            # resolutions.
+            acc["time"] = timestamp
+
+    def get_since(self, last_time, resolution=0):
+        """Return the samples after the given time.
+
+        The most recent part of the range comes from the finest buffer
+        that holds it, while older parts, if requested, come from the
+        coarser ones.
+
+        last_time (float): only the samples after this time are
+            returned.
+        resolution (float): the minimum spacing, in seconds, of the
+            samples; coarser buffers are used if needed.
+
+        return ([(float, dict)]): the time and the data of each
+            sample, oldest first.
+
+        """
+        rings = [(self.FULL_RESOLUTION, self._full)] + \
+            [(res, ring) for res, ring, unused_acc in self._downsampled]
+        # Skip the ones that are too fine, but keep the coarsest.
+        while len(rings) > 1 and rings[0][0] < resolution:
+            rings.pop(0)
+        segments = []
+        until = None
+        for unused_res, ring in rings:
+            segments.append(ring.get_since(last_time, until))
+            first_time = ring.first_time()
+            if first_time is None:
+                continue
+            if first_time <= last_time:
+                break
+            until = first_time if until is None else min(until, first_time)
+        return [(timestamp, self._decode(row))
+                for segment in reversed(segments)
+                for timestamp, row in segment]
+
+
 class ResourceService(Service):
     """This service looks at the resources usage (CPU, load, memory,
     network) every seconds, stores it locally, and offer (new) data
@@ -77,14 +357,14 @@ class ResourceService(Service):
 
         self.contest_id = contest_id
 
-        # _local_store is a dictionary indexed by time in int(epoch)
-        self._local_store = []
         # Floating point epoch using for precise measurement of percents
         self._last_saved_time = time.time()
         # Starting point for cpu times
         self._prev_cpu_times = self._get_cpu_times()
         # Sorted list of ServiceCoord running in the same machine
         self._local_services = self._find_local_services()
+        # The history of the samples, by time in int(epoch).
+        self._history = ResourceHistory(self._local_services)
         # Dict service with bool to mark if we will restart them.
         self._will_restart = dict((service,
                                    None if self.contest_id is None else True)
@@ -98,7 +378,8 @@ class ResourceService(Service):
         # Start finding processes and their cputimes.
         self._store_resources(store=False)
 
-        self.add_timeout(self._store_resources, None, 5.0)
+        self.add_timeout(self._store_resources, None,
+                         ResourceHistory.FULL_RESOLUTION)
         if self.contest_id is not None:
             self._launched_processes = set([])
             self.add_timeout(self._restart_services, None, 5.0,
@@ -372,24 +653,26 @@ class ResourceService(Service):
             data["services"]["%s" % (service,)] = dic
 
         if store:
-            if len(self._local_store) >= 5000:  # almost 7 hours
-                self._local_store = self._local_store[1:]
-            self._local_store.append((now, data))
+            self._history.add(now, data)
 
         return True
 
     @rpc_method
-    def get_resources(self, last_time=0.0):
+    def get_resources(self, last_time=0.0, resolution=0):
         """Returns the resurce usage information from last_time to
         now.
 
         last_time (float): timestamp of the last time the caller
             called this method.
+        resolution (float): the minimum spacing, in seconds, of the
+            returned samples (see ResourceHistory.get_since).
+
+        return ([(float, dict)]): the time and the data of each
+            sample, oldest first.
 
         """
         logger.debug("ResourceService._get_resources")
-        index = bisect.bisect_right(self._local_store, (last_time, 0))
-        return self._local_store[index:]
+        return self._history.get_since(last_time, resolution)
 
     @rpc_method
     def kill_service(self, service):
@@ -35,11 +35,12 @@ import gevent
 from gevent.queue import JoinableQueue
 from gevent.event import Event
 
-from cms import ServiceCoord
+from cms import ServiceCoord, get_service_shards
 from cms.io import Service, rpc_method
-from cms.db import SessionGen, Submission, Dataset
+from cms.db import SessionGen, Submission, Dataset, Task, UserTaskScore, \
+    User
 from cms.grading.scoretypes import get_score_type
-from cms.service import get_submission_results
+from cms.service import get_submission_results, update_user_task_score
 from cmscommon.datetime import monotonic_time
 
 
@@ -65,6 +66,14 @@ class ScoringService(Service):
     in the database and put the unscored ones in the queue (this check
     can also be forced by the search_jobs_not_done RPC method).
 
+    ScoringService also maintains the UserTaskScore table, i.e. the
+    score of each user on each task, used to build the rankings. The
+    pairs (user_id, task_id) whose score may have changed are put in a
+    second queue, consumed by another greenlet. The queue is filled
+    when a result on an active dataset is scored or invalidated, by the
+    new_submission, submission_tokened and dataset_updated RPC methods
+    and by the sweeper, for the pairs that have no stored score yet.
+
     """
 
     # How often we look for submission results not scored.
@@ -79,11 +88,31 @@ class ScoringService(Service):
         # Set up communication with ProxyService.
         self.proxy_service = self.connect_to(ServiceCoord("ProxyService", 0))
 
+        # Set up communication with ContestWebServers, to tell the
+        # contestants that their submissions have been scored.
+        self.contest_web_servers = []
+        for i in xrange(get_service_shards("ContestWebServer")):
+            self.contest_web_servers.append(self.connect_to(
+                ServiceCoord("ContestWebServer", i)))
+
         # Set up and spawn the scorer.
         # TODO Link to greenlet: when it dies, log CRITICAL and exit.
         self._scorer_queue = JoinableQueue()
         gevent.spawn(self._scorer_loop)
 
+        # Set up and spawn the task score updater.
+        # TODO Link to greenlet: when it dies, log CRITICAL and exit.
+        self._task_score_queue = JoinableQueue()
+        self._task_score_pending = set()
+        gevent.spawn(self._task_score_loop)
+
+        queue_length = self.metrics.gauge(
+            "cms_scoring_queue_length",
+            "Items waiting in the queues of ScoringService.", ["queue"])
+        queue_length.set_function(self._scorer_queue.qsize, queue="scorer")
+        queue_length.set_function(self._task_score_queue.qsize,
+                                  queue="task_score")
+
         # Set up and spawn the sweeper.
         # TODO Link to greenlet: when it dies, log CRITICAL and exit.
         self._sweeper_start = None
@@ -169,10 +198,78 @@ class ScoringService(Service):
             # Store it.
             session.commit()
 
-            # If dataset is the active one, update RWS.
+            # If dataset is the active one, update the user's score on
+            # the task and RWS, and tell the user.
             if dataset is submission.task.active_dataset:
+                self._enqueue_task_score(submission.user_id,
+                                         submission.task_id)
                 self.proxy_service.submission_scored(
                     submission_id=submission.id)
+                for contest_web_server in self.contest_web_servers:
+                    contest_web_server.submission_updated(
+                        contest_id=submission.task.contest_id,
+                        username=submission.user.username,
+                        task_name=submission.task.name)
+
+    def _enqueue_task_score(self, user_id, task_id):
+        """Schedule the score of a user on a task for recomputation.
+
+        If the pair is already waiting in the queue it isn't added
+        again, as a single recomputation will take all changes into
+        account.
+
+        user_id (int): the id of the user.
+        task_id (int): the id of the task.
+
+        """
+        if (user_id, task_id) not in self._task_score_pending:
+            self._task_score_pending.add((user_id, task_id))
+            self._task_score_queue.put((user_id, task_id))
+
+    def _task_score_loop(self):
+        """Monitor the queue, updating the score of its top element.
+
+        This is an infinite loop that, at each iteration, gets a pair
+        (user_id, task_id) from the queue (blocking until there is
+        one, if the queue is empty) and recomputes the score of the
+        user on the task. Any error during the update is sent to the
+        logger and then suppressed, because the loop must go on.
+
+        """
+        while True:
+            user_id, task_id = self._task_score_queue.get()
+            # Remove it before starting, so that changes that happen
+            # during the update will cause another one.
+            self._task_score_pending.discard((user_id, task_id))
+            try:
+                self._update_task_score(user_id, task_id)
+            except Exception:
+                logger.error("Unexpected error when updating the score of "
+                             "user %d on task %d.", user_id, task_id,
+                             exc_info=True)
+            finally:
+                self._task_score_queue.task_done()
+
+    def _update_task_score(self, user_id, task_id):
+        """Recompute and store the score of a user on a task.
+
+        user_id (int): the id of the user.
+        task_id (int): the id of the task.
+
+        """
+        with SessionGen() as session:
+            user = User.get_from_id(user_id, session)
+            if user is None:
+                raise ValueError("User %d not found in the database." %
+                                 user_id)
+
+            task = Task.get_from_id(task_id, session)
+            if task is None:
+                raise ValueError("Task %d not found in the database." %
+                                 task_id)
+
+            update_user_task_score(user, task, session)
+            session.commit()
 
     def _sweeper_loop(self):
         """Regularly check the database for unscored results.
@@ -215,6 +312,7 @@ class ScoringService(Service):
 
         """
         counter = 0
+        missing_counter = 0
 
         with SessionGen() as session:
             for sr in get_submission_results(session=session):
@@ -222,8 +320,21 @@ class ScoringService(Service):
                     self._scorer_queue.put((sr.submission_id, sr.dataset_id))
                     counter += 1
 
+            # Look for users that submitted on a task but whose score
+            # on it has never been stored (e.g., after an import).
+            stored = set(session.query(UserTaskScore.user_id,
+                                       UserTaskScore.task_id).all())
+            for user_id, task_id in session.query(Submission.user_id,
+                                                  Submission.task_id)\
+                    .distinct().all():
+                if (user_id, task_id) not in stored:
+                    self._enqueue_task_score(user_id, task_id)
+                    missing_counter += 1
+
         if counter > 0:
             logger.info("Found %d unscored submissions.", counter)
+        if missing_counter > 0:
+            logger.info("Found %d missing task scores.", missing_counter)
 
     @rpc_method
     def search_jobs_not_done(self):
@@ -246,6 +357,73 @@ class ScoringService(Service):
         """
         self._scorer_queue.put((submission_id, dataset_id))
 
+    @rpc_method
+    def new_submission(self, submission_id):
+        """Notice that a submission has been received.
+
+        Usually called by ContestWebServer. A new submission makes the
+        score of its user on its task partial (and possibly lower), so
+        we schedule its recomputation.
+
+        submission_id (int): the id of the new submission.
+
+        """
+        self._submission_changed(submission_id)
+
+    @rpc_method
+    def submission_tokened(self, submission_id):
+        """Notice that a submission has been tokened.
+
+        Usually called by ContestWebServer when it's processing a token
+        request of an user. The score of the user on the task may
+        change, so we schedule its recomputation.
+
+        submission_id (int): the id of the tokened submission.
+
+        """
+        self._submission_changed(submission_id)
+
+    def _submission_changed(self, submission_id):
+        """Schedule the recomputation of the score of a submission.
+
+        submission_id (int): the id of the submission.
+
+        raise (KeyError): if the submission doesn't exist.
+
+        """
+        with SessionGen() as session:
+            submission = Submission.get_from_id(submission_id, session)
+            if submission is None:
+                logger.error("Received notification for unexistent "
+                             "submission id %s.", submission_id)
+                raise KeyError("Submission not found.")
+
+            self._enqueue_task_score(submission.user_id, submission.task_id)
+
+    @rpc_method
+    def dataset_updated(self, task_id):
+        """Notice that the active dataset of a task has been changed.
+
+        Usually called by AdminWebServer when the contest administrator
+        changed the active dataset of a task. The scores of all the
+        users of the contest on the task have to be recomputed.
+
+        task_id (int): the id of the task whose dataset has changed.
+
+        raise (KeyError): if the task doesn't exist.
+
+        """
+        with SessionGen() as session:
+            task = Task.get_from_id(task_id, session)
+            if task is None:
+                logger.error("Received dataset update for unexistent "
+                             "task id %s.", task_id)
+                raise KeyError("Task not found.")
+
+            for user_id, in session.query(Submission.user_id)\
+                    .filter(Submission.task == task).distinct().all():
+                self._enqueue_task_score(user_id, task.id)
+
     @rpc_method
     def invalidate_submission(self, submission_id=None, dataset_id=None,
                               user_id=None, task_id=None, contest_id=None):
@@ -277,6 +455,7 @@ class ScoringService(Service):
         # been invalidated (and committed to the database). Therefore
         # we temporarily save them somewhere else.
         temp_queue = list()
+        task_scores = set()
 
         with SessionGen() as session:
             submission_results = \
@@ -288,10 +467,16 @@ class ScoringService(Service):
                 if sr.scored():
                     sr.invalidate_score()
                     temp_queue.append((sr.submission_id, sr.dataset_id))
+                    submission = sr.submission
+                    if sr.dataset_id == submission.task.active_dataset_id:
+                        task_scores.add((submission.user_id,
+                                         submission.task_id))
 
             session.commit()
 
         for item in temp_queue:
             self._scorer_queue.put(item)
+        for user_id, task_id in task_scores:
+            self._enqueue_task_score(user_id, task_id)
 
         logger.info("Invalidated %d submissions.", len(temp_queue))
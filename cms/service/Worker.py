@@ -28,6 +28,7 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import json
 import logging
 
 import gevent.coros
@@ -105,6 +106,11 @@ class Worker(Service):
 
         if self.work_lock.acquire(False):
 
+            # The task types used by the jobs of the group, by type and
+            # parameters, so that they can reuse their resources (e.g.,
+            # sandboxes) across jobs.
+            task_types = dict()
+
             try:
                 self._ignore_job = False
 
@@ -118,15 +124,15 @@ class Worker(Service):
                     # The only TaskType that needs it is OutputOnly.
                     job._key = k
 
-                    # FIXME We're creating a new TaskType for each Job
-                    # even if, at the moment, a JobGroup always uses
-                    # the same TaskType and the same parameters. Yet,
-                    # this could change in the future, so the best
-                    # solution is to keep a cache of TaskTypes objects
-                    # (like ScoringService does with ScoreTypes, except
-                    # that we cannot index by Dataset ID here...).
-                    task_type = get_task_type(job.task_type,
-                                              job.task_type_parameters)
+                    # At the moment a JobGroup always uses the same
+                    # TaskType and the same parameters, but this could
+                    # change in the future.
+                    task_type_key = (job.task_type,
+                                     json.dumps(job.task_type_parameters))
+                    if task_type_key not in task_types:
+                        task_types[task_type_key] = get_task_type(
+                            job.task_type, job.task_type_parameters)
+                    task_type = task_types[task_type_key]
                     task_type.execute_job(job, self.file_cacher)
 
                     logger.info("Finished job.",
@@ -146,6 +152,8 @@ class Worker(Service):
                 raise JobException(err_msg)
 
             finally:
+                for task_type in task_types.itervalues():
+                    task_type.cleanup()
                 self.work_lock.release()
 
         else:
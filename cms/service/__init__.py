@@ -27,7 +27,11 @@ from __future__ import unicode_literals
 
 import logging
 
-from cms.db import SessionGen, User, Task, Submission, SubmissionResult
+from sqlalchemy.orm import joinedload
+
+from cms.db import SessionGen, User, Task, Submission, SubmissionResult, \
+    UserTaskScore
+from cms.grading import submissions_score
 
 
 logger = logging.getLogger(__name__)
@@ -169,3 +173,37 @@ def get_datasets_to_judge(task):
             judge.append(dataset)
 
     return judge
+
+
+def update_user_task_score(user, task, session):
+    """Recompute the stored score of a user on a task.
+
+    Load all the submissions of the user on the task (with their
+    tokens and results) and use them to compute the score on the
+    active dataset, as cms.grading.task_score would do. Then store it
+    in the UserTaskScore for the pair, creating it if needed. The
+    caller is responsible for committing the session.
+
+    user (User): the user whose score has to be updated.
+    task (Task): the task whose score has to be updated.
+    session (Session): the database session to use.
+
+    return (UserTaskScore): the updated score.
+
+    """
+    submissions = session.query(Submission)\
+        .filter(Submission.user == user)\
+        .filter(Submission.task == task)\
+        .options(joinedload(Submission.token))\
+        .options(joinedload(Submission.results))\
+        .all()
+
+    user_task_score = UserTaskScore.get_from_id((user.id, task.id), session)
+    if user_task_score is None:
+        user_task_score = UserTaskScore(user=user, task=task)
+        session.add(user_task_score)
+
+    user_task_score.score, user_task_score.partial = \
+        submissions_score(submissions, task.active_dataset)
+
+    return user_task_score
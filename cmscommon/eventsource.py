@@ -23,17 +23,15 @@ from __future__ import unicode_literals
 
 import re
 import time
-from collections import deque
-from weakref import WeakSet
 
 import six
 
 from gevent import Timeout
-from gevent.queue import Queue, Empty
+from gevent.event import Event
 from gevent.pywsgi import WSGIHandler
 
 from werkzeug.wrappers import Request
-from werkzeug.exceptions import NotAcceptable
+from werkzeug.exceptions import NotAcceptable, Forbidden
 
 
 __all__ = [
@@ -89,8 +87,14 @@ class Publisher(object):
     Publish-subscribe is actually an improper name, as there's just one
     "topic", making it a simple broadcast system. The publisher class
     is responsible for receiving messages to be sent, keeping them in
-    a cache for a while, instantiating subscribers, each with its own
-    queue, and pushing new messages to all these queues.
+    a cache for a while, instantiating subscribers and waking them up
+    when there are new messages.
+
+    Messages are stored, already formatted, in a ring buffer, and each
+    subscriber just keeps the position of the next message it has to
+    read: putting a message takes constant time, regardless of the
+    number of subscribers, and a subscriber retrieves all the messages
+    it missed in a single batch.
 
     """
     def __init__(self, size):
@@ -99,13 +103,19 @@ class Publisher(object):
         size (int): the number of messages to keep in cache.
 
         """
-        # We use a deque as it's efficient to add messages to one end
-        # and have the ones at the other end be dropped when the total
-        # number exceeds the given limit.
-        self._cache = deque(maxlen=size)
-        # We use a WeakSet as we want queues to be vanish automatically
-        # when no one else is using (i.e. fetching from) them.
-        self._sub_queues = WeakSet()
+        self._size = size
+        # The ring buffers of the keys and of the messages: the message
+        # number i (counting from zero since the creation of the
+        # publisher) is at position i % size, until it's overwritten.
+        self._keys = [None] * size
+        self._msgs = [None] * size
+        # The number of the next message that will be put.
+        self._next = 0
+        # The key of the last message put, to make keys increase.
+        self._last_key = 0
+        # The event subscribers wait on; it's replaced by a new one
+        # every time it's set.
+        self._new_data = Event()
 
     def put(self, event, data):
         """Dispatch a new item to all subscribers.
@@ -116,14 +126,77 @@ class Publisher(object):
         data (unicode): the associated data.
 
         """
-        # Number of microseconds since epoch.
-        key = int(time.time() * 1000000)
+        # Number of microseconds since epoch, kept strictly increasing.
+        key = max(int(time.time() * 1000000), self._last_key + 1)
+        self._last_key = key
         msg = format_event("%x" % key, event, data)
         # Put into cache.
-        self._cache.append((key, msg))
-        # Send to all subscribers.
-        for queue in self._sub_queues:
-            queue.put(msg)
+        self._keys[self._next % self._size] = key
+        self._msgs[self._next % self._size] = msg
+        self._next += 1
+        # Wake up all subscribers.
+        new_data, self._new_data = self._new_data, Event()
+        new_data.set()
+
+    def get_last_id(self):
+        """Return the ID of the last message put.
+
+        Passed as last_event_id to get_subscriber, it makes the
+        subscriber receive exactly the messages put after this call.
+
+        return (unicode): the ID, as sent to the clients (or the one
+            preceding all of them, if no message was put yet).
+
+        """
+        return "%x" % self._last_key
+
+    def _first(self):
+        """Return the number of the oldest message still in cache.
+
+        """
+        return max(0, self._next - self._size)
+
+    def _find_after(self, last_event_key):
+        """Return the number of the first message after the given key.
+
+        last_event_key (int): the key of a message.
+
+        return (int|None): the number of the first message in cache
+            with a greater key, or None if some messages with a
+            greater key may have been already dropped from the cache
+            (or if the key wasn't given by this publisher, as it's
+            greater than the last one).
+
+        """
+        lo, hi = self._first(), self._next
+        if lo == hi or last_event_key < self._keys[lo % self._size] or \
+                last_event_key > self._last_key:
+            return None
+        # Bisect on the keys, which are increasing.
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._keys[mid % self._size] > last_event_key:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def _get_range(self, start, stop):
+        """Return the messages with numbers in the given range.
+
+        start (int): the number of the first message, still in cache.
+        stop (int): the number after the one of the last message.
+
+        return ([bytes]): the messages.
+
+        """
+        if start == stop:
+            return []
+        begin, end = start % self._size, stop % self._size
+        if begin < end:
+            return self._msgs[begin:end]
+        # The range wraps around the end of the buffer.
+        return self._msgs[begin:] + self._msgs[:end]
 
     def get_subscriber(self, last_event_id=None):
         """Obtain a new subscriber.
@@ -139,23 +212,18 @@ class Publisher(object):
         return (Subscriber): a new subscriber instance.
 
         """
-        queue = Queue()
         # If a valid last_event_id is provided see if cache can supply
         # missed events.
         if last_event_id is not None and \
                 re.match("^[0-9A-Fa-f]+$", last_event_id):
-            last_event_key = int(last_event_id, 16)
-            if len(self._cache) > 0 and last_event_key >= self._cache[0][0]:
+            cursor = self._find_after(int(last_event_id, 16))
+            if cursor is not None:
                 # All missed events are in cache.
-                for key, msg in self._cache:
-                    if key > last_event_key:
-                        queue.put(msg)
+                return Subscriber(self, cursor)
             else:
                 # Some events may be missing. Ask to reinit.
-                queue.put(b"event:reinit\n\n")
-        # Store the queue and return a subscriber bound to it.
-        self._sub_queues.add(queue)
-        return Subscriber(queue)
+                return Subscriber(self, self._next, reinit=True)
+        return Subscriber(self, self._next)
 
 
 class Subscriber(object):
@@ -165,39 +233,51 @@ class Subscriber(object):
     it.
 
     """
-    def __init__(self, queue):
+    def __init__(self, publisher, cursor, reinit=False):
         """Create a new subscriber.
 
-        Make it wait for messages on the given queue, managed by the
-        Publisher.
+        Make it read the messages of the given publisher, starting
+        from the given one.
 
-        queue (Queue): a message queue.
+        publisher (Publisher): the publisher.
+        cursor (int): the number of the next message to read.
+        reinit (bool): whether to tell the client to reinitialize,
+            as it missed some messages.
 
         """
-        self._queue = queue
+        self._pub = publisher
+        self._cursor = cursor
+        self._reinit = reinit
 
     def get(self):
         """Retrieve new messages.
 
         Obtain all messages that were put in the associated publisher
         since this method was last called, or (on the first call) since
-        the last_event_id given to get_subscriber.
+        the last_event_id given to get_subscriber. If the subscriber
+        fell so much behind that some of them have already been
+        dropped from the cache, just ask the client to reinitialize.
 
         return ([objects]): the items put in the publisher, in order
             (actually, returns a generator, not a list).
 
-        raise (OutdatedError): if some of the messages it's supposed to
-            retrieve have already been removed from the cache.
-
         """
+        pub = self._pub
         # Block until we have something to do.
-        self._queue.peek()
+        if not self._reinit and self._cursor == pub._next:
+            pub._new_data.wait()
+
+        if self._cursor < pub._first():
+            self._reinit = True
+            self._cursor = pub._next
+
         # Fetch all items that are immediately available.
-        try:
-            while True:
-                yield self._queue.get_nowait()
-        except Empty:
-            pass
+        msgs = pub._get_range(self._cursor, pub._next)
+        self._cursor = pub._next
+        if self._reinit:
+            self._reinit = False
+            msgs.insert(0, b"event:reinit\n\n")
+        return iter(msgs)
 
 
 class EventSource(object):
@@ -219,7 +299,7 @@ class EventSource(object):
     _WRITE_TIMEOUT = 30
     _PING_TIMEOUT = 15
 
-    _CACHE_SIZE = 250
+    _CACHE_SIZE = 4096
 
     def __init__(self):
         """Create an event source.
@@ -239,6 +319,21 @@ class EventSource(object):
         """
         self._pub.put(event, data)
 
+    def get_publisher(self, request):
+        """Return the publisher whose events have to be sent to a client.
+
+        By default all clients receive the same events. Subclasses can
+        override this method to send different events to different
+        clients, or to refuse some of them.
+
+        request (Request): the request of the client.
+
+        return (Publisher|None): the publisher to subscribe to, or None
+            to refuse the request (with 403 Forbidden).
+
+        """
+        return self._pub
+
     def __call__(self, environ, start_response):
         """Execute this instance as a WSGI application.
 
@@ -305,15 +400,22 @@ class EventSource(object):
         if request.accept_mimetypes.quality(b"text/event-stream") <= 0:
             return NotAcceptable()(environ, start_response)
 
+        # Check if the client is allowed to receive events.
+        pub = self.get_publisher(request)
+        if pub is None:
+            return Forbidden()(environ, start_response)
+
         # Initialize the response and get the write() callback. The
         # Cache-Control header is useless for conforming clients, as
         # the spec. already imposes that behavior on them, but we set
         # it explictly to avoid unwanted caching by unaware proxies and
-        # middlewares.
+        # middlewares. X-Accel-Buffering tells nginx not to buffer the
+        # response, even where proxy_buffering is on.
         write = start_response(
             b"200 OK",
             [(b"Content-Type", b"text/event-stream; charset=utf-8"),
-             (b"Cache-Control", b"no-cache")])
+             (b"Cache-Control", b"no-cache"),
+             (b"X-Accel-Buffering", b"no")])
 
         # This is a part of the fourth hack (see above).
         if hasattr(start_response, "__self__") and \
@@ -352,7 +454,7 @@ class EventSource(object):
                                              type=lambda x: x.decode('utf-8'))
 
         # We subscribe to the publisher to receive events.
-        sub = self._pub.get_subscriber(last_event_id)
+        sub = pub.get_subscriber(last_event_id)
 
         # Send some data down the pipe. We need that to make the user
         # agent announces the connection (see the spec.). Since it's a
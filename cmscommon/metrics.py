@@ -0,0 +1,384 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+# Copyright © 2014 Luca Wehrstedt <luca.wehrstedt@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A registry of metrics, exposed in the text format of Prometheus.
+
+Each process has a registry (the module-level registry object) where
+the code defines its metrics: counters (that only go up), gauges (that
+can be set to any value, or computed by a function whenever they are
+read) and histograms (that count the observed values in buckets). A
+metric can have labels, in which case it has a separate value for each
+combination of their values. The registry is also a WSGI application
+that serves the current values of all metrics on /metrics.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from bisect import bisect_left
+
+from werkzeug.wrappers import Request, Response
+from werkzeug.exceptions import HTTPException, NotFound, MethodNotAllowed
+
+from cmscommon.datetime import monotonic_time
+
+
+__all__ = [
+    "Counter", "Gauge", "Histogram", "MetricsRegistry", "registry",
+    ]
+
+
+def format_value(value):
+    """Format a sample value as the text format wants it.
+
+    value (float): the value.
+
+    return (unicode): its representation.
+
+    """
+    value = float(value)
+    if value == float("inf"):
+        return "+Inf"
+    if value == float("-inf"):
+        return "-Inf"
+    if value != value:
+        return "NaN"
+    return repr(value).decode('ascii')
+
+
+def format_labels(labels):
+    """Format the labels of a sample as the text format wants them.
+
+    labels ([(unicode, unicode)]): the names and values of the labels.
+
+    return (unicode): their representation (empty if there are none).
+
+    """
+    if len(labels) == 0:
+        return ""
+    return "{%s}" % ",".join(
+        "%s=\"%s\"" % (name, ("%s" % value).replace("\\", "\\\\")
+                       .replace("\"", "\\\"").replace("\n", "\\n"))
+        for name, value in labels)
+
+
+class Metric(object):
+    """Base class for the metrics.
+
+    The values are kept in a dictionary indexed by the tuple of the
+    values of the labels (in the order of their names).
+
+    """
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        """Create a metric.
+
+        name (unicode): the name of the metric.
+        documentation (unicode): a description of what it measures.
+        labelnames ([unicode]): the names of its labels.
+
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = dict()
+
+    def _get_key(self, labels):
+        """Return the key of the values of the given labels.
+
+        labels ({unicode: object}): the value of each label.
+
+        return (tuple): the key.
+
+        raise (ValueError): if the labels aren't the ones of the
+            metric.
+
+        """
+        if set(labels.iterkeys()) != set(self.labelnames):
+            raise ValueError("Metric %s has labels %s, not %s." %
+                             (self.name, ", ".join(self.labelnames),
+                              ", ".join(labels.iterkeys())))
+        return tuple("%s" % labels[name] for name in self.labelnames)
+
+    def get_samples(self):
+        """Return the current samples of the metric.
+
+        return ([(unicode, [(unicode, unicode)], float)]): for each
+            sample, the suffix to add to the name, its labels and its
+            value.
+
+        """
+        raise NotImplementedError("Please subclass this class.")
+
+    def render(self):
+        """Return the metric in the text format.
+
+        return ([unicode]): the lines describing the metric.
+
+        """
+        lines = ["# HELP %s %s" % (self.name, self.documentation.replace(
+                     "\\", "\\\\").replace("\n", "\\n")),
+                 "# TYPE %s %s" % (self.name, self.TYPE)]
+        for suffix, labels, value in self.get_samples():
+            lines.append("%s%s%s %s" % (self.name, suffix,
+                                        format_labels(labels),
+                                        format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    """A value that can only increase (e.g., a number of events).
+
+    """
+    TYPE = "counter"
+
+    def inc(self, amount=1, **labels):
+        """Increase the value.
+
+        amount (float): how much to add, not negative.
+        labels ({unicode: object}): the values of the labels.
+
+        """
+        if amount < 0:
+            raise ValueError("Counters can only increase.")
+        key = self._get_key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def get_samples(self):
+        """See Metric.get_samples."""
+        return [("", zip(self.labelnames, key), value)
+                for key, value in sorted(self._values.iteritems())]
+
+
+class Gauge(Metric):
+    """A value that can go up and down (e.g., the length of a queue).
+
+    """
+    TYPE = "gauge"
+
+    def set(self, value, **labels):
+        """Set the value.
+
+        value (float): the new value.
+        labels ({unicode: object}): the values of the labels.
+
+        """
+        self._values[self._get_key(labels)] = value
+
+    def set_function(self, function, **labels):
+        """Compute the value whenever it's read.
+
+        This spares updating the value each time it changes.
+
+        function (function): called without arguments, returns the
+            current value.
+        labels ({unicode: object}): the values of the labels.
+
+        """
+        self._values[self._get_key(labels)] = function
+
+    def get_samples(self):
+        """See Metric.get_samples."""
+        return [("", zip(self.labelnames, key),
+                 value() if callable(value) else value)
+                for key, value in sorted(self._values.iteritems())]
+
+
+class Histogram(Metric):
+    """The distribution of some values (e.g., durations).
+
+    """
+    TYPE = "histogram"
+
+    # The default upper bounds of the buckets, suited for durations in
+    # seconds.
+    DEFAULT_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 50,
+                       100]
+
+    def __init__(self, name, documentation, labelnames=(), buckets=None):
+        """Create a histogram.
+
+        buckets ([float]|None): the upper bounds of the buckets, in
+            increasing order (a last one, unbounded, is added); if
+            None, DEFAULT_BUCKETS.
+
+        See Metric.__init__ for the other arguments.
+
+        """
+        Metric.__init__(self, name, documentation, labelnames)
+        self.buckets = list(buckets if buckets is not None
+                            else self.DEFAULT_BUCKETS)
+
+    def observe(self, value, **labels):
+        """Add a value.
+
+        value (float): the observed value.
+        labels ({unicode: object}): the values of the labels.
+
+        """
+        key = self._get_key(labels)
+        if key not in self._values:
+            self._values[key] = {"count": [0] * (len(self.buckets) + 1),
+                                 "sum": 0.0}
+        self._values[key]["count"][bisect_left(self.buckets, value)] += 1
+        self._values[key]["sum"] += value
+
+    def time(self, **labels):
+        """Return a context manager observing the time spent in it.
+
+        labels ({unicode: object}): the values of the labels.
+
+        return (object): the context manager.
+
+        """
+        return _Timer(self, labels)
+
+    def get_samples(self):
+        """See Metric.get_samples."""
+        samples = list()
+        for key, value in sorted(self._values.iteritems()):
+            labels = zip(self.labelnames, key)
+            total = 0
+            for bound, count in zip(self.buckets + [float("inf")],
+                                    value["count"]):
+                total += count
+                samples.append(("_bucket",
+                                labels + [("le", format_value(bound))],
+                                total))
+            samples.append(("_count", labels, total))
+            samples.append(("_sum", labels, value["sum"]))
+        return samples
+
+
+class _Timer(object):
+    """Observe on a histogram the time spent in a with statement.
+
+    """
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = monotonic_time()
+
+    def __exit__(self, unused1, unused2, unused3):
+        self.histogram.observe(monotonic_time() - self.start, **self.labels)
+
+
+class MetricsRegistry(object):
+    """A collection of metrics, served over HTTP.
+
+    """
+    def __init__(self):
+        # Dictionary name -> metric.
+        self._metrics = dict()
+
+    def _get_or_create(self, cls, name, *args, **kwargs):
+        """Return the metric with the given name, creating it if needed.
+
+        Different parts of the code can define the same metric (and
+        the same code can run more than once).
+
+        cls (type): the class of the metric.
+        name (unicode): the name of the metric.
+
+        return (Metric): the metric.
+
+        raise (ValueError): if a metric with that name but another
+            type exists.
+
+        """
+        if name not in self._metrics:
+            self._metrics[name] = cls(name, *args, **kwargs)
+        elif not isinstance(self._metrics[name], cls):
+            raise ValueError("Metric %s is already a %s." %
+                             (name, self._metrics[name].TYPE))
+        return self._metrics[name]
+
+    def counter(self, name, documentation, labelnames=()):
+        """Return a counter (see Metric.__init__ for the arguments).
+
+        return (Counter): the counter.
+
+        """
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        """Return a gauge (see Metric.__init__ for the arguments).
+
+        return (Gauge): the gauge.
+
+        """
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=None):
+        """Return a histogram (see Histogram.__init__ for the
+        arguments).
+
+        return (Histogram): the histogram.
+
+        """
+        return self._get_or_create(Histogram, name, documentation,
+                                   labelnames, buckets)
+
+    def render(self):
+        """Return all the metrics in the text format.
+
+        return (bytes): the exposition of the metrics.
+
+        """
+        lines = list()
+        for name in sorted(self._metrics.iterkeys()):
+            lines.extend(self._metrics[name].render())
+        return ("\n".join(lines) + "\n").encode('utf-8')
+
+    def __call__(self, environ, start_response):
+        """Execute this instance as a WSGI application.
+
+        See the PEP for the meaning of parameters. The separation of
+        __call__ and wsgi_app eases the insertion of middlewares.
+
+        """
+        return self.wsgi_app(environ, start_response)
+
+    def wsgi_app(self, environ, start_response):
+        """Serve the metrics on /metrics.
+
+        """
+        request = Request(environ)
+        try:
+            if request.path != "/metrics":
+                raise NotFound()
+            if request.method not in ("GET", "HEAD"):
+                raise MethodNotAllowed(["GET", "HEAD"])
+        except HTTPException as exc:
+            return exc(environ, start_response)
+
+        response = Response(
+            self.render(),
+            content_type=b"text/plain; version=0.0.4; charset=utf-8")
+        return response(environ, start_response)
+
+
+# The registry of this process.
+registry = MetricsRegistry()
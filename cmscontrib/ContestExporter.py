@@ -36,12 +36,17 @@ import gevent.monkey
 gevent.monkey.patch_all()
 
 import argparse
+import hashlib
 import io
 import json
 import logging
 import os
 import tarfile
 import tempfile
+import time
+from collections import deque
+
+import gevent.pool
 
 from sqlalchemy.types import \
     Boolean, Integer, Float, String, Unicode, DateTime, Interval, Enum
@@ -52,9 +57,8 @@ from cms.db import SessionGen, Contest, ask_for_contest, \
     Submission, UserTest, SubmissionResult, UserTestResult, \
     RepeatedUnicode
 from cms.db.filecacher import FileCacher
-from cms.io.GeventUtils import rmtree
+from cms.io.GeventUtils import copyfileobj, rmtree
 
-from cmscontrib import sha1sum
 from cmscommon.datetime import make_timestamp
 
 
@@ -104,17 +108,86 @@ def get_archive_info(file_name):
     return ret
 
 
+# The name of the file, at the root of a dump, listing the files that
+# the dump (and the ones it's incremental to) contains.
+MANIFEST_NAME = "manifest.json"
+
+
+def load_manifest(path):
+    """Return the files contained in a previous dump.
+
+    path (string): the manifest of the dump, or the dump itself (a
+        directory or a tar archive, possibly compressed).
+
+    return (set): the digests of the files of the dump (including
+        the ones of the dumps it's incremental to).
+
+    raise (IOError): if the manifest cannot be found.
+    raise (ValueError): if it isn't valid.
+
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, MANIFEST_NAME)
+    if path.endswith(".json"):
+        with io.open(path, "rb") as fin:
+            return set(json.load(fin, encoding="utf-8")["files"])
+
+    # The exporter puts the manifest first in archives, so we can stop
+    # reading (and decompressing) the archive as soon as we find it.
+    archive = tarfile.open(path, "r|*")
+    try:
+        for member in archive:
+            if member.name.split("/")[1:] == [MANIFEST_NAME]:
+                return set(json.load(archive.extractfile(member),
+                                     encoding="utf-8")["files"])
+    finally:
+        archive.close()
+    raise IOError("No manifest found in %s." % path)
+
+
+class DigestReader(object):
+    """A read-only file-like object computing the SHA1 digest of the
+    data read from the wrapped one.
+
+    """
+    def __init__(self, fobj):
+        self.fobj = fobj
+        self.hasher = hashlib.sha1()
+
+    def read(self, size=-1):
+        data = self.fobj.read(size)
+        self.hasher.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.hasher.hexdigest().decode('ascii')
+
+
 class ContestExporter(object):
 
     """This service exports every data about the contest that CMS
     knows. The process of exporting and importing again should be
     idempotent.
 
+    The dump is written as it's produced (directly into the archive,
+    if the target is one): the files are fetched concurrently and the
+    objects are serialized one at a time, so that neither a copy of
+    the dump nor the whole object graph are kept at any moment.
+
     """
 
     def __init__(self, contest_id, export_target,
                  dump_files, dump_model, skip_generated,
-                 skip_submissions, skip_user_tests):
+                 skip_submissions, skip_user_tests,
+                 previous_dump=None, jobs=4):
+        """Create the exporter.
+
+        previous_dump (string|None): if given, the dump (or its
+            manifest) this one is incremental to: the files it
+            contains are not exported again.
+        jobs (int): the number of files to fetch concurrently.
+
+        """
         self.contest_id = contest_id
         self.dump_files = dump_files
         self.dump_model = dump_model
@@ -122,6 +195,8 @@ class ContestExporter(object):
         self.skip_submissions = skip_submissions
         self.skip_user_tests = skip_user_tests
         self.export_target = export_target
+        self.previous_dump = previous_dump
+        self.jobs = jobs
 
         # If target is not provided, we use the contest's name.
         if export_target == "":
@@ -137,6 +212,11 @@ class ContestExporter(object):
 
         self.file_cacher = FileCacher()
 
+        # The archive we are writing to (None if exporting to a
+        # directory) and the path of the root of the dump in it.
+        self.archive = None
+        self.export_dir = None
+
     def do_export(self):
         """Run the actual export code."""
         if self.contest_id is None:
@@ -144,84 +224,271 @@ class ContestExporter(object):
 
         logger.info("Starting export.")
 
-        export_dir = self.export_target
+        previous_files = set()
+        if self.previous_dump is not None:
+            try:
+                previous_files = load_manifest(self.previous_dump)
+            except (IOError, OSError, ValueError, KeyError,
+                    tarfile.TarError) as error:
+                logger.critical("Cannot read the manifest of the previous "
+                                "dump %s: %s." % (self.previous_dump, error))
+                return False
+            logger.info("Exporting only the files not contained in %s "
+                        "(%d files)." % (self.previous_dump,
+                                         len(previous_files)))
+
         archive_info = get_archive_info(self.export_target)
 
+        # A partial dump must never be found at the target (e.g., by a
+        # later --incremental export, that would trust its manifest):
+        # archives are written with a temporary name and renamed at the
+        # end, and directories are removed if the export fails (and
+        # get their manifest last).
         if archive_info["write_mode"] != "":
             # We are able to write to this archive.
             if os.path.exists(self.export_target):
                 logger.critical("The specified file already exists, "
                                 "I won't overwrite it.")
                 return False
-            export_dir = os.path.join(tempfile.mkdtemp(),
-                                      archive_info["basename"])
+            partial_target = self.export_target + ".part"
+            self.archive = tarfile.open(partial_target,
+                                        archive_info["write_mode"])
+            self.export_dir = archive_info["basename"]
+        else:
+            if os.path.exists(self.export_target):
+                logger.critical("The specified directory already exists, "
+                                "I won't overwrite it.")
+                return False
+            self.export_dir = self.export_target
 
-        logger.info("Creating dir structure.")
+        success = False
         try:
-            os.mkdir(export_dir)
-        except OSError:
-            logger.critical("The specified directory already exists, "
-                            "I won't overwrite it.")
+            success = self.export_contents(previous_files)
+        finally:
+            if self.archive is not None:
+                self.archive.close()
+            self.file_cacher.destroy_cache()
+            if not success:
+                logger.info("Removing the partial dump.")
+                if self.archive is not None:
+                    os.remove(partial_target)
+                elif os.path.exists(self.export_dir):
+                    rmtree(self.export_dir)
+
+        if not success:
             return False
 
-        files_dir = os.path.join(export_dir, "files")
-        descr_dir = os.path.join(export_dir, "descriptions")
-        os.mkdir(files_dir)
-        os.mkdir(descr_dir)
+        if self.archive is not None:
+            os.rename(partial_target, self.export_target)
+
+        logger.info("Export finished.")
+
+        return True
+
+    def export_contents(self, previous_files):
+        """Write the dump.
+
+        previous_files (set): the digests of the files not to export.
+
+        return (bool): True if all ok, False if something wrong.
+
+        """
+        logger.info("Creating dir structure.")
+        self.add_directory("")
+        self.add_directory("files")
+        self.add_directory("descriptions")
 
         with SessionGen() as session:
 
             contest = Contest.get_from_id(self.contest_id, session)
 
-            # Export files.
+            files = set()
             if self.dump_files:
-                logger.info("Exporting files.")
                 files = contest.enumerate_files(self.skip_submissions,
                                                 self.skip_user_tests,
                                                 self.skip_generated)
-                for file_ in files:
-                    if not self.safe_get_file(file_,
-                                              os.path.join(files_dir, file_),
-                                              os.path.join(descr_dir, file_)):
-                        return False
+
+            # In archives the manifest comes first, see load_manifest;
+            # in directories it comes last, so that an interrupted
+            # export doesn't leave one behind.
+            manifest = json.dumps(
+                {"_version": model_version,
+                 "files": sorted(files | previous_files)},
+                encoding="utf-8", indent=4, sort_keys=True).encode('utf-8')
+            if self.archive is not None:
+                self.add_file_content(MANIFEST_NAME, manifest)
+
+            # Export files.
+            if self.dump_files:
+                logger.info("Exporting files.")
+                if not self.export_files(sorted(files - previous_files)):
+                    return False
 
             # Export the contest in JSON format.
             if self.dump_model:
                 logger.info("Exporting the contest to a JSON file.")
 
-                # We use strings because they'll be the keys of a JSON
-                # object; the contest will have ID 0.
-                self.ids = {contest.sa_identity_key: "0"}
-                self.queue = [contest]
+                if self.archive is None:
+                    with io.open(os.path.join(self.export_dir,
+                                              "contest.json"), "wb") as fout:
+                        self.export_model(contest, fout)
+                else:
+                    # The archive needs the size before the content.
+                    with tempfile.TemporaryFile() as fout:
+                        self.export_model(contest, fout)
+                        size = fout.tell()
+                        fout.seek(0)
+                        self.add_file("contest.json", fout, size)
 
-                data = dict()
-                while len(self.queue) > 0:
-                    obj = self.queue.pop(0)
-                    data[self.ids[obj.sa_identity_key]] = \
-                        self.export_object(obj)
+            if self.archive is None:
+                self.add_file_content(MANIFEST_NAME, manifest)
 
-                # Specify the "root" of the data graph
-                data["_objects"] = ["0"]
+        return True
 
-                data["_version"] = model_version
+    def add_directory(self, name):
+        """Create a directory in the dump.
 
-                with io.open(os.path.join(export_dir,
-                                          "contest.json"), "wb") as fout:
-                    json.dump(data, fout, encoding="utf-8",
-                              indent=4, sort_keys=True)
+        name (string): its path, relative to the root of the dump.
 
-        # If the admin requested export to file, we do that.
-        if archive_info["write_mode"] != "":
-            archive = tarfile.open(self.export_target,
-                                   archive_info["write_mode"])
-            archive.add(export_dir, arcname=archive_info["basename"])
-            archive.close()
-            rmtree(export_dir)
+        """
+        if self.archive is None:
+            os.mkdir(os.path.join(self.export_dir, name))
+        else:
+            info = tarfile.TarInfo(
+                os.path.join(self.export_dir, name).rstrip("/"))
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            info.mtime = time.time()
+            self.archive.addfile(info)
+
+    def add_file(self, name, fobj, size):
+        """Write a file in the dump.
+
+        name (string): its path, relative to the root of the dump.
+        fobj (fileobj): where to read its content from.
+        size (int): the length of its content.
 
-        logger.info("Export finished.")
+        """
+        if self.archive is None:
+            with io.open(os.path.join(self.export_dir, name), "wb") as fout:
+                copyfileobj(fobj, fout)
+        else:
+            info = tarfile.TarInfo(os.path.join(self.export_dir, name))
+            info.size = size
+            info.mode = 0o644
+            info.mtime = time.time()
+            self.archive.addfile(info, fobj)
+
+    def add_file_content(self, name, content):
+        """Write a file in the dump.
+
+        name (string): its path, relative to the root of the dump.
+        content (bytes): its content.
 
+        """
+        self.add_file(name, io.BytesIO(content), len(content))
+
+    def fetch_file(self, digest):
+        """Bring a file and its description in the local cache.
+
+        Executed concurrently for many files.
+
+        digest (string): the digest of the file.
+
+        return ((string, unicode|None)): the digest and the
+            description of the file, or None if it could not be
+            retrieved.
+
+        """
+        try:
+            self.file_cacher.get_file(digest).close()
+            return digest, self.file_cacher.describe(digest)
+        except Exception as error:
+            logger.error("File %s could not retrieved from file server (%r)."
+                         % (digest, error))
+            return digest, None
+
+    def export_files(self, digests):
+        """Write the given files, and their descriptions, in the dump.
+
+        The files are fetched concurrently, and written as soon as
+        they are available; each file is then removed from the local
+        cache, so that the export doesn't need twice the disk space.
+
+        digests ([string]): the digests of the files.
+
+        return (bool): True if all ok, False if something wrong.
+
+        """
+        pool = gevent.pool.Pool(self.jobs)
+        try:
+            for idx, (digest, description) in enumerate(
+                    pool.imap_unordered(self.fetch_file, digests)):
+                if description is None:
+                    return False
+                with self.file_cacher.get_file(digest) as fobj:
+                    reader = DigestReader(fobj)
+                    self.add_file(os.path.join("files", digest), reader,
+                                  os.fstat(fobj.fileno()).st_size)
+                if reader.hexdigest() != digest:
+                    logger.critical("File %s has wrong hash %s."
+                                    % (digest, reader.hexdigest()))
+                    return False
+                self.add_file_content(os.path.join("descriptions", digest),
+                                      description.encode('utf-8'))
+                self.file_cacher.drop(digest)
+                if (idx + 1) % 1000 == 0:
+                    logger.info("Exported %d files of %d."
+                                % (idx + 1, len(digests)))
+        finally:
+            pool.kill()
         return True
 
+    def export_model(self, contest, fout):
+        """Write the objects of the contest as a JSON object.
+
+        The objects are visited starting from the contest and written
+        as soon as they are exported, so that the result doesn't need
+        to be kept in memory.
+
+        contest (Contest): the contest to export.
+        fout (fileobj): where to write the JSON.
+
+        """
+        # We use strings because they'll be the keys of a JSON
+        # object; the contest will have ID 0.
+        self.ids = {contest.sa_identity_key: "0"}
+        self.queue = deque([contest])
+
+        fout.write(b"{\n")
+        while len(self.queue) > 0:
+            obj = self.queue.popleft()
+            self.write_item(fout, self.ids[obj.sa_identity_key],
+                            self.export_object(obj))
+            fout.write(b",\n")
+
+        # Specify the "root" of the data graph
+        self.write_item(fout, "_objects", ["0"])
+        fout.write(b",\n")
+
+        self.write_item(fout, "_version", model_version)
+        fout.write(b"\n}\n")
+
+    @staticmethod
+    def write_item(fout, key, value):
+        """Write an item of a JSON object, indented.
+
+        fout (fileobj): where to write the item.
+        key (unicode): the key of the item.
+        value (object): a JSON-encodable value.
+
+        """
+        value = json.dumps(value, encoding="utf-8", indent=4,
+                           sort_keys=True)
+        fout.write(("    %s: %s" % (json.dumps(key),
+                                    value.replace("\n", "\n    ")))
+                   .encode('utf-8'))
+
     def get_id(self, obj):
         obj_key = obj.sa_identity_key
         if obj_key not in self.ids:
@@ -314,43 +581,6 @@ class ContestExporter(object):
 
         return data
 
-    def safe_get_file(self, digest, path, descr_path=None):
-
-        """Get file from FileCacher ensuring that the digest is
-        correct.
-
-        digest (string): the digest of the file to retrieve.
-        path (string): the path where to save the file.
-        descr_path (string): the path where to save the description.
-
-        return (bool): True if all ok, False if something wrong.
-
-        """
-
-        # TODO - Probably this method could be merged in FileCacher
-
-        # First get the file
-        try:
-            self.file_cacher.get_file_to_path(digest, path)
-        except Exception as error:
-            logger.error("File %s could not retrieved from file server (%r)."
-                         % (digest, error))
-            return False
-
-        # Then check the digest
-        calc_digest = sha1sum(path)
-        if digest != calc_digest:
-            logger.critical("File %s has wrong hash %s."
-                            % (digest, calc_digest))
-            return False
-
-        # If applicable, retrieve also the description
-        if descr_path is not None:
-            with io.open(descr_path, 'wt', encoding='utf-8') as fout:
-                fout.write(self.file_cacher.describe(digest))
-
-        return True
-
 
 def main():
     """Parse arguments and launch process."""
@@ -369,6 +599,13 @@ def main():
                         help="don't export submissions")
     parser.add_argument("-U", "--no-user-tests", action="store_true",
                         help="don't export user tests")
+    parser.add_argument("-i", "--incremental", action="store",
+                        type=utf8_decoder,
+                        help="previous dump (directory, archive or its "
+                             "manifest): export only the files it doesn't "
+                             "contain")
+    parser.add_argument("-j", "--jobs", action="store", type=int, default=4,
+                        help="number of files to fetch concurrently")
     parser.add_argument("export_target", action="store",
                         type=utf8_decoder, nargs='?', default="",
                         help="target directory or archive for export")
@@ -384,7 +621,9 @@ def main():
                     dump_model=not args.files,
                     skip_generated=args.no_generated,
                     skip_submissions=args.no_submissions,
-                    skip_user_tests=args.no_user_tests).do_export()
+                    skip_user_tests=args.no_user_tests,
+                    previous_dump=args.incremental,
+                    jobs=args.jobs).do_export()
 
 
 if __name__ == "__main__":
@@ -44,8 +44,13 @@ import os
 import tarfile
 import tempfile
 import zipfile
+from collections import OrderedDict, defaultdict
 from datetime import timedelta
 
+import gevent.pool
+
+from sqlalchemy import and_, bindparam, inspect
+from sqlalchemy.orm.interfaces import MANYTOONE, ONETOMANY
 from sqlalchemy.types import \
     Boolean, Integer, Float, String, Unicode, DateTime, Interval, Enum
 
@@ -53,13 +58,14 @@ import cms.db as class_hook
 
 from cms import utf8_decoder
 from cms.db import version as model_version
-from cms.db import SessionGen, init_db, drop_db, Submission, UserTest, \
-    SubmissionResult, UserTestResult, RepeatedUnicode
+from cms.db import SessionGen, init_db, drop_db, metadata, Contest, \
+    Submission, UserTest, SubmissionResult, UserTestResult, FSObject, \
+    RepeatedUnicode
 from cms.db.filecacher import FileCacher
 from cms.io.GeventUtils import rmtree
 
 from cmscontrib import sha1sum
-from cmscommon.datetime import make_datetime
+from cmscommon.datetime import make_datetime, monotonic_time
 
 
 logger = logging.getLogger(__name__)
@@ -97,15 +103,31 @@ class ContestImporter(object):
 
     """
 
+    # Number of rows inserted by each query, in bulk mode.
+    BULK_BATCH_SIZE = 1000
+
     def __init__(self, drop, import_source,
                  load_files, load_model, skip_generated,
-                 skip_submissions, skip_user_tests):
+                 skip_submissions, skip_user_tests,
+                 bulk=False, jobs=4):
+        """Create the importer.
+
+        bulk (bool): whether to insert the rows of each table in
+            batches (see bulk_add) and to upload the files
+            concurrently, trusting the digests of the files already
+            stored (see bulk_put_files).
+        jobs (int): the number of files to upload concurrently, in
+            bulk mode.
+
+        """
         self.drop = drop
         self.load_files = load_files
         self.load_model = load_model
         self.skip_generated = skip_generated
         self.skip_submissions = skip_submissions
         self.skip_user_tests = skip_user_tests
+        self.bulk = bulk
+        self.jobs = jobs
 
         self.import_source = import_source
         self.import_dir = import_source
@@ -247,18 +269,26 @@ class ContestImporter(object):
                 contest_id = list()
                 contest_files = set()
 
+                contests = list(self.objs[id_]
+                                for id_ in self.datas["_objects"])
+                if self.bulk:
+                    self.bulk_add(session, contests)
+
                 # Add each base object and all its dependencies
-                for id_ in self.datas["_objects"]:
-                    contest = self.objs[id_]
-
-                    # We explictly add only the contest since all child
-                    # objects will be automatically added by cascade.
-                    # Adding each object individually would also add
-                    # orphaned objects like the ones that depended on
-                    # submissions or user_tests that we (possibly)
-                    # removed above.
-                    session.add(contest)
-                    session.flush()
+                for contest in contests:
+                    if self.bulk:
+                        # Already inserted: load it to enumerate its
+                        # files.
+                        contest = Contest.get_from_id(contest.id, session)
+                    else:
+                        # We explictly add only the contest since all
+                        # child objects will be automatically added by
+                        # cascade. Adding each object individually
+                        # would also add orphaned objects like the ones
+                        # that depended on submissions or user_tests
+                        # that we (possibly) removed above.
+                        session.add(contest)
+                        session.flush()
 
                     contest_id += [contest.id]
                     contest_files |= contest.enumerate_files(
@@ -302,6 +332,13 @@ class ContestImporter(object):
                 if contest_files is not None:
                     files &= contest_files
 
+                if self.bulk:
+                    if not self.bulk_put_files(files_dir, descr_dir, files):
+                        logger.critical("Aborting. Please remove the "
+                                        "contest from the database.")
+                        return False
+                    files = set()
+
                 for digest in files:
                     file_ = os.path.join(files_dir, digest)
                     desc = os.path.join(descr_dir, digest)
@@ -416,6 +453,223 @@ class ContestImporter(object):
                 raise RuntimeError(
                     "Unknown RelationshipProperty value: %s" % type(val))
 
+    def bulk_add(self, session, roots):
+
+        """Insert the given objects, and all their dependencies, in
+        the database with few queries.
+
+        The rows are the ones that adding the objects to the session
+        and flushing it would insert. But while the ORM sends an
+        INSERT for each object, as it needs to read back the primary
+        key that the database assigned to it, here the primary keys
+        are reserved in advance from their sequences, the foreign keys
+        are computed from the relationships and the rows of each table
+        are inserted in batches, with executemany. Like the ORM does,
+        the columns of post_update relationships (the ones creating
+        cycles between tables) are set by UPDATEs at the end.
+
+        session (Session): the session to use; the objects aren't
+            added to it, and the caller has to commit it.
+        roots ([Base]): the objects to insert.
+
+        """
+        start_time = monotonic_time()
+
+        # The objects that session.add would add, in the order they are
+        # reached (to assign the identifiers deterministically).
+        objs = OrderedDict()
+        for root in roots:
+            state = inspect(root)
+            objs[id(root)] = root
+            for obj, unused_mapper, unused_state, unused_dict in \
+                    state.mapper.cascade_iterator("save-update", state):
+                objs[id(obj)] = obj
+        by_table = defaultdict(list)
+        for obj in objs.itervalues():
+            by_table[inspect(obj).mapper.local_table].append(obj)
+
+        # Assign the primary keys that the database would generate
+        # (i.e., those of the SERIAL columns).
+        for table, table_objs in by_table.iteritems():
+            column = table._autoincrement_column
+            if column is None:
+                continue
+            key = inspect(table_objs[0]).mapper.get_property_by_column(
+                column).key
+            for obj, id_ in zip(table_objs, self.allocate_ids(
+                    session, column, len(table_objs))):
+                setattr(obj, key, id_)
+
+        # The column values of each object (by id of the object and
+        # column), and the ones to set after inserting all rows.
+        values = defaultdict(dict)
+        post_updates = defaultdict(list)
+
+        def get_value(obj, col):
+            mapper = inspect(obj).mapper
+            return getattr(obj, mapper.get_property_by_column(col).key)
+
+        for obj in objs.itervalues():
+            state = inspect(obj)
+            for prp in state.mapper.relationships:
+                other = state.dict.get(prp.key)
+                if other is None:
+                    continue
+                if prp.direction is MANYTOONE:
+                    row = dict((local, get_value(other, remote))
+                               for local, remote in prp.local_remote_pairs)
+                    if prp.post_update:
+                        post_updates[state.mapper.local_table].append(
+                            (obj, row))
+                    else:
+                        values[id(obj)].update(row)
+                elif prp.direction is ONETOMANY:
+                    if not prp.uselist:
+                        other = [other]
+                    elif isinstance(other, dict):
+                        other = other.values()
+                    for child in other:
+                        values[id(child)].update(
+                            (remote, get_value(obj, local))
+                            for local, remote in prp.local_remote_pairs)
+
+        # Insert the rows, a table after the ones it depends on.
+        count = 0
+        for table in metadata.sorted_tables:
+            rows = list()
+            for obj in by_table.get(table, []):
+                state = inspect(obj)
+                row = dict((col.key, None) for col in table.columns)
+                for prp in state.mapper.column_attrs:
+                    if prp.key in state.dict:
+                        row[prp.columns[0].key] = state.dict[prp.key]
+                for col, value in values[id(obj)].iteritems():
+                    row[col.key] = value
+                rows.append(row)
+            for i in xrange(0, len(rows), self.BULK_BATCH_SIZE):
+                session.execute(table.insert(),
+                                rows[i:i + self.BULK_BATCH_SIZE])
+            count += len(rows)
+
+        for table, updates in post_updates.iteritems():
+            pk_cols = list(table.primary_key.columns)
+            for obj, row in updates:
+                params = dict(("_pk_%s" % col.key, get_value(obj, col))
+                              for col in pk_cols)
+                params.update(("_value_%s" % col.key, value)
+                              for col, value in row.iteritems())
+                session.execute(
+                    table.update()
+                    .where(and_(*[col == bindparam("_pk_%s" % col.key)
+                                  for col in pk_cols]))
+                    .values(dict((col.key, bindparam("_value_%s" % col.key))
+                                 for col in row)),
+                    params)
+
+        elapsed = monotonic_time() - start_time
+        logger.info("Inserted %d rows in %.1f s (%.0f rows/s)." %
+                    (count, elapsed, count / max(elapsed, 0.001)))
+
+    @staticmethod
+    def allocate_ids(session, column, count):
+
+        """Reserve values for an autoincrementing primary key.
+
+        session (Session): the session to use.
+        column (Column): the primary key, a PostgreSQL SERIAL.
+        count (int): how many values to reserve.
+
+        return ([int]): the reserved values.
+
+        """
+        sequence = "%s_%s_seq" % (column.table.name, column.name)
+        return list(
+            row[0] for row in session.execute(
+                "SELECT nextval(:sequence) FROM generate_series(1, :count)",
+                {"sequence": sequence, "count": count}))
+
+    def bulk_put_files(self, files_dir, descr_dir, digests):
+
+        """Put many files to FileCacher, concurrently.
+
+        The names of the files are their digests. The files whose
+        digest is already in the database are trusted to be the same
+        and skipped; the digest of each of the others is verified
+        while it's being uploaded, without reading it again.
+
+        files_dir (string): the directory containing the files.
+        descr_dir (string): the directory containing the descriptions.
+        digests (set): the digests of the files to put.
+
+        return (bool): True if all ok, False if something wrong.
+
+        """
+        with SessionGen() as session:
+            stored = set(digest for digest,
+                         in session.query(FSObject.digest).all())
+        to_put = sorted(digests - stored)
+        logger.info("Uploading %d files (%d are already stored)." %
+                    (len(to_put), len(digests) - len(to_put)))
+
+        start_time = monotonic_time()
+        total_size = 0
+        pool = gevent.pool.Pool(self.jobs)
+        try:
+            for idx, size in enumerate(pool.imap_unordered(
+                    lambda digest: self.put_file(files_dir, descr_dir,
+                                                 digest),
+                    to_put)):
+                if size is None:
+                    return False
+                total_size += size
+                if (idx + 1) % 1000 == 0 or idx + 1 == len(to_put):
+                    elapsed = monotonic_time() - start_time
+                    logger.info("Uploaded %d files of %d, %.1f MB in "
+                                "%.1f s (%.1f MB/s)." %
+                                (idx + 1, len(to_put),
+                                 total_size / 1024.0 / 1024.0, elapsed,
+                                 total_size / 1024.0 / 1024.0 /
+                                 max(elapsed, 0.001)))
+        finally:
+            pool.kill()
+        return True
+
+    def put_file(self, files_dir, descr_dir, digest):
+
+        """Put a file to FileCacher, verifying its digest.
+
+        files_dir (string): the directory containing the file.
+        descr_dir (string): the directory containing the description.
+        digest (string): the digest of the file (i.e., its name).
+
+        return (int|None): the size of the file, or None if something
+            wrong.
+
+        """
+        path = os.path.join(files_dir, digest)
+        try:
+            with io.open(os.path.join(descr_dir, digest),
+                         'rt', encoding='utf-8') as fin:
+                description = fin.read()
+        except IOError:
+            description = ''
+
+        try:
+            calc_digest = self.file_cacher.put_file_from_path(path,
+                                                              description)
+        except Exception as error:
+            logger.critical("File %s could not be put to file server (%r)."
+                            % (path, error))
+            return None
+        # We don't need the copy in the local cache.
+        self.file_cacher.drop(calc_digest)
+
+        if digest != calc_digest:
+            logger.critical("File %s has hash %s." % (path, calc_digest))
+            return None
+
+        return os.path.getsize(path)
+
     def safe_put_file(self, path, descr_path):
 
         """Put a file to FileCacher signaling every error (including
@@ -473,6 +727,13 @@ def main():
                         help="don't import submissions")
     parser.add_argument("-U", "--no-user-tests", action="store_true",
                         help="don't import user tests")
+    parser.add_argument("-b", "--bulk", action="store_true",
+                        help="insert the data in batches and upload the "
+                             "files concurrently, trusting the ones already "
+                             "stored (faster for big contests)")
+    parser.add_argument("-j", "--jobs", action="store", type=int, default=4,
+                        help="number of files to upload concurrently, in "
+                             "bulk mode")
     parser.add_argument("import_source", action="store", type=utf8_decoder,
                         help="source directory or compressed file")
 
@@ -484,7 +745,9 @@ def main():
                     load_model=not args.files,
                     skip_generated=args.no_generated,
                     skip_submissions=args.no_submissions,
-                    skip_user_tests=args.no_user_tests).do_import()
+                    skip_user_tests=args.no_user_tests,
+                    bulk=args.bulk,
+                    jobs=args.jobs).do_import()
 
 
 if __name__ == "__main__":
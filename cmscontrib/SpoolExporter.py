@@ -40,7 +40,7 @@ import os
 import time
 
 from cms import utf8_decoder
-from cms.db import SessionGen, Contest, ask_for_contest
+from cms.db import ReadOnlySessionGen, Contest, ask_for_contest
 from cms.db.filecacher import FileCacher
 from cms.grading.scoretypes import get_score_type
 
@@ -83,7 +83,7 @@ class SpoolExporter(object):
             return False
         os.mkdir(self.upload_dir)
 
-        with SessionGen() as session:
+        with ReadOnlySessionGen() as session:
             self.contest = Contest.get_from_id(self.contest_id, session)
             self.submissions = sorted(
                 (submission
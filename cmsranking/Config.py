@@ -49,8 +49,17 @@ class Config(object):
         self.username = 'usern4me'
         self.password = 'passw0rd'
 
+        # Replication (the URL, with credentials, of the RWS to copy
+        # the data from, and its certificate, if it uses HTTPS).
+        self.primary_url = None
+        self.primary_certfile = None
+
         # Buffers
-        self.buffer_size = 100  # Needs to be strictly positive.
+        self.buffer_size = 10000  # Needs to be strictly positive.
+
+        # Caching (max-age sent to clients, in seconds).
+        self.static_max_age = 300  # 5 minutes
+        self.image_max_age = 3600  # 1 hour
 
         # File system.
         self.installed = sys.argv[0].startswith("/usr/") and \
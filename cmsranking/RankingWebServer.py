@@ -23,15 +23,20 @@ from __future__ import unicode_literals
 
 import argparse
 import functools
+import hashlib
 import io
 import json
 import logging
+import mimetypes
 import os
 import pprint
 import re
 import shutil
 import time
+import uuid
+import zlib
 from datetime import datetime
+from urlparse import urlsplit
 
 import gevent
 from gevent.pywsgi import WSGIServer
@@ -40,8 +45,7 @@ from werkzeug.wrappers import Request, Response
 from werkzeug.routing import Map, Rule
 from werkzeug.exceptions import HTTPException, BadRequest, Unauthorized, \
     Forbidden, NotFound, NotAcceptable, UnsupportedMediaType
-from werkzeug.wsgi import responder, wrap_file, SharedDataMiddleware, \
-    DispatcherMiddleware
+from werkzeug.wsgi import responder, wrap_file, DispatcherMiddleware
 from werkzeug.utils import redirect
 
 # Needed for initialization. Do not remove.
@@ -57,11 +61,20 @@ import cmsranking.User as User
 import cmsranking.Submission as Submission
 import cmsranking.Subchange as Subchange
 import cmsranking.Scoring as Scoring
+import cmsranking.Replication as Replication
 
 
 logger = logging.getLogger(__name__)
 
 
+# Identifies this run of RWS, and is sent in the Store-Epoch header of
+# all the responses of the stores. Changes are acknowledged before
+# being written to disk, hence a client (i.e. ProxyService) can trust
+# that the data it sent is still here only while the epoch is the
+# same: once it changes, it has to send everything again.
+EPOCH = uuid.uuid4().hex.decode('ascii')
+
+
 class CustomUnauthorized(Unauthorized):
     def get_response(self, environ=None):
         response = Unauthorized.get_response(self, environ)
@@ -72,9 +85,33 @@ class CustomUnauthorized(Unauthorized):
         return response
 
 
+def authorized(request):
+    """Return whether the request carries the configured credentials.
+
+    """
+    return request.authorization is not None and \
+        request.authorization.type == "basic" and \
+        request.authorization.username == config.username and \
+        request.authorization.password == config.password
+
+
 class StoreHandler(object):
-    def __init__(self, store):
+    def __init__(self, store, read_only=False):
+        """Create the handler.
+
+        store (Store): the store to give access to.
+        read_only (bool): whether to refuse all changes (as data is
+            replicated from a primary RWS).
+
+        """
         self.store = store
+        self.read_only = read_only
+
+        # The list of all entities, computed only after changes.
+        self.list_response = CachedResponse(self.store.retrieve_list)
+        self.store.add_create_callback(self.list_response.invalidate)
+        self.store.add_update_callback(self.list_response.invalidate)
+        self.store.add_delete_callback(self.list_response.invalidate)
 
         self.router = Map(
             [Rule("/<key>", methods=["GET"], endpoint="get"),
@@ -119,13 +156,44 @@ class StoreHandler(object):
         except HTTPException as exc:
             return exc
 
+        response.headers[b'Store-Epoch'] = EPOCH.encode('ascii')
         return response
 
+    def load_json(self, request):
+        """Decode the JSON body of the request.
+
+        The body may be gzip-compressed, as announced by the
+        Content-Encoding header.
+
+        request (Request): the request to read.
+
+        return (object): the decoded data.
+
+        raise (BadRequest): if the body isn't valid.
+
+        """
+        encoding = request.headers.get("Content-Encoding", "identity")
+        try:
+            if encoding == "gzip":
+                return json.loads(zlib.decompress(request.stream.read(),
+                                                  16 + zlib.MAX_WBITS))
+            elif encoding == "identity":
+                return json.load(request.stream)
+        except (TypeError, ValueError, zlib.error):
+            logger.warning("Wrong JSON.",
+                           extra={'location': request.url})
+            raise BadRequest()
+        logger.warning("Unsupported content encoding.",
+                       extra={'location': request.url,
+                              'details': encoding})
+        raise UnsupportedMediaType()
+
     def authorized(self, request):
-        return request.authorization is not None and \
-            request.authorization.type == "basic" and \
-            request.authorization.username == config.username and \
-            request.authorization.password == config.password
+        if self.read_only:
+            logger.warning("Change requested to a replica.",
+                           extra={'location': request.url})
+            raise Forbidden()
+        return authorized(request)
 
     def get(self, request, response, key):
         # Limit charset of keys.
@@ -145,10 +213,8 @@ class StoreHandler(object):
         if request.accept_mimetypes.quality("application/json") <= 0:
             raise NotAcceptable()
 
-        response.status_code = 200
         response.headers[b'Timestamp'] = b"%0.6f" % time.time()
-        response.mimetype = "application/json"
-        response.data = json.dumps(self.store.retrieve_list())
+        self.list_response.serve(request, response)
 
     def put(self, request, response, key):
         # Limit charset of keys.
@@ -165,12 +231,7 @@ class StoreHandler(object):
                                   'details': request.mimetype})
             raise UnsupportedMediaType()
 
-        try:
-            data = json.load(request.stream)
-        except (TypeError, ValueError):
-            logger.warning("Wrong JSON.",
-                           extra={'location': request.url})
-            raise BadRequest()
+        data = self.load_json(request)
 
         try:
             if key not in self.store:
@@ -197,12 +258,7 @@ class StoreHandler(object):
                                   'details': request.mimetype})
             raise UnsupportedMediaType()
 
-        try:
-            data = json.load(request.stream)
-        except (TypeError, ValueError):
-            logger.warning("Wrong JSON.",
-                           extra={'location': request.url})
-            raise BadRequest()
+        data = self.load_json(request)
 
         try:
             self.store.merge_list(data)
@@ -286,46 +342,259 @@ class DataWatcher(EventSource):
         self.send("score", "%s %s %0.2f" % (user, task, score))
 
 
-def SubListHandler(request, response, user_id):
-    if request.accept_mimetypes.quality("application/json") <= 0:
-        raise NotAcceptable()
+class ReplicationFeed(EventSource):
+    """Publish the changes of the stores, for replicas to follow.
+
+    Each change is an event with the name of the store, the key of the
+    entity and its new data (null if it has been deleted), and its ID
+    is a sequence number (a timestamp in microseconds, see
+    cmsranking.Replication). The snapshot of all data is served
+    together with the sequence number of the last change it includes,
+    so that a replica can ask the feed for the following ones.
+
+    """
+    def __init__(self):
+        self._CACHE_SIZE = config.buffer_size
+        EventSource.__init__(self)
 
-    result = list()
-    for task_id in Task.store._store.iterkeys():
-        result.extend(Scoring.store.get_submissions(user_id, task_id).values())
-    result.sort(key=lambda x: (x.task, x.time))
-    result = list(a.__dict__ for a in result)
+        # Start with an event, so that the sequence number of the first
+        # snapshot is different in every run of RWS.
+        self.send("start", None)
+        self.snapshot = CachedResponse(self.get_snapshot)
 
-    response.status_code = 200
-    response.mimetype = "application/json"
-    response.data = json.dumps(result)
+        for name, store in Replication.STORES:
+            store.add_create_callback(
+                functools.partial(self.callback, name))
+            store.add_update_callback(
+                functools.partial(self.callback, name))
+            store.add_delete_callback(
+                functools.partial(self.callback, name, deleted=True))
 
+        self.router = Map(
+            [Rule("/events", methods=["GET"], endpoint="events"),
+             Rule("/snapshot", methods=["GET"], endpoint="snapshot"),
+             ], encoding_errors="strict")
+
+    def callback(self, name, key, *args, **kwargs):
+        if kwargs.get("deleted", False):
+            data = None
+        else:
+            data = args[-1].get()
+        # The dump is ASCII, but format_event wants unicode.
+        self.send("change", json.dumps(
+            {"store": name, "key": key, "data": data}).decode('ascii'))
+        self.snapshot.invalidate()
+
+    def get_snapshot(self):
+        return {"sequence": self._pub.get_last_id(),
+                "stores": Replication.get_snapshot()}
+
+    def __call__(self, environ, start_response):
+        route = self.router.bind_to_environ(environ)
+        try:
+            endpoint, args = route.match()
+        except HTTPException as exc:
+            return exc(environ, start_response)
+
+        request = Request(environ)
+        request.encoding_errors = "strict"
+
+        if not authorized(request):
+            logger.info("Unauthorized request.",
+                        extra={'location': request.url,
+                               'details': repr(request.authorization)})
+            return CustomUnauthorized()(environ, start_response)
+
+        if endpoint == "events":
+            return self.wsgi_app(environ, start_response)
 
-def HistoryHandler(request, response):
+        if request.accept_mimetypes.quality("application/json") <= 0:
+            return NotAcceptable()(environ, start_response)
+        response = Response()
+        self.snapshot.serve(request, response)
+        return response(environ, start_response)
+
+
+def SubListHandler(request, response, user_id, score_cache):
     if request.accept_mimetypes.quality("application/json") <= 0:
         raise NotAcceptable()
+    # Don't let clients make us cache lists for made-up users.
+    if user_id not in User.store:
+        raise NotFound()
+
+    score_cache.get_sublist(user_id).serve(request, response)
+
+
+class CachedResponse(object):
+    """A JSON response that is computed again only when data changes.
+
+    The body (plain and gzipped) is kept until invalidate() is called,
+    and it's served with an ETag that changes at each invalidation, so
+    that clients that already have it get a 304 Not Modified.
 
-    result = list(Scoring.store.get_global_history())
+    """
+    def __init__(self, compute):
+        """Create the response.
+
+        compute (function): called with no arguments, return the
+            object to send, encoded as JSON.
+
+        """
+        self._compute = compute
+        # To tell apart the versions of different runs of RWS.
+        self._instance = uuid.uuid4().hex[:8]
+        self._version = 0
+        self._body = None
+        self._gzipped_body = None
+
+    def invalidate(self, *args):
+        """Discard the body, as the data it's computed from changed.
+
+        It accepts (and ignores) any argument, to be usable as a
+        callback for stores.
+
+        """
+        self._version += 1
+        self._body = None
+        self._gzipped_body = None
+
+    def serve(self, request, response):
+        """Fill the response to a request.
+
+        request (Request): the request.
+        response (Response): the response to fill.
+
+        """
+        etag = "%s-%d" % (self._instance, self._version)
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+        response.vary.add("Accept-Encoding")
+        response.mimetype = "application/json"
+
+        if request.if_none_match.contains(etag):
+            response.status_code = 304
+            return
+
+        if self._body is None:
+            self._body = json.dumps(self._compute())
+            compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            self._gzipped_body = \
+                compressor.compress(self._body) + compressor.flush()
+
+        response.status_code = 200
+        if request.accept_encodings.quality("gzip") > 0:
+            response.content_encoding = "gzip"
+            response.data = self._gzipped_body
+        else:
+            response.data = self._body
 
-    response.status_code = 200
-    response.mimetype = "application/json"
-    response.data = json.dumps(result)
 
+class ScoreCache(object):
+    """Keep the scores, their history and the submissions ready.
 
-def ScoreHandler(request, response):
+    The current scores are updated at each change, the history and the
+    list of submissions of each user are computed again only when
+    asked after a change.
+
+    """
+    def __init__(self):
+        # The positive scores, by user and task.
+        self._scores = dict()
+        for u_id, tasks in Scoring.store._scores.iteritems():
+            for t_id, score in tasks.iteritems():
+                if score.get_score() > 0.0:
+                    self._scores.setdefault(u_id, dict())[t_id] = \
+                        score.get_score()
+
+        self.scores = CachedResponse(lambda: self._scores)
+        self.history = CachedResponse(
+            lambda: list(Scoring.store.get_global_history()))
+
+        # The lists of submissions, by user (only of the existing
+        # users whose list has been asked).
+        self.sublists = dict()
+        User.store.add_delete_callback(self.user_delete_callback)
+
+        Scoring.store.add_score_callback(self.score_callback)
+        # The history may change even if no score does.
+        for store in (Submission.store, Subchange.store):
+            store.add_create_callback(self.history.invalidate)
+            store.add_update_callback(self.history.invalidate)
+            store.add_delete_callback(self.history.invalidate)
+
+        Submission.store.add_create_callback(self.submission_callback)
+        Submission.store.add_update_callback(self.submission_callback)
+        Submission.store.add_delete_callback(self.submission_callback)
+        Subchange.store.add_create_callback(self.subchange_callback)
+        Subchange.store.add_update_callback(self.subchange_callback)
+        Subchange.store.add_delete_callback(self.subchange_callback)
+
+    def get_sublist(self, user_id):
+        """Return the response with the submissions of a user.
+
+        user_id (unicode): the key of the user.
+
+        return (CachedResponse): the list of submissions, sorted by
+            task and time, with their current status.
+
+        """
+        if user_id not in self.sublists:
+            self.sublists[user_id] = CachedResponse(
+                functools.partial(self._compute_sublist, user_id))
+        return self.sublists[user_id]
+
+    def _compute_sublist(self, user_id):
+        result = list()
+        if user_id in Scoring.store._scores:
+            for score in Scoring.store._scores[user_id].itervalues():
+                result.extend(score._submissions.itervalues())
+        result.sort(key=lambda x: (x.task, x.time))
+        return list(a.__dict__ for a in result)
+
+    def _invalidate_sublist(self, user_id):
+        if user_id in self.sublists:
+            self.sublists[user_id].invalidate()
+
+    def user_delete_callback(self, key, unused_user):
+        self.sublists.pop(key, None)
+
+    def submission_callback(self, key, *submissions):
+        # Old and new values, if both given, may be of different users.
+        for submission in submissions:
+            self._invalidate_sublist(submission.user)
+
+    def subchange_callback(self, key, *subchanges):
+        for subchange in subchanges:
+            # If the submission has been deleted its callback did.
+            if subchange.submission in Submission.store:
+                self._invalidate_sublist(
+                    Submission.store._store[subchange.submission].user)
+
+    def score_callback(self, user, task, score):
+        if score > 0.0:
+            self._scores.setdefault(user, dict())[task] = score
+        elif user in self._scores:
+            self._scores[user].pop(task, None)
+            if len(self._scores[user]) == 0:
+                del self._scores[user]
+        self.scores.invalidate()
+        self.history.invalidate()
+
+
+def HistoryHandler(request, response, score_cache):
     if request.accept_mimetypes.quality("application/json") <= 0:
         raise NotAcceptable()
 
-    result = dict()
-    for u_id, tasks in Scoring.store._scores.iteritems():
-        for t_id, score in tasks.iteritems():
-            if score.get_score() > 0.0:
-                result.setdefault(u_id, dict())[t_id] = score.get_score()
+    score_cache.history.serve(request, response)
+
+
+def ScoreHandler(request, response, score_cache):
+    if request.accept_mimetypes.quality("application/json") <= 0:
+        raise NotAcceptable()
 
-    response.status_code = 200
     response.headers[b'Timestamp'] = b"%0.6f" % time.time()
-    response.mimetype = "application/json"
-    response.data = json.dumps(result)
+    score_cache.scores.serve(request, response)
 
 
 class ImageHandler(object):
@@ -375,22 +644,129 @@ class ImageHandler(object):
             path = self.fallback
             mimetype = 'image/png'  # FIXME Hardcoded type.
 
+        stat = os.stat(path)
         response.status_code = 200
         response.mimetype = mimetype
         response.last_modified = \
-            datetime.utcfromtimestamp(os.path.getmtime(path))\
-                    .replace(microsecond=0)
-
-        # TODO check for If-Modified-Since and If-None-Match
+            datetime.utcfromtimestamp(stat.st_mtime).replace(microsecond=0)
+        response.set_etag("%x-%x-%x" % (int(stat.st_mtime), stat.st_size,
+                                        zlib.crc32(path.encode('utf-8'))
+                                        & 0xffffffff))
+        response.cache_control.public = True
+        response.cache_control.max_age = config.image_max_age
+        response.vary.add("Accept")
 
         response.response = wrap_file(environ, io.open(path, 'rb'))
         response.direct_passthrough = True
 
-        return response
+        return response.make_conditional(request)
+
+
+class StaticHandler(object):
+    """Serve the files of a directory, falling back on an application.
+
+    Files are kept in memory, with their gzipped version when it's
+    useful, and served with strong ETags (derived from their content)
+    and Cache-Control headers. Changes on disk are detected by looking
+    at the modification time and the size of the file.
+
+    """
+    COMPRESSIBLE_TYPES = ["application/javascript", "application/json",
+                          "application/x-javascript", "image/svg+xml"]
+
+    def __init__(self, app, directory):
+        """Create the handler.
+
+        app (function): the WSGI application to call for the requests
+            that don't match a file.
+        directory (string): the directory to serve.
+
+        """
+        self.app = app
+        self.directory = os.path.abspath(directory)
+        # The cached files, as tuples (mtime, size, mimetype, etag,
+        # body, gzipped body or None), by path.
+        self._cache = dict()
+
+    def __call__(self, environ, start_response):
+        return self.wsgi_app(environ, start_response)
+
+    def _load(self, path, stat):
+        """Read a file and store it in the cache.
+
+        path (string): the path of the file.
+        stat (posix.stat_result): the result of stat on the file.
+
+        return (tuple): the cache entry.
+
+        """
+        with io.open(path, 'rb') as f:
+            body = f.read()
+        mimetype = mimetypes.guess_type(path)[0] or \
+            "application/octet-stream"
+        etag = hashlib.sha1(body).hexdigest()[:20]
+        gzipped = None
+        if mimetype.startswith("text/") or \
+                mimetype in self.COMPRESSIBLE_TYPES:
+            compressor = zlib.compressobj(9, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            gzipped = compressor.compress(body) + compressor.flush()
+            if len(gzipped) >= len(body):
+                gzipped = None
+        entry = (stat.st_mtime, stat.st_size, mimetype, etag, body, gzipped)
+        self._cache[path] = entry
+        return entry
+
+    def wsgi_app(self, environ, start_response):
+        request = Request(environ)
+        request.encoding_errors = "strict"
+
+        if request.method not in ("GET", "HEAD"):
+            return self.app(environ, start_response)
+
+        path = os.path.normpath(
+            os.path.join(self.directory, request.path.lstrip("/")))
+        if not path.startswith(self.directory + os.sep):
+            return self.app(environ, start_response)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return self.app(environ, start_response)
+        if not os.path.isfile(path):
+            return self.app(environ, start_response)
+
+        entry = self._cache.get(path)
+        if entry is None or (entry[0], entry[1]) != \
+                (stat.st_mtime, stat.st_size):
+            try:
+                entry = self._load(path, stat)
+            except IOError:
+                return NotFound()(environ, start_response)
+        _, _, mimetype, etag, body, gzipped = entry
+
+        response = Response()
+        response.status_code = 200
+        response.mimetype = mimetype
+        response.last_modified = \
+            datetime.utcfromtimestamp(stat.st_mtime).replace(microsecond=0)
+        response.cache_control.public = True
+        response.cache_control.max_age = config.static_max_age
+        if gzipped is not None:
+            response.vary.add("Accept-Encoding")
+        if gzipped is not None and \
+                request.accept_encodings.quality("gzip") > 0:
+            response.set_etag(etag + "-gzip")
+            response.content_encoding = "gzip"
+            response.data = gzipped
+        else:
+            response.set_etag(etag)
+            response.data = body
+
+        return response.make_conditional(request)(environ, start_response)
 
 
 class RoutingHandler(object):
-    def __init__(self, event_handler, logo_handler):
+    def __init__(self, event_handler, logo_handler, score_cache):
         self.router = Map(
             [Rule("/", methods=["GET"], endpoint="root"),
              Rule("/sublist/<user_id>", methods=["GET"], endpoint="sublist"),
@@ -402,6 +778,7 @@ class RoutingHandler(object):
 
         self.event_handler = event_handler
         self.logo_handler = logo_handler
+        self.score_cache = score_cache
         self.root_handler = redirect("Ranking.html")
 
     def __call__(self, environ, start_response):
@@ -426,12 +803,16 @@ class RoutingHandler(object):
 
             response = Response()
 
-            if endpoint == "sublist":
-                SubListHandler(request, response, args["user_id"])
-            elif endpoint == "scores":
-                ScoreHandler(request, response)
-            elif endpoint == "history":
-                HistoryHandler(request, response)
+            try:
+                if endpoint == "sublist":
+                    SubListHandler(request, response, args["user_id"],
+                                   self.score_cache)
+                elif endpoint == "scores":
+                    ScoreHandler(request, response, self.score_cache)
+                elif endpoint == "history":
+                    HistoryHandler(request, response, self.score_cache)
+            except HTTPException as exc:
+                return exc(environ, start_response)
 
             return response(environ, start_response)
 
@@ -459,25 +840,28 @@ def main():
             print("Not removing directory %s." % config.lib_dir)
         return False
 
+    read_only = config.primary_url is not None
+
     toplevel_handler = RoutingHandler(DataWatcher(), ImageHandler(
         os.path.join(config.lib_dir, '%(name)s'),
-        os.path.join(config.web_dir, 'img', 'logo.png')))
+        os.path.join(config.web_dir, 'img', 'logo.png')), ScoreCache())
 
-    wsgi_app = SharedDataMiddleware(DispatcherMiddleware(
+    wsgi_app = StaticHandler(DispatcherMiddleware(
         toplevel_handler,
-        {'/contests': StoreHandler(Contest.store),
-         '/tasks': StoreHandler(Task.store),
-         '/teams': StoreHandler(Team.store),
-         '/users': StoreHandler(User.store),
-         '/submissions': StoreHandler(Submission.store),
-         '/subchanges': StoreHandler(Subchange.store),
+        {'/contests': StoreHandler(Contest.store, read_only),
+         '/tasks': StoreHandler(Task.store, read_only),
+         '/teams': StoreHandler(Team.store, read_only),
+         '/users': StoreHandler(User.store, read_only),
+         '/submissions': StoreHandler(Submission.store, read_only),
+         '/subchanges': StoreHandler(Subchange.store, read_only),
          '/faces': ImageHandler(
              os.path.join(config.lib_dir, 'faces', '%(name)s'),
              os.path.join(config.web_dir, 'img', 'face.png')),
          '/flags': ImageHandler(
              os.path.join(config.lib_dir, 'flags', '%(name)s'),
              os.path.join(config.web_dir, 'img', 'flag.png')),
-         }), {'/': config.web_dir})
+         '/replication': ReplicationFeed(),
+         }), config.web_dir)
 
     servers = list()
     if config.http_port is not None:
@@ -490,10 +874,22 @@ def main():
             certfile=config.https_certfile, keyfile=config.https_keyfile)
         servers.append(https_server)
 
+    replica = None
+    if read_only:
+        logger.info("Replicating the RWS at %s.",
+                    urlsplit(config.primary_url).hostname)
+        replica = gevent.spawn(Replication.Replica(
+            config.primary_url, config.primary_certfile).run)
+
     try:
         gevent.joinall(list(gevent.spawn(s.serve_forever) for s in servers))
     except KeyboardInterrupt:
         pass
     finally:
+        if replica is not None:
+            replica.kill()
         gevent.joinall(list(gevent.spawn(s.stop) for s in servers))
+        for store in (Contest.store, Task.store, Team.store, User.store,
+                      Submission.store, Subchange.store):
+            store.flush()
     return True
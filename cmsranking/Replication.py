@@ -0,0 +1,277 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+# Copyright © 2014 Luca Wehrstedt <luca.wehrstedt@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Replication of the data of a RWS on other, read-only, RWSs.
+
+The primary RWS (the one ScoringService sends data to) publishes all
+the changes to its stores on an ordered feed, served as an event
+stream, and a snapshot of all its data, tagged with the event ID of
+the last change it includes. A replica downloads the snapshot, then
+follows the feed from that event ID on, applying each change to its
+own stores (so that everything built on them, i.e. scores, histories
+and the events sent to spectators, works as on the primary). If it
+falls so much behind that the primary doesn't have the changes it
+missed any longer, it's told to reinitialize and it downloads a new
+snapshot.
+
+The event IDs (called sequence numbers here) aren't a counter: they
+are the keys of cmscommon.eventsource.Publisher, i.e. the time the
+change was published, in microseconds since the epoch (in hex), kept
+strictly increasing. Hence the IDs of a previous run of the primary
+are older than all the ones it still has in cache, and a replica that
+was following it is told to reinitialize, instead of being given the
+changes after an unrelated position of a new counter. An ID greater
+than the last one published (e.g., if the clock of the primary went
+back between two runs) also causes a reinitialization.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import logging
+from urlparse import urljoin, urlsplit
+
+import gevent
+import requests
+import requests.exceptions
+
+from cmsranking.Entity import InvalidData, InvalidKey
+import cmsranking.Contest as Contest
+import cmsranking.Task as Task
+import cmsranking.Team as Team
+import cmsranking.User as User
+import cmsranking.Submission as Submission
+import cmsranking.Subchange as Subchange
+
+
+logger = logging.getLogger(__name__)
+
+
+# The stores that are replicated, by name, in an order such that each
+# store comes after the ones its entities refer to.
+STORES = [
+    ("contests", Contest.store),
+    ("tasks", Task.store),
+    ("teams", Team.store),
+    ("users", User.store),
+    ("submissions", Submission.store),
+    ("subchanges", Subchange.store),
+    ]
+
+
+def get_snapshot():
+    """Return all the data of the replicated stores.
+
+    return ({unicode: {unicode: dict}}): the data of the entities, by
+        key, by name of the store.
+
+    """
+    return dict((name, store.retrieve_list()) for name, store in STORES)
+
+
+def apply_snapshot(snapshot):
+    """Make the stores hold exactly the data of a snapshot.
+
+    Only the entities that are missing or different are touched, to
+    spare the work of the callbacks.
+
+    snapshot ({unicode: {unicode: dict}}): as returned by get_snapshot.
+
+    raise (InvalidData): if the snapshot isn't valid.
+
+    """
+    if not isinstance(snapshot, dict):
+        raise InvalidData("Not a dictionary")
+    # Delete the dependent entities first (deleting the ones they
+    # depend on would delete them anyway).
+    for name, store in reversed(STORES):
+        data = snapshot.get(name, dict())
+        for key in list(store._store.iterkeys()):
+            if key not in data and key in store:
+                store.delete(key)
+    for name, store in STORES:
+        data = snapshot.get(name, dict())
+        store.merge_list(dict(
+            (key, value) for key, value in data.iteritems()
+            if key not in store or store.retrieve(key) != value))
+
+
+def apply_change(change):
+    """Apply to the stores a change received from the feed.
+
+    change (dict): the change, with the name of the store, the key of
+        the entity and its new data (None if it has been deleted).
+
+    raise (InvalidData): if the change isn't valid.
+    raise (InvalidKey): if the change can't be applied to the stores.
+
+    """
+    try:
+        store = dict(STORES)[change["store"]]
+        key = change["key"]
+        data = change["data"]
+    except (TypeError, KeyError):
+        raise InvalidData("Malformed change")
+    if data is None:
+        # A deletion may have been already done by the one of an
+        # entity this one depended on.
+        if key in store:
+            store.delete(key)
+    elif key not in store:
+        store.create(key, data)
+    else:
+        store.update(key, data)
+
+
+class Replica(object):
+    """Keep the stores in sync with the ones of a primary RWS.
+
+    """
+    # Seconds to wait before trying again after an error.
+    RETRY_DELAY = 5
+    # Seconds of silence after which the connection is considered
+    # lost (the primary pings the feed every 15 seconds).
+    READ_TIMEOUT = 60
+
+    def __init__(self, url, certfile=None):
+        """Create a replica.
+
+        url (unicode): the URL of the primary RWS, in the same form
+            ScoringService uses, i.e. including the credentials.
+        certfile (unicode|None): the certificate to verify the
+            primary with, if it uses HTTPS.
+
+        """
+        self._url = url
+        # XXX With requests-1.2 auth is automatically extracted from
+        # the URL: there is no need for this.
+        auth = urlsplit(url)
+        self._auth = (auth.username, auth.password)
+        self._verify = certfile if certfile is not None else True
+        self._session = requests.Session()
+
+    def _get(self, resource, **kwargs):
+        """Send a GET request to the primary.
+
+        resource (unicode): the path, relative to the URL.
+
+        return (requests.Response): the (successful) response.
+
+        raise (requests.exceptions.RequestException): in case of
+            communication errors.
+
+        """
+        res = self._session.get(urljoin(self._url, resource),
+                                auth=self._auth, verify=self._verify,
+                                timeout=self.READ_TIMEOUT, **kwargs)
+        res.raise_for_status()
+        return res
+
+    def synchronize(self):
+        """Download a snapshot from the primary and apply it.
+
+        return (unicode): the sequence number of the snapshot.
+
+        """
+        data = self._get("replication/snapshot",
+                         headers={"Accept": "application/json"}).json()
+        try:
+            sequence = data["sequence"]
+            snapshot = data["stores"]
+        except (TypeError, KeyError):
+            raise InvalidData("Malformed snapshot")
+        apply_snapshot(snapshot)
+        logger.info("Synchronized with the primary at %s.", sequence)
+        return sequence
+
+    def follow(self, sequence):
+        """Apply the changes of the feed until the connection ends.
+
+        sequence (unicode): the sequence number after which to start.
+
+        return (unicode|None): the sequence number of the last change
+            applied, or None if some changes were lost and a new
+            snapshot is needed.
+
+        """
+        res = self._get("replication/events", stream=True,
+                        headers={"Accept": "text/event-stream",
+                                 "Last-Event-ID": sequence})
+        event_id = event = None
+        data = list()
+        for line in res.iter_lines(chunk_size=None):
+            line = line.decode('utf-8')
+            if line == "":
+                # Dispatch the event.
+                if event == "reinit":
+                    res.close()
+                    return None
+                if event == "change":
+                    apply_change(json.loads("\n".join(data)))
+                if event_id is not None:
+                    sequence = event_id
+                event_id = event = None
+                data = list()
+            elif line.startswith(":"):
+                # A comment, used to keep the connection alive.
+                pass
+            else:
+                field, _, value = line.partition(":")
+                if value.startswith(" "):
+                    value = value[1:]
+                if field == "id":
+                    event_id = value
+                elif field == "event":
+                    event = value
+                elif field == "data":
+                    data.append(value)
+        return sequence
+
+    def run(self):
+        """Keep following the primary, forever.
+
+        """
+        sequence = None
+        while True:
+            try:
+                if sequence is None:
+                    sequence = self.synchronize()
+                sequence = self.follow(sequence)
+                if sequence is None:
+                    logger.warning("Missed some changes of the primary, "
+                                   "synchronizing again.")
+            except requests.exceptions.RequestException as error:
+                logger.warning("%s while following the primary: %s.",
+                               type(error).__name__, error)
+                gevent.sleep(self.RETRY_DELAY)
+            except (ValueError, InvalidData, InvalidKey) as error:
+                # ValueError also covers JSON decoding errors.
+                logger.error("Invalid data from the primary, "
+                             "synchronizing again: %s.", error)
+                sequence = None
+                gevent.sleep(self.RETRY_DELAY)
+            except Exception:
+                # Don't let the replica stop following the primary.
+                logger.error("Unexpected error while following the "
+                             "primary, synchronizing again.", exc_info=True)
+                sequence = None
+                gevent.sleep(self.RETRY_DELAY)
@@ -21,6 +21,7 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import bisect
 import heapq
 import logging
 
@@ -35,30 +36,67 @@ class NumberSet(object):
     """A fast data structure on numbers.
 
     It supports:
-    - inserting a value
-    - removing a value
-    - querying the maximum value
+    - inserting a value (in O(log n) time)
+    - removing a value (in amortized O(log n) time)
+    - querying the maximum value (in O(1) time)
 
     It can hold the same value multiple times.
 
-    This data structure could be implemented with a binary tree, but
-    at the moment we're actually using a standard python list.
+    It's implemented as a binary heap (of the opposites of the values,
+    as heapq is a min-heap) with lazy deletion: removed values stay in
+    the heap until they reach its top, or until they are so many that
+    it's worth rebuilding it.
 
     """
     def __init__(self):
-        self._impl = list()
+        # The opposites of the values, including the removed ones.
+        self._heap = list()
+        # How many times each value is in the set.
+        self._count = dict()
+        # How many times each removed value is still in the heap.
+        self._removed = dict()
+        self._removed_total = 0
 
     def insert(self, val):
-        self._impl.append(val)
+        heapq.heappush(self._heap, -val)
+        self._count[val] = self._count.get(val, 0) + 1
 
     def remove(self, val):
-        self._impl.remove(val)
+        if self._count.get(val, 0) == 0:
+            raise ValueError("NumberSet.remove(x): x not in set")
+        self._count[val] -= 1
+        if self._count[val] == 0:
+            del self._count[val]
+        self._removed[val] = self._removed.get(val, 0) + 1
+        self._removed_total += 1
+
+        if 2 * self._removed_total > len(self._heap):
+            # Most of the heap is garbage: rebuild it.
+            self._heap = [-value for value, count in self._count.iteritems()
+                          for _ in xrange(count)]
+            heapq.heapify(self._heap)
+            self._removed.clear()
+            self._removed_total = 0
+        else:
+            # Keep a valid value on top.
+            while len(self._heap) > 0 and \
+                    self._removed.get(-self._heap[0], 0) > 0:
+                top = -heapq.heappop(self._heap)
+                self._removed[top] -= 1
+                if self._removed[top] == 0:
+                    del self._removed[top]
+                self._removed_total -= 1
 
     def query(self):
-        return max(self._impl + [0.0])
+        if len(self._heap) == 0:
+            return 0.0
+        return max(-self._heap[0], 0.0)
 
     def clear(self):
-        del self._impl[:]
+        del self._heap[:]
+        self._count.clear()
+        self._removed.clear()
+        self._removed_total = 0
 
 
 class Score(object):
@@ -68,7 +106,15 @@ class Score(object):
     user/task.  It gets notified in case a submission is created,
     updated and deleted.
 
+    When a change doesn't happen at the end of the history, only the
+    part of the history after it is recomputed: every CHECKPOINT_STEP
+    changes we store the state of the submissions, so that we can
+    restart from the last checkpoint preceding the change.
+
     """
+    # Number of changes between two consecutive checkpoints.
+    CHECKPOINT_STEP = 32
+
     # We assume that the submissions will all have different times,
     # since cms enforces a minimum delay between two submissions of
     # the same user for the same task.
@@ -80,8 +126,19 @@ class Score(object):
         # The submissions in their current status.
         self._submissions = dict()
 
-        # The list of changes of the submissions.
+        # The list of changes of the submissions, sorted by time and
+        # key, and the list of their (time, key) pairs, to bisect it.
         self._changes = list()
+        self._change_keys = list()
+        # The time of each change, by key.
+        self._change_times = dict()
+
+        # The i-th checkpoint is the state before the change in
+        # position i * CHECKPOINT_STEP was applied: a tuple with the
+        # status of the submissions (score, token and extra, by key),
+        # the key of the last submission and the length of the
+        # history.
+        self._checkpoints = list()
 
         # The set of the scores of the currently released submissions.
         self._released = NumberSet()
@@ -123,39 +180,92 @@ class Score(object):
     def get_score(self):
         return self._history[-1][1] if len(self._history) > 0 else 0.0
 
-    def reset_history(self):
-        # Delete everything except the submissions and the subchanges.
-        self._last = None
-        self._released.clear()
-        del self._history[:]
+    def _apply(self, idx):
+        """Apply the change in position idx, checkpointing if needed.
+
+        idx (int): the position of the change; all the previous ones
+            have to be already applied.
+
+        """
+        if idx % self.CHECKPOINT_STEP == 0:
+            self._checkpoints.append((
+                dict((key, (sub.score, sub.token, sub.extra))
+                     for key, sub in self._submissions.iteritems()),
+                self._last.key if self._last is not None else None,
+                len(self._history)))
+        self.append_change(self._changes[idx])
+
+    def _replay_from(self, idx):
+        """Recompute the history from the change in position idx.
+
+        Restore the state of the last checkpoint before idx and apply
+        again all the changes after it.
 
-        # Reset the submissions at their default value.
-        for sub in self._submissions.itervalues():
-            sub.score = 0.0
-            sub.token = False
-            sub.extra = list()
+        idx (int): the position of the first change that differs from
+            the last time the history was computed.
+
+        """
+        # Checkpoints after idx are no longer valid.
+        del self._checkpoints[idx // self.CHECKPOINT_STEP + 1:]
+
+        if len(self._checkpoints) > 0:
+            states, last, history_len = self._checkpoints.pop()
+        else:
+            states, last, history_len = dict(), None, 0
+
+        # Restore the submissions at the status they had then.
+        self._released.clear()
+        for key, sub in self._submissions.iteritems():
+            sub.score, sub.token, sub.extra = \
+                states.get(key, (0.0, False, list()))
+            if sub.token:
+                self._released.insert(sub.score)
+        self._last = self._submissions.get(last)
+        del self._history[history_len:]
 
         # Append each change, one at a time.
-        for change in self._changes:
-            self.append_change(change)
+        for i in xrange(len(self._checkpoints) * self.CHECKPOINT_STEP,
+                        len(self._changes)):
+            self._apply(i)
+
+    def reset_history(self):
+        # Recompute everything, keeping only the submissions and the
+        # subchanges.
+        self._replay_from(0)
+
+    def _insert_change(self, key, subchange):
+        """Insert a subchange at its position in the sorted list.
+
+        return (int): its position.
+
+        """
+        idx = bisect.bisect(self._change_keys, (subchange.time, key))
+        self._changes.insert(idx, subchange)
+        self._change_keys.insert(idx, (subchange.time, key))
+        self._change_times[key] = subchange.time
+        return idx
+
+    def _remove_change(self, key):
+        """Remove a subchange from the sorted list.
+
+        return (int): the position it had.
+
+        """
+        idx = bisect.bisect_left(self._change_keys,
+                                 (self._change_times.pop(key), key))
+        del self._changes[idx]
+        del self._change_keys[idx]
+        return idx
 
     def create_subchange(self, key, subchange):
         # Insert the subchange at the right position inside the
-        # (sorted) list and call the appropriate method (append_change
-        # or reset_history)
-        if len(self._changes) == 0 or \
-                subchange.time > self._changes[-1].time or \
-                (subchange.time == self._changes[-1].time and
-                 subchange.key > self._changes[-1].key):
-            self._changes.append(subchange)
-            self.append_change(subchange)
+        # (sorted) list and apply it or, if it's not the last one,
+        # recompute the history from it.
+        idx = self._insert_change(key, subchange)
+        if idx == len(self._changes) - 1:
+            self._apply(idx)
         else:
-            for idx, val in enumerate(self._changes):
-                if subchange.time < val.time or \
-                   (subchange.time == val.time and subchange.key < val.key):
-                    self._changes.insert(idx, subchange)
-                    break
-            self.reset_history()
+            self._replay_from(idx)
             logger.info("Reset history for user '%s' and task '%s' after "
                         "creating subchange '%s' for submission '%s'" %
                         (self._submissions[subchange.submission].user,
@@ -163,23 +273,33 @@ class Score(object):
                          key, subchange.submission))
 
     def update_subchange(self, key, subchange):
-        # Update the subchange inside the (sorted) list and,
-        # regardless of its position in that list, reset the history.
-        for i in range(len(self._changes)):
-            if self._changes[i].key == key:
-                self._changes[i] = subchange
-        self.reset_history()
+        # Move the subchange to its new position inside the (sorted)
+        # list and recompute the history from the first of the two
+        # positions. Nothing needs to be done if it didn't change, as
+        # it happens when data is sent again to us.
+        old_idx = bisect.bisect_left(self._change_keys,
+                                     (self._change_times[key], key))
+        old = self._changes[old_idx]
+        if (old.submission, old.time, old.score, old.token, old.extra) == \
+                (subchange.submission, subchange.time, subchange.score,
+                 subchange.token, subchange.extra):
+            self._changes[old_idx] = subchange
+            return
+
+        self._remove_change(key)
+        idx = self._insert_change(key, subchange)
+        self._replay_from(min(old_idx, idx))
         logger.info("Reset history for user '%s' and task '%s' after "
-                    "creating subchange '%s' for submission '%s'" %
+                    "updating subchange '%s' for submission '%s'" %
                     (self._submissions[subchange.submission].user,
                      self._submissions[subchange.submission].task,
                      key, subchange.submission))
 
     def delete_subchange(self, key):
-        # Delete the subchange from the (sorted) list and reset the
-        # history.
-        self._changes = filter(lambda a: a.key != key, self._changes)
-        self.reset_history()
+        # Delete the subchange from the (sorted) list and recompute
+        # the history from its position.
+        idx = self._remove_change(key)
+        self._replay_from(idx)
         logger.info("Reset history after deleting subchange '%s'" % key)
 
     def create_submission(self, key, submission):
@@ -193,9 +313,18 @@ class Score(object):
     def update_submission(self, key, submission):
         # An updated submission may cause an update in history because
         # it may change the "last" submission at some point in
-        # history.
+        # history. If its time didn't change it cannot, and we just
+        # need to carry its status over.
+        old_submission = self._submissions[key]
         self._submissions[key] = submission
-        self.reset_history()
+        if old_submission.time == submission.time:
+            submission.score = old_submission.score
+            submission.token = old_submission.token
+            submission.extra = old_submission.extra
+            if self._last is old_submission:
+                self._last = submission
+        else:
+            self.reset_history()
 
     def delete_submission(self, key):
         # A deleted submission shouldn't cause any history changes
@@ -204,9 +333,11 @@ class Score(object):
         if key in self._submissions:
             del self._submissions[key]
             # Delete all its subchanges.
-            self._changes = filter(lambda a: a.submission != key,
-                                   self._changes)
-            self.reset_history()
+            idx = len(self._changes)
+            for change_key in [change.key for change in self._changes
+                               if change.submission == key]:
+                idx = min(idx, self._remove_change(change_key))
+            self._replay_from(idx)
 
 
 class ScoringStore(object):
@@ -240,7 +371,10 @@ class ScoringStore(object):
 
         for key, value in submission_store._store.iteritems():
             self.create_submission(key, value)
-        for key, value in sorted(subchange_store._store.iteritems()):
+        # Sorting them by time (as the Score objects do) makes each
+        # of them be appended at the end of the history.
+        for key, value in sorted(subchange_store._store.iteritems(),
+                                 key=lambda item: (item[1].time, item[0])):
             self.create_subchange(key, value)
 
     def add_score_callback(self, callback):
@@ -27,6 +27,7 @@ import logging
 import os
 import re
 
+import gevent
 from gevent.lock import RLock
 
 from cmsranking.Config import config
@@ -50,7 +51,23 @@ class Store(object):
     get notified when something changes by providing appropriate
     callbacks.
 
+    The entities are persisted in a snapshot (a JSON object holding
+    all of them) and in a log of the changes made after it (a JSON
+    object per line, with the key and, unless it is a deletion, the
+    data of the entity). Changes are appended to the log in batches,
+    at most FLUSH_DELAY seconds after they happen, and the log is
+    compacted in a new snapshot when it grows larger than the store.
+
     """
+    # Seconds to wait, after a change, before writing it (and all
+    # the others made in the meantime) to the log.
+    FLUSH_DELAY = 0.5
+    # Minimum number of records in the log to consider compacting it.
+    COMPACT_MIN_RECORDS = 1000
+
+    SNAPSHOT_NAME = "store.snapshot"
+    LOG_NAME = "store.log"
+
     def __init__(self, entity, dir_name, depends=None):
         """Initialize an empty EntityStore.
 
@@ -78,6 +95,88 @@ class Store(object):
             # it's ok: it means the directory already exists
             pass
 
+        # The records not yet written to the log, the number of
+        # records in it and whether a flush is already scheduled.
+        self._pending = list()
+        self._log_records = 0
+        self._flush_scheduled = False
+
+        self._snapshot_path = os.path.join(self._path, self.SNAPSHOT_NAME)
+        self._log_path = os.path.join(self._path, self.LOG_NAME)
+
+        if os.path.exists(self._snapshot_path) or \
+                os.path.exists(self._log_path):
+            self._load()
+        else:
+            self._load_legacy()
+        # Start from a compacted state.
+        if self._log_records > 0 or not os.path.exists(self._snapshot_path):
+            self._compact()
+
+    def _load_item(self, key, data):
+        """Put an entity read from the persistent storage in the store.
+
+        key (unicode): the key of the entity.
+        data (dict): the properties of the entity.
+
+        """
+        try:
+            item = self._entity()
+            item.set(data)
+            item.key = key
+            self._store[key] = item
+        except InvalidData as exc:
+            logger.error(exc.message, exc_info=False,
+                         extra={'location': "%s (%s)" % (self._path, key)})
+
+    def _load(self):
+        """Load the entities from the snapshot and the log.
+
+        """
+        try:
+            if os.path.exists(self._snapshot_path):
+                with io.open(self._snapshot_path, 'rb') as snapshot:
+                    for key, data in json.load(
+                            snapshot, encoding='utf-8').iteritems():
+                        self._load_item(key, data)
+        except (IOError, ValueError):
+            # Keep it aside, as we'll write a new one.
+            logger.error("Unable to load snapshot, moving it away",
+                         exc_info=True,
+                         extra={'location': self._snapshot_path})
+            try:
+                os.rename(self._snapshot_path,
+                          self._snapshot_path + ".invalid")
+            except OSError:
+                pass
+
+        try:
+            if os.path.exists(self._log_path):
+                with io.open(self._log_path, 'rb') as log:
+                    for line in log:
+                        try:
+                            record = json.loads(line, encoding='utf-8')
+                        except ValueError:
+                            # The last write may have been interrupted.
+                            logger.warning(
+                                "Invalid record in log, ignoring it.",
+                                extra={'location': self._log_path})
+                            continue
+                        self._log_records += 1
+                        if "data" in record:
+                            self._load_item(record["key"], record["data"])
+                        else:
+                            self._store.pop(record["key"], None)
+        except IOError:
+            logger.error("I/O error occured", exc_info=True)
+
+    def _load_legacy(self):
+        """Load the entities from the old format, a file per entity.
+
+        They will be written in a snapshot, after which the files are
+        ignored (and can be removed).
+
+        """
         try:
             for name in os.listdir(self._path):
                 # TODO check that the key is '[A-Za-z0-9_]+'
@@ -100,6 +199,71 @@ class Store(object):
             logger.error(exc.message, exc_info=False,
                          extra={'location': os.path.join(self._path, name)})
 
+    def _persist(self, key, item):
+        """Record a change, to be written at the next flush.
+
+        key (unicode): the key of the entity that changed.
+        item (Entity|None): its new value, or None if it was deleted.
+
+        """
+        if item is not None:
+            self._pending.append({"key": key, "data": item.get()})
+        else:
+            self._pending.append({"key": key})
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            gevent.spawn_later(self.FLUSH_DELAY, self.flush)
+
+    def flush(self):
+        """Write all the pending changes to the persistent storage.
+
+        They are appended to the log with a single write, and the log
+        is compacted if it became too large.
+
+        """
+        with LOCK:
+            self._flush_scheduled = False
+            if len(self._pending) == 0:
+                return
+            pending, self._pending = self._pending, list()
+            try:
+                with io.open(self._log_path, 'ab') as log:
+                    log.write(b"".join(
+                        json.dumps(record, encoding='utf-8') + b"\n"
+                        for record in pending))
+                    log.flush()
+                    os.fsync(log.fileno())
+                self._log_records += len(pending)
+            except IOError:
+                logger.error("I/O error occured while writing changes",
+                             exc_info=True)
+
+            if self._log_records >= self.COMPACT_MIN_RECORDS and \
+                    self._log_records > len(self._store):
+                self._compact()
+
+    def _compact(self):
+        """Write all the entities in a new snapshot and empty the log.
+
+        """
+        with LOCK:
+            tmp_path = self._snapshot_path + ".tmp"
+            try:
+                with io.open(tmp_path, 'wb') as snapshot:
+                    json.dump(dict((key, value.get())
+                                   for key, value in self._store.iteritems()),
+                              snapshot, encoding='utf-8')
+                    snapshot.flush()
+                    os.fsync(snapshot.fileno())
+                os.rename(tmp_path, self._snapshot_path)
+                # Replaying the old log on the new snapshot would be
+                # harmless, in case we crash before truncating it.
+                io.open(self._log_path, 'wb').close()
+                self._log_records = 0
+            except (IOError, OSError):
+                logger.error("I/O error occured while writing snapshot",
+                             exc_info=True)
+
     def add_create_callback(self, callback):
         """Add a callback to be called when entities are created.
 
@@ -157,13 +321,7 @@ class Store(object):
             for callback in self._create_callbacks:
                 callback(key, item)
             # reflect changes on the persistent storage
-            try:
-                path = os.path.join(self._path, key + '.json')
-                with io.open(path, 'wb') as rec:
-                    json.dump(self._store[key].get(), rec, encoding='utf-8')
-            except IOError:
-                logger.error("I/O error occured while creating entity",
-                             exc_info=True)
+            self._persist(key, item)
 
     def update(self, key, data):
         """Update an entity.
@@ -196,13 +354,7 @@ class Store(object):
             for callback in self._update_callbacks:
                 callback(key, old_item, item)
             # reflect changes on the persistent storage
-            try:
-                path = os.path.join(self._path, key + '.json')
-                with io.open(path, 'wb') as rec:
-                    json.dump(self._store[key].get(), rec, encoding='utf-8')
-            except IOError:
-                logger.error("I/O error occured while updating entity",
-                             exc_info=True)
+            self._persist(key, item)
 
     def merge_list(self, data_dict):
         """Merge a list of entities.
@@ -252,14 +404,7 @@ class Store(object):
                     for callback in self._update_callbacks:
                         callback(key, old_value, value)
                 # reflect changes on the persistent storage
-                try:
-                    path = os.path.join(self._path, key + '.json')
-                    with io.open(path, 'wb') as rec:
-                        json.dump(value.get(), rec, encoding='utf-8')
-                except IOError:
-                    logger.error(
-                        "I/O error occured while merging entity lists",
-                        exc_info=True)
+                self._persist(key, value)
 
     def delete(self, key):
         """Delete an entity.
@@ -288,10 +433,7 @@ class Store(object):
             for callback in self._delete_callbacks:
                 callback(key, old_value)
             # reflect changes on the persistent storage
-            try:
-                os.remove(os.path.join(self._path, key + '.json'))
-            except OSError:
-                logger.error("Unable to delete entity", exc_info=True)
+            self._persist(key, None)
 
     def delete_list(self):
         """Delete all entities.
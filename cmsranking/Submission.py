@@ -76,9 +76,11 @@ class Submission(Entity):
     def get(self):
         result = self.__dict__.copy()
         del result['key']
-        del result['score']
-        del result['token']
-        del result['extra']
+        # These are set by Scoring, that may not have seen it yet (e.g.
+        # when the store is compacted while being loaded).
+        result.pop('score', None)
+        result.pop('token', None)
+        result.pop('extra', None)
         return result
 
     def consistent(self):
@@ -26,9 +26,13 @@ from __future__ import unicode_literals
 
 import json
 import os
+import shutil
 import sys
 
+import gevent.pool
+
 from cmscontrib.YamlLoader import YamlLoader
+from cms import config
 from cms.db import Executable
 from cms.db.filecacher import FileCacher
 from cms.grading import format_status_text
@@ -40,14 +44,18 @@ from cms.grading.tasktypes import get_task_type
 task = None
 file_cacher = None
 
+# The persistent cache of the files, shared by all tasks.
+CACHE_PATH = os.path.join(config.cache_dir, "fs-cache-cmstaskenv")
+
 
 def usage():
-    print("""%s base_dir executable [assume]"
+    print("""%s base_dir executable [assume [jobs]]"
 base_dir:   directory of the task
 executable: solution to test (relative to the task's directory)
 language:   programming language the solution is written in
 assume:     if it's y, answer yes to every question
             if it's n, answer no to every question
+jobs:       number of testcases to evaluate at the same time
 """ % sys.argv[0])
 
 
@@ -63,20 +71,29 @@ def mem_human(mem):
     return "%4d" % mem
 
 
-def test_testcases(base_dir, soluzione, language, assume=None):
+def test_testcases(base_dir, soluzione, language, assume=None, jobs=1):
+    """Evaluate a solution on all the testcases of a task.
+
+    base_dir (unicode): directory of the task.
+    soluzione (unicode): solution to test, relative to base_dir.
+    language (unicode): programming language of the solution.
+    assume (unicode|None): the answer to give to every question, if
+        any ('y' or 'n').
+    jobs (int): number of testcases to evaluate at the same time.
+
+    return ([(float, unicode, unicode)]): the points, the comment and
+        the resource usage of each testcase.
+
+    """
     global task, file_cacher
 
     # Use a FileCacher with a NullBackend in order to avoid to fill
-    # the database with junk
+    # the database with junk, and with a persistent cache, so that the
+    # files of the task are read and copied only when they change
     if file_cacher is None:
-        file_cacher = FileCacher(null=True)
+        file_cacher = FileCacher(null=True, cache_path=CACHE_PATH)
 
     # Load the task
-    # TODO - This implies copying a lot of data to the FileCacher,
-    # which is annoying if you have to do it continuously; it would be
-    # better to use a persistent cache (although local, possibly
-    # filesystem-based instead of database-based) and somehow detect
-    # when the task has already been loaded
     if task is None:
         loader = YamlLoader(
             os.path.realpath(os.path.join(base_dir, "..")),
@@ -91,7 +108,7 @@ def test_testcases(base_dir, soluzione, language, assume=None):
         os.path.join(base_dir, soluzione),
         "Solution %s for task %s" % (soluzione, task.name))
     executables = {task.name: Executable(filename=task.name, digest=digest)}
-    jobs = [(t, EvaluationJob(
+    jobs_list = [(t, EvaluationJob(
         language=language,
         task_type=dataset.task_type,
         task_type_parameters=json.loads(dataset.task_type_parameters),
@@ -102,29 +119,37 @@ def test_testcases(base_dir, soluzione, language, assume=None):
         memory_limit=dataset.memory_limit)) for t in dataset.testcases]
     tasktype = get_task_type(dataset=dataset)
 
+    # Evaluate the testcases in parallel, but consider their outcomes
+    # in order, as if they were evaluated one after the other.
+    stop = False
+
+    def evaluate(jobinfo):
+        # Skip the testcase if we decided to consider everything to
+        # timeout
+        if not stop:
+            tasktype.evaluate(jobinfo[1], file_cacher)
+        return jobinfo
+
+    pool = gevent.pool.Pool(jobs)
     ask_again = True
     last_status = "ok"
     status = "ok"
-    stop = False
     info = []
     points = []
     comments = []
     tcnames = []
-    for jobinfo in sorted(jobs):
+    for jobinfo in pool.imap(evaluate, sorted(jobs_list)):
         print(jobinfo[0], end='')
         sys.stdout.flush()
         job = jobinfo[1]
-        # Skip the testcase if we decide to consider everything to
-        # timeout
         if stop:
             info.append("Time limit exceeded")
             points.append(0.0)
             comments.append("Timeout.")
             continue
 
-        # Evaluate testcase
+        # Collect the outcome of the testcase
         last_status = status
-        tasktype.evaluate(job, file_cacher)
         status = job.plus["exit_status"]
         info.append("Time: %5.3f   Wall: %5.3f   Memory: %s" %
                    (job.plus["execution_time"],
@@ -150,6 +175,8 @@ def test_testcases(base_dir, soluzione, language, assume=None):
             else:
                 ask_again = False
 
+    tasktype.cleanup()
+
     # Result pretty printing
     print()
     clen = max(len(c) for c in comments)
@@ -161,16 +188,26 @@ def test_testcases(base_dir, soluzione, language, assume=None):
 
 
 def clean_test_env():
-    """Clean the testing environment, mostly to reclaim disk space.
+    """Clean the testing environment.
+
+    The file cache is persistent, and it's kept for the next runs
+    (see clean_test_cache).
 
     """
-    # We're done: since we have no way to reuse this cache, we destroy
-    # it to free space. See the TODO above.
     global file_cacher, task
-    if file_cacher is not None:
-        file_cacher.destroy_cache()
-        file_cacher = None
-        task = None
+    file_cacher = None
+    task = None
+
+
+def clean_test_cache():
+    """Remove the persistent file cache of the testing environment.
+
+    It's shared by all tasks and it grows with each new version of
+    their files: the next test starts again with an empty one.
+
+    """
+    clean_test_env()
+    shutil.rmtree(CACHE_PATH, ignore_errors=True)
 
 if __name__ == "__main__":
     if len(sys.argv) < 4:
@@ -179,4 +216,9 @@ if __name__ == "__main__":
         assume = None
     else:
         assume = sys.argv[4]
-    test_testcases(sys.argv[1], sys.argv[2], sys.argv[3], assume=assume)
+    if len(sys.argv) <= 5:
+        jobs = 1
+    else:
+        jobs = int(sys.argv[5])
+    test_testcases(sys.argv[1], sys.argv[2], sys.argv[3], assume=assume,
+                   jobs=jobs)
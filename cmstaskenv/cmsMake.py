@@ -27,6 +27,7 @@ from __future__ import unicode_literals
 
 import argparse
 import io
+import multiprocessing
 import os
 import sys
 import subprocess
@@ -34,11 +35,13 @@ import copy
 import functools
 import shutil
 import tempfile
+import traceback
 import yaml
 
 from cms import utf8_decoder
 from cms.grading import get_compilation_commands
-from cmstaskenv.Test import test_testcases, clean_test_env
+from cmstaskenv.Test import test_testcases, clean_test_env, \
+    clean_test_cache
 
 
 SOL_DIRNAME = 'sol'
@@ -167,7 +170,16 @@ def noop():
     pass
 
 
-def build_sols_list(base_dir, task_type, in_out_files, yaml_conf):
+class InteractiveAction(functools.partial):
+    """An action that must be executed in the main process (e.g.,
+    because it asks questions to the user), and alone.
+
+    """
+    pass
+
+
+def build_sols_list(base_dir, task_type, in_out_files, yaml_conf,
+                    test_jobs=1):
     if yaml_conf.get('only_gen', False):
         return []
 
@@ -250,7 +262,8 @@ def build_sols_list(base_dir, task_type, in_out_files, yaml_conf):
                 base_dir,
                 exe,
                 language=lang,
-                assume=assume)
+                assume=assume,
+                jobs=test_jobs)
 
         actions.append(
             (srcs,
@@ -265,7 +278,7 @@ def build_sols_list(base_dir, task_type, in_out_files, yaml_conf):
 
         test_actions.append((test_deps,
                              ['test_%s' % (os.path.split(exe)[1])],
-                             functools.partial(test_src, exe_EVAL, lang),
+                             InteractiveAction(test_src, exe_EVAL, lang),
                              'test solution (compiled with -DEVAL)'))
 
     return actions + test_actions
@@ -436,7 +449,7 @@ def build_gen_list(base_dir, task_type):
     return actions, in_out_files
 
 
-def build_action_list(base_dir, task_type, yaml_conf):
+def build_action_list(base_dir, task_type, yaml_conf, test_jobs=1):
     """Build a list of actions that cmsMake is able to do here. Each
     action is described by a tuple (infiles, outfiles, callable,
     description) where:
@@ -454,11 +467,15 @@ def build_action_list(base_dir, task_type, yaml_conf):
     4) description is a human-readable description of what this
     action does.
 
+    test_jobs (int) is the number of testcases to evaluate at the
+    same time when testing a solution.
+
     """
     actions = []
     gen_actions, in_out_files = build_gen_list(base_dir, task_type)
     actions += gen_actions
-    actions += build_sols_list(base_dir, task_type, in_out_files, yaml_conf)
+    actions += build_sols_list(base_dir, task_type, in_out_files, yaml_conf,
+                               test_jobs=test_jobs)
     actions += build_checker_list(base_dir, task_type)
     actions += build_text_list(base_dir, task_type)
     return actions
@@ -580,13 +597,186 @@ def execute_target(base_dir, exec_tree, target,
 
 
 def execute_multiple_targets(base_dir, exec_tree, targets,
-                             debug=False, assume=None):
+                             debug=False, assume=None, jobs=1):
+    if jobs > 1:
+        execute_targets_in_parallel(base_dir, exec_tree, targets, jobs,
+                                    debug=debug, assume=assume)
+        return
     already_executed = set()
     for target in targets:
         execute_target(base_dir, exec_tree, target,
                        already_executed, debug=debug, assume=assume)
 
 
+# The execution tree, for the worker processes of
+# execute_targets_in_parallel (that get it by forking).
+_exec_tree = None
+
+
+def _execute_action(target, assume):
+    """Execute, in a worker process, the action of a target.
+
+    target (unicode): the target.
+    assume (unicode|None): the answer to give to every question.
+
+    return (unicode|None): None if the action was successful, a
+        description of the error otherwise.
+
+    """
+    try:
+        _exec_tree[target][1](assume=assume)
+    except SystemExit:
+        # Raised by call() when a command fails (it has already
+        # printed the error).
+        return "a command failed"
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+
+def execute_targets_in_parallel(base_dir, exec_tree, targets, jobs,
+                                debug=False, assume=None):
+    """Make the targets, as execute_multiple_targets does, but running
+    up to the given number of actions at the same time on a pool of
+    processes. An action is executed as soon as all its dependencies
+    are made, if one of the targets it's needed for is older than
+    them. If an action fails, the others being executed are
+    interrupted and no more are started.
+
+    Actions built from the same source files (e.g., a solution and
+    the same solution compiled with -DEVAL) are never executed at the
+    same time, as compilers may write the same intermediate files
+    next to the sources (e.g., fpc writes sol/X.o for both).
+
+    base_dir (unicode): the directory of the task.
+    exec_tree (dict): as returned by build_execution_tree().
+    targets ([unicode]): the targets to make.
+    jobs (int): the maximum number of actions to execute at the same
+        time.
+    debug (bool): whether to print debug messages.
+    assume (unicode|None): the answer to give to every question.
+
+    """
+    global _exec_tree
+
+    # Find the needed targets, grouped by the action that makes them,
+    # the dependencies of each action and the source files among them.
+    action_targets = {}
+    action_deps = {}
+    action_sources = {}
+    visited = set()
+
+    def visit(target, stack):
+        if target in stack:
+            raise Exception("Circular dependency detected")
+        if target in visited:
+            return
+        visited.add(target)
+        deps, action = exec_tree[target]
+        for dep in deps:
+            visit(dep, stack | set([target]))
+        action_targets.setdefault(action, []).append(target)
+        action_deps.setdefault(action, set()).update(
+            exec_tree[dep][1] for dep in deps)
+        action_sources.setdefault(action, set()).update(
+            dep for dep in deps if exec_tree[dep][1] is noop)
+
+    for target in targets:
+        visit(target, frozenset())
+    for action in action_deps:
+        action_deps[action].discard(action)
+
+    def needs_execution(action):
+        # As in execute_target, an action is needed if one of its
+        # targets is older than one of its dependencies.
+        for target in action_targets[action]:
+            deps = exec_tree[target][0]
+            dep_times = max([0] + map(lambda dep: os.stat(
+                os.path.join(base_dir, dep)).st_mtime, deps))
+            try:
+                gen_time = os.stat(os.path.join(base_dir, target)).st_mtime
+            except OSError:
+                gen_time = 0
+            if gen_time < dep_times:
+                return True
+        if debug:
+            print(">> Targets %s are already new enough, not building" %
+                  (", ".join(action_targets[action])))
+        return False
+
+    _exec_tree = exec_tree
+    pool = multiprocessing.Pool(jobs)
+    # The results of the actions being executed, by action.
+    running = {}
+    done = set()
+    failed = None
+    try:
+        while True:
+            # Start all the actions whose dependencies are made.
+            progress = True
+            while progress:
+                progress = False
+                for action in action_targets:
+                    if action in done or action in running or \
+                            not action_deps[action] <= done:
+                        continue
+                    if len(action_sources[action]) > 0 and any(
+                            action_sources[other] == action_sources[action]
+                            for other in running):
+                        continue
+                    if action is noop or not needs_execution(action):
+                        done.add(action)
+                        progress = True
+                    elif isinstance(action, InteractiveAction):
+                        if len(running) == 0:
+                            if debug:
+                                print(">> Actually building targets %s" %
+                                      (", ".join(action_targets[action])))
+                            action(assume=assume)
+                            done.add(action)
+                            progress = True
+                    else:
+                        if debug:
+                            print(">> Actually building targets %s" %
+                                  (", ".join(action_targets[action])))
+                        running[action] = pool.apply_async(
+                            _execute_action,
+                            (action_targets[action][0], assume))
+            if len(running) == 0:
+                break
+
+            # Wait for one of them to finish.
+            finished = None
+            while finished is None:
+                for action, result in running.iteritems():
+                    if result.ready():
+                        finished = action
+                        break
+                else:
+                    running.values()[0].wait(0.1)
+            error = running.pop(finished).get()
+            if error is not None:
+                failed = finished
+                print("Failed to build %s: %s" %
+                      (", ".join(action_targets[finished]), error),
+                      file=sys.stderr)
+                break
+            done.add(finished)
+            if debug:
+                print(">> Targets %s finished to build" %
+                      (", ".join(action_targets[finished])))
+    finally:
+        if len(running) > 0:
+            pool.terminate()
+        else:
+            pool.close()
+        pool.join()
+        _exec_tree = None
+
+    if failed is not None:
+        sys.exit(1)
+
+
 def main():
     # Parse command line options
     parser = argparse.ArgumentParser()
@@ -597,7 +787,8 @@ def main():
     parser.add_argument("-l", "--list", action="store_true", default=False,
                         help="list actions that cmsMake is aware of")
     parser.add_argument("-c", "--clean", action="store_true", default=False,
-                        help="clean all generated files")
+                        help="clean all generated files (and the cache "
+                        "of the files used by the tests)")
     parser.add_argument("-a", "--all", action="store_true", default=False,
                         help="make all targets")
     group.add_argument("-y", "--yes",
@@ -608,6 +799,12 @@ def main():
                        help="answer no to all questions")
     parser.add_argument("-d", "--debug", action="store_true", default=False,
                         help="enable debug messages")
+    parser.add_argument("-j", "--jobs", action="store", type=int, default=1,
+                        metavar="N", help="execute up to N actions at the "
+                        "same time (1 by default)")
+    parser.add_argument("--test-jobs", action="store", type=int, default=1,
+                        metavar="N", help="evaluate N testcases at the same "
+                        "time when testing solutions (1 by default)")
     parser.add_argument("targets", action="store", type=utf8_decoder,
                         nargs="*", metavar="target", help="target to build")
     options = parser.parse_args()
@@ -622,7 +819,8 @@ def main():
 
     task_type = detect_task_type(base_dir)
     yaml_conf = parse_task_yaml(base_dir)
-    actions = build_action_list(base_dir, task_type, yaml_conf)
+    actions = build_action_list(base_dir, task_type, yaml_conf,
+                                test_jobs=options.test_jobs)
     exec_tree, generated_list = build_execution_tree(actions)
 
     if [len(options.targets) > 0, options.list, options.clean,
@@ -640,13 +838,14 @@ def main():
     elif options.clean:
         print("Cleaning")
         clean(base_dir, generated_list)
+        clean_test_cache()
 
     elif options.all:
         print("Making all targets")
         try:
             execute_multiple_targets(base_dir, exec_tree,
                                      generated_list, debug=options.debug,
-                                     assume=assume)
+                                     assume=assume, jobs=options.jobs)
 
         # After all work, possibly clean the left-overs of testing
         finally:
@@ -656,7 +855,7 @@ def main():
         try:
             execute_multiple_targets(base_dir, exec_tree,
                                      options.targets, debug=options.debug,
-                                     assume=assume)
+                                     assume=assume, jobs=options.jobs)
 
         # After all work, possibly clean the left-overs of testing
         finally:
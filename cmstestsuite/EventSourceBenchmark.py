@@ -0,0 +1,103 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+# Copyright © 2014 Luca Wehrstedt <luca.wehrstedt@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measure how fast a Publisher delivers events to many subscribers.
+
+Simulate a crowd of spectators connected to RankingWebServer: each
+subscriber runs in its own greenlet, fetching batches of events as the
+EventSource handler does, while events are published in bursts (as it
+happens when ProxyService sends many scores at once). Report the time
+needed to deliver all events, and check that every subscriber received
+all of them.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import sys
+import time
+
+import gevent
+
+from cmscommon.eventsource import Publisher
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the publisher of the event streams.")
+    parser.add_argument("--subscribers", type=int, default=10000,
+                        help="number of simulated clients")
+    parser.add_argument("--bursts", type=int, default=100,
+                        help="number of bursts of events")
+    parser.add_argument("--events", type=int, default=100,
+                        help="number of events per burst")
+    parser.add_argument("--cache-size", type=int, default=10000,
+                        help="number of events kept by the publisher")
+    args = parser.parse_args()
+
+    total = args.bursts * args.events
+    publisher = Publisher(args.cache_size)
+    # The number of events received by each subscriber, and the last
+    # one of them.
+    received = [0] * args.subscribers
+    last = [None] * args.subscribers
+
+    def subscriber_loop(idx):
+        sub = publisher.get_subscriber()
+        while received[idx] < total:
+            msgs = list(sub.get())
+            if msgs[0] == b"event:reinit\n\n":
+                # The subscriber fell behind and lost some events.
+                return
+            # This is what the EventSource handler writes.
+            b"".join(msgs)
+            received[idx] += len(msgs)
+            last[idx] = msgs[-1]
+
+    greenlets = [gevent.spawn(subscriber_loop, i)
+                 for i in xrange(args.subscribers)]
+    # Let all of them subscribe.
+    gevent.sleep(0)
+
+    start = time.time()
+    for burst in xrange(args.bursts):
+        for event in xrange(args.events):
+            publisher.put("score", "u%d t%d 1.00" % (burst, event))
+        # Let the subscribers run, as the server would do.
+        gevent.sleep(0)
+    gevent.joinall(greenlets)
+    elapsed = time.time() - start
+
+    print("Delivered %d events to %d subscribers in %.3f s "
+          "(%.0f deliveries/s)." % (total, args.subscribers, elapsed,
+                                    total * args.subscribers / elapsed))
+
+    expected = publisher._get_range(publisher._next - 1, publisher._next)[0]
+    if any(count != total for count in received) or \
+            any(msg != expected for msg in last):
+        print("Some subscriber didn't receive all events!")
+        return False
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
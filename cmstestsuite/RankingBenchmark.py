@@ -0,0 +1,244 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+# Copyright © 2014 Luca Wehrstedt <luca.wehrstedt@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measure how fast RankingWebServer computes the scores.
+
+Replay a stream of submissions and subchanges (the ones stored in the
+RWS data directory or, if it's empty or if asked so, a randomly
+generated one) on the Score objects of cmsranking.Scoring, once with
+the current NumberSet and once with the original list-based one, and
+check that both produce the same histories. Each replay is done twice:
+feeding the subchanges in time order and feeding them out of order
+(each one delayed by a random amount), which makes the Scores
+recompute their histories.
+
+The stores of cmsranking are created, and compacted, as soon as their
+modules are imported: to leave the data of a live RWS untouched they
+are created on a temporary copy of it.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from cmsranking.Config import config
+
+
+class ListNumberSet(object):
+    """The original implementation of NumberSet, as a reference.
+
+    """
+    def __init__(self):
+        self._impl = list()
+
+    def insert(self, val):
+        self._impl.append(val)
+
+    def remove(self, val):
+        self._impl.remove(val)
+
+    def query(self):
+        return max(self._impl + [0.0])
+
+    def clear(self):
+        del self._impl[:]
+
+
+def generate_stream(users, tasks, submissions, seed):
+    """Generate the data of a random contest.
+
+    Each user sends the given number of submissions on each task; each
+    submission is scored, possibly rescored later, and often tokened.
+
+    users (int): number of users.
+    tasks (int): number of tasks.
+    submissions (int): number of submissions per user and task.
+    seed (int): seed of the random number generator.
+
+    return (({unicode: dict}, {unicode: dict})): the data of the
+        submissions and of the subchanges, by key.
+
+    """
+    rnd = random.Random(seed)
+    submission_data = dict()
+    subchange_data = dict()
+    for u in xrange(users):
+        for t in xrange(tasks):
+            sub_time = 0
+            for s in xrange(submissions):
+                sub_time += rnd.randint(1, 600)
+                key = "%d_%d_%d" % (u, t, s)
+                submission_data[key] = {
+                    "user": "u%d" % u, "task": "t%d" % t, "time": sub_time}
+                subchange_data[key + "s"] = {
+                    "submission": key, "time": sub_time + 10,
+                    "score": float(rnd.randint(0, 100)), "extra": []}
+                if rnd.random() < 0.7:
+                    subchange_data[key + "t"] = {
+                        "submission": key,
+                        "time": sub_time + rnd.randint(10, 3000),
+                        "token": True}
+                if rnd.random() < 0.1:
+                    subchange_data[key + "r"] = {
+                        "submission": key,
+                        "time": sub_time + rnd.randint(10, 3000),
+                        "score": float(rnd.randint(0, 100)), "extra": []}
+    return submission_data, subchange_data
+
+
+def load_stored_data():
+    """Read the submissions and subchanges stored by RWS.
+
+    The stores are created on a temporary copy of their directories,
+    hence the real ones aren't modified. This has to be called before
+    anything else imports the stores.
+
+    return (({unicode: dict}, {unicode: dict})): the data of the
+        submissions and of the subchanges, by key.
+
+    """
+    lib_dir = tempfile.mkdtemp()
+    try:
+        for dir_name in ["submissions", "subchanges"]:
+            path = os.path.join(config.lib_dir, dir_name)
+            if os.path.isdir(path):
+                shutil.copytree(path, os.path.join(lib_dir, dir_name))
+        config.lib_dir = lib_dir
+        from cmsranking.Submission import store as submission_store
+        from cmsranking.Subchange import store as subchange_store
+        return submission_store.retrieve_list(), \
+            subchange_store.retrieve_list()
+    finally:
+        shutil.rmtree(lib_dir)
+
+
+def replay(submission_data, subchange_data, max_delay, seed):
+    """Compute the scores of all users on all tasks.
+
+    submission_data ({unicode: dict}): the submissions, by key.
+    subchange_data ({unicode: dict}): the subchanges, by key.
+    max_delay (int): the subchanges are fed in the order of their
+        time plus a random delay up to this many seconds (0 means in
+        time order).
+    seed (int): seed of the random number generator of the delays.
+
+    return ((float, {(unicode, unicode): list})): the time taken and
+        the score history of each user on each task.
+
+    """
+    # Imported here, as importing them creates the stores.
+    from cmsranking import Scoring
+    from cmsranking.Submission import Submission
+    from cmsranking.Subchange import Subchange
+
+    submissions = dict()
+    for key, data in submission_data.iteritems():
+        submission = Submission()
+        submission.set(data)
+        submission.key = key
+        submissions[key] = submission
+    subchanges = list()
+    for key, data in subchange_data.iteritems():
+        subchange = Subchange()
+        subchange.set(data)
+        subchange.key = key
+        subchanges.append(subchange)
+    # The order in which a live RWS would receive them: usually the
+    # order of their times, but evaluations can be late.
+    subchanges.sort(key=lambda s: (s.time, s.key))
+    rnd = random.Random(seed)
+    delays = dict((s.key, rnd.randint(0, max_delay)) for s in subchanges)
+    subchanges.sort(key=lambda s: s.time + delays[s.key])
+
+    start = time.time()
+    scores = dict()
+    for key, submission in submissions.iteritems():
+        ident = (submission.user, submission.task)
+        if ident not in scores:
+            scores[ident] = Scoring.Score()
+        scores[ident].create_submission(key, submission)
+    for subchange in subchanges:
+        submission = submissions[subchange.submission]
+        scores[(submission.user, submission.task)].create_subchange(
+            subchange.key, subchange)
+    elapsed = time.time() - start
+
+    return elapsed, dict((ident, score._history)
+                         for ident, score in scores.iteritems())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the score computation of RWS.")
+    parser.add_argument("-s", "--synthetic", action="store_true",
+                        help="use random data instead of the stored one")
+    parser.add_argument("--users", type=int, default=1000,
+                        help="number of users of the random contest")
+    parser.add_argument("--tasks", type=int, default=6,
+                        help="number of tasks of the random contest")
+    parser.add_argument("--submissions", type=int, default=50,
+                        help="submissions per user and task")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the random contest and delays")
+    parser.add_argument("--max-delay", type=int, default=300,
+                        help="maximum delay, in seconds, of the "
+                        "subchanges in the out-of-order replay")
+    args = parser.parse_args()
+
+    submission_data, subchange_data = load_stored_data()
+    if args.synthetic or len(subchange_data) == 0:
+        submission_data, subchange_data = generate_stream(
+            args.users, args.tasks, args.submissions, args.seed)
+    print("Replaying %d subchanges of %d submissions." %
+          (len(subchange_data), len(submission_data)))
+
+    from cmsranking import Scoring
+    current_number_set = Scoring.NumberSet
+
+    histories = list()
+    for description, max_delay in [("in order", 0),
+                                   ("out of order", args.max_delay)]:
+        for name, number_set in [("Current", current_number_set),
+                                 ("List", ListNumberSet)]:
+            Scoring.NumberSet = number_set
+            try:
+                elapsed, history = replay(submission_data, subchange_data,
+                                          max_delay, args.seed)
+            finally:
+                Scoring.NumberSet = current_number_set
+            print("%s NumberSet, %s: %.3f s." % (name, description, elapsed))
+            histories.append(history)
+
+    if any(history != histories[0] for history in histories[1:]):
+        print("The histories differ!")
+        return False
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
@@ -34,8 +34,11 @@ import random
 from StringIO import StringIO
 import hashlib
 import shutil
+import tempfile
 import unittest
 
+from mock import patch
+
 from cms.db.filecacher import FileCacher
 
 
@@ -324,5 +327,68 @@ class TestFileCacher(unittest.TestCase):
             self.file_cacher.delete(self.digest)
 
 
+class TestPersistentFileCacher(unittest.TestCase):
+    """Test the persistent cache of FileCacher, and how it avoids to
+    read again the unchanged files stored from a path.
+
+    """
+
+    def setUp(self):
+        self.base_path = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.base_path, "cache")
+        self.src_path = os.path.join(self.base_path, "file")
+        with io.open(self.src_path, 'wb') as src:
+            src.write(b"content")
+        self.digest = hashlib.sha1(b"content").hexdigest()
+
+    def tearDown(self):
+        shutil.rmtree(self.base_path, ignore_errors=True)
+
+    def test_unchanged_file(self):
+        """Store the same file twice, with two FileCachers sharing the
+        cache: the second one must not read it.
+
+        """
+        file_cacher = FileCacher(null=True, cache_path=self.cache_path)
+        self.assertEqual(file_cacher.put_file_from_path(self.src_path),
+                         self.digest)
+
+        file_cacher = FileCacher(null=True, cache_path=self.cache_path)
+        with patch.object(file_cacher, "put_file_from_fobj") as put:
+            self.assertEqual(file_cacher.put_file_from_path(self.src_path),
+                             self.digest)
+        self.assertFalse(put.called)
+        self.assertEqual(file_cacher.get_file_content(self.digest),
+                         b"content")
+
+    def test_changed_file(self):
+        """Store a file, change it and store it again: the new digest
+        must be returned.
+
+        """
+        file_cacher = FileCacher(null=True, cache_path=self.cache_path)
+        file_cacher.put_file_from_path(self.src_path)
+
+        with io.open(self.src_path, 'wb') as src:
+            src.write(b"other content")
+        os.utime(self.src_path, (0, 0))
+        self.assertEqual(file_cacher.put_file_from_path(self.src_path),
+                         hashlib.sha1(b"other content").hexdigest())
+
+    def test_dropped_file(self):
+        """Store a file, drop it from the cache and store it again: it
+        must be read again.
+
+        """
+        file_cacher = FileCacher(null=True, cache_path=self.cache_path)
+        file_cacher.put_file_from_path(self.src_path)
+        file_cacher.drop(self.digest)
+
+        self.assertEqual(file_cacher.put_file_from_path(self.src_path),
+                         self.digest)
+        self.assertEqual(file_cacher.get_file_content(self.digest),
+                         b"content")
+
+
 if __name__ == "__main__":
     unittest.main()
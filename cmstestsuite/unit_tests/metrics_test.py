@@ -0,0 +1,94 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+# Copyright © 2014 Luca Wehrstedt <luca.wehrstedt@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the metrics registry."""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import unittest
+
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+from cmscommon.metrics import MetricsRegistry
+
+
+class TestMetricsRegistry(unittest.TestCase):
+    """Test the class cmscommon.metrics.MetricsRegistry."""
+    def setUp(self):
+        """Create an empty registry."""
+        self.registry = MetricsRegistry()
+
+    def get_lines(self):
+        """Return the non-comment lines of the exposition."""
+        return [line for line in
+                self.registry.render().decode('utf-8').splitlines()
+                if not line.startswith("#")]
+
+    def test_counter(self):
+        """Test counters, with labels."""
+        counter = self.registry.counter("c_total", "Doc.", ["method"])
+        counter.inc(method="echo")
+        counter.inc(2, method="echo")
+        counter.inc(method="quit")
+        self.assertEqual(self.get_lines(), ['c_total{method="echo"} 3.0',
+                                            'c_total{method="quit"} 1.0'])
+        self.assertRaises(ValueError, counter.inc, -1, method="echo")
+        self.assertRaises(ValueError, counter.inc, other="echo")
+
+    def test_gauge(self):
+        """Test gauges, both set and computed."""
+        values = [1]
+        self.registry.gauge("g", "Doc.").set_function(lambda: len(values))
+        self.assertEqual(self.get_lines(), ["g 1.0"])
+        values.append(2)
+        self.assertEqual(self.get_lines(), ["g 2.0"])
+        self.registry.gauge("g", "Doc.").set(7)
+        self.assertEqual(self.get_lines(), ["g 7.0"])
+
+    def test_histogram(self):
+        """Test that histograms are cumulative."""
+        histogram = self.registry.histogram("h", "Doc.", buckets=[1, 10])
+        for value in [0.5, 1, 5, 50]:
+            histogram.observe(value)
+        self.assertEqual(self.get_lines(), ['h_bucket{le="1.0"} 2.0',
+                                            'h_bucket{le="10.0"} 3.0',
+                                            'h_bucket{le="+Inf"} 4.0',
+                                            'h_count 4.0',
+                                            'h_sum 56.5'])
+
+    def test_type_conflict(self):
+        """Test that a name can't be reused for another type."""
+        self.registry.counter("m", "Doc.")
+        self.assertRaises(ValueError, self.registry.gauge, "m", "Doc.")
+
+    def test_wsgi(self):
+        """Test the HTTP endpoint."""
+        self.registry.gauge("g", "Doc.").set(1)
+        client = Client(self.registry, BaseResponse)
+        response = client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"\ng 1.0\n", response.data)
+        self.assertEqual(client.get("/").status_code, 404)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+# Copyright © 2014 Luca Wehrstedt <luca.wehrstedt@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the persistence of the stores of RWS.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from cmsranking.Config import config
+
+# Importing the entities creates their stores, in the lib_dir: keep
+# them away from the real one.
+config.lib_dir = tempfile.mkdtemp()
+
+from cmsranking.Store import Store
+from cmsranking.Submission import Submission
+
+
+def tearDownModule():
+    shutil.rmtree(config.lib_dir)
+
+
+class TestStore(unittest.TestCase):
+    """Test that a Store reloads what it persisted."""
+
+    SUBMISSION = {"user": "u", "task": "t", "time": 1}
+
+    def setUp(self):
+        self.path = os.path.join(config.lib_dir, "test")
+        os.mkdir(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, name, records):
+        """Write one JSON object per line in a file of the store."""
+        with io.open(os.path.join(self.path, name), 'wb') as fobj:
+            for record in records:
+                fobj.write(json.dumps(record) + b"\n")
+
+    def assertStored(self, store):
+        self.assertEqual(store.retrieve_list(), {"s1": self.SUBMISSION})
+
+    def test_legacy(self):
+        """Test the migration from a file per entity."""
+        self.write("s1.json", [self.SUBMISSION])
+        self.assertStored(Store(Submission, "test"))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.path, Store.SNAPSHOT_NAME)))
+        # Reopen it from the snapshot.
+        self.assertStored(Store(Submission, "test"))
+
+    def test_log(self):
+        """Test reopening a store whose log isn't empty."""
+        self.write(Store.LOG_NAME, [{"key": "s1", "data": self.SUBMISSION},
+                                    {"key": "s2", "data": self.SUBMISSION},
+                                    {"key": "s2"}])
+        self.assertStored(Store(Submission, "test"))
+        with io.open(os.path.join(self.path, Store.LOG_NAME), 'rb') as log:
+            self.assertEqual(log.read(), b"")
+        self.assertStored(Store(Submission, "test"))
+
+
+if __name__ == "__main__":
+    unittest.main()
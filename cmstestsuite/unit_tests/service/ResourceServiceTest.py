@@ -28,7 +28,7 @@ from __future__ import unicode_literals
 import unittest
 
 from cms import ServiceCoord
-from cms.service.ResourceService import ResourceService
+from cms.service.ResourceService import ResourceHistory, ResourceService
 
 
 class TestResourceService(unittest.TestCase):
@@ -83,5 +83,69 @@ class TestResourceService(unittest.TestCase):
         self.assertFalse(ResourceService._is_service_proc(
             service, cmdline.split(" ")), cmdline)
 
+
+class TestResourceHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.service = ServiceCoord("Worker", 0)
+        self.history = ResourceHistory([self.service])
+
+    def sample(self, user, running=True):
+        """Return a sample with the given CPU usage."""
+        service = {"autorestart": None, "running": running}
+        if running:
+            service.update({"since": 10.0, "resident": 5.0, "virtual": 9.0,
+                            "user": user, "sys": 0, "threads": 2})
+        return {"cpu": {"user": user, "num_cpu": 4},
+                "memory": {"ram_used": 100.0},
+                "services": {"Worker,0": service}}
+
+    def test_round_trip(self):
+        """Test that samples are returned as they were stored."""
+        self.history.add(1000, self.sample(30))
+        self.history.add(1005, self.sample(40, running=False))
+        self.assertEqual(self.history.get_since(0), [
+            (1000, {"cpu": {"user": 30, "num_cpu": 4},
+                    "memory": {"ram_used": 100.0},
+                    "services": {"Worker,0": {
+                        "running": True, "since": 10.0, "resident": 5.0,
+                        "virtual": 9.0, "user": 30, "sys": 0,
+                        "threads": 2}}}),
+            (1005, {"cpu": {"user": 40, "num_cpu": 4},
+                    "memory": {"ram_used": 100.0},
+                    "services": {"Worker,0": {"running": False}}})])
+        self.assertEqual([t for t, unused in self.history.get_since(1000)],
+                         [1005])
+
+    def test_ring(self):
+        """Test that only the last samples are kept."""
+        size = ResourceHistory.FULL_SIZE
+        for i in xrange(size + 10):
+            self.history.add(i * 5, self.sample(i % 100))
+        samples = self.history.get_since(45, resolution=5)
+        self.assertEqual(len(samples), size)
+        self.assertEqual(samples[0][0], 50)
+        self.assertEqual(samples[-1][0], (size + 9) * 5)
+
+    def test_downsampling(self):
+        """Test that older data comes from the coarser buffers."""
+        size = ResourceHistory.FULL_SIZE
+        # Twice the span of the full resolution buffer.
+        for i in xrange(2 * size):
+            self.history.add(i * 5, self.sample(i % 12 * 10))
+        samples = self.history.get_since(-1)
+        times = [t for t, unused in samples]
+        self.assertEqual(times, sorted(times))
+        # One per minute, then one every five seconds.
+        self.assertEqual(len(samples), size / 12 + size)
+        self.assertEqual(times[0], 55)
+        self.assertEqual(samples[0][1]["cpu"]["user"], 55)
+        self.assertEqual(samples[0][1]["services"]["Worker,0"]["since"],
+                         10.0)
+        # Coarser data can be asked explicitly.
+        samples = self.history.get_since(-1, resolution=600)
+        self.assertEqual(len(samples), 2 * size / 120 - 1)
+
+
 if __name__ == "__main__":
     unittest.main()
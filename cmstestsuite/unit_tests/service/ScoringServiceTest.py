@@ -99,6 +99,31 @@ class TestScoringService(unittest.TestCase):
         # Asserts that compute_score was called.
         assert score_type.compute_score.mock_calls == []
 
+    def test_new_evaluation_active_dataset(self):
+        """The task score is updated when scoring the active dataset.
+
+        """
+        sr_a = TestScoringService.new_sr_to_score()
+        sr_b = TestScoringService.new_sr_to_score()
+        score_type = Mock()
+        score_type.compute_score.return_value = self.new_score_info()
+        submission, dataset = \
+            TestScoringService.set_up_db([sr_a, sr_b], score_type)
+        submission.task.active_dataset = dataset
+        update_user_task_score = Mock()
+        cms.service.ScoringService.update_user_task_score = \
+            update_user_task_score
+        cms.service.ScoringService.User.get_from_id = Mock()
+        cms.service.ScoringService.Task.get_from_id = Mock()
+
+        self.service.new_evaluation(123, 456)
+        self.service.new_evaluation(123, 456)
+
+        gevent.sleep(0)  # Needed to trigger the score loop.
+        gevent.sleep(0)  # Needed to trigger the task score loop.
+        # Asserts that the task score was updated once.
+        assert len(update_user_task_score.mock_calls) == 1
+
     @staticmethod
     def new_sr_to_score():
         sr = Mock()
@@ -127,12 +152,14 @@ class TestScoringService(unittest.TestCase):
     def set_up_db(srs, score_type):
         submission = Mock()
         submission.get_result = Mock(side_effect=srs)
+        dataset = Mock()
         cms.service.ScoringService.Submission.get_from_id = \
             Mock(return_value=submission)
         cms.service.ScoringService.Dataset.get_from_id = \
-            Mock(return_value=Mock())
+            Mock(return_value=dataset)
         cms.service.ScoringService.get_score_type = \
             Mock(return_value=score_type)
+        return submission, dataset
 
 
 if __name__ == "__main__":
@@ -56,6 +56,8 @@ class TestWorker(unittest.TestCase):
         cms.service.Worker.get_task_type.assert_has_calls(
             calls, any_order=True)
         self.assertEquals(task_type.call_count, 3)
+        # Once for each of the (different) task types of the jobs.
+        self.assertEquals(task_type.cleanup_count, 3)
 
     def test_execute_job_group_jobs_failure(self):
         """Executes a job group with three unsuccessful jobs.
@@ -228,6 +230,7 @@ class FakeTaskType(object):
         self.execute_results = execute_results
         self.index = 0
         self.call_count = 0
+        self.cleanup_count = 0
 
     def execute_job(self, job, file_cacher):
         self.call_count += 1
@@ -244,6 +247,9 @@ class FakeTaskType(object):
             job.success = True
             gevent.sleep(result)
 
+    def cleanup(self):
+        self.cleanup_count += 1
+
     def set_results(self, results):
         self.execute_results = results
 